@@ -0,0 +1,358 @@
+"""Admission control of the LLM calls of all workers.
+
+The controller runs in the chatbot process, the workers ask it for a slot
+before calling the provider and block until the slot is granted. Slots
+are bounded by a global concurrency cap and by the provider's requests
+and tokens per minute. VIP users are served before free users. Within
+each class users share the slots fairly, in proportion to their weight
+(the "weight" of their quota, 1 by default): a user with many waiting
+requests does not hold back the others. When the workers serve several
+bots, each bot may also be limited to a number of concurrent calls.
+"""
+import contextlib
+import heapq
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+
+import metrics
+
+# Tokens expected in a reply, the estimate is corrected on release.
+REPLY_TOKENS = 256
+# Seconds a worker waits for a slot before giving up.
+ADMISSION_TIMEOUT = 60
+
+
+class Overloaded(Exception):
+    """No slot was granted in time."""
+
+
+class TokenBucket:
+    """Allows `rate` units per minute, with bursts up to `rate`."""
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.available = rate
+        self._refilled_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.rate, self.available + (now - self._refilled_at) * self.rate / 60)
+        self._refilled_at = now
+
+    def take(self, amount: float) -> bool:
+        self._refill()
+        if self.available < amount:
+            return False
+        self.available -= amount
+        return True
+
+    def adjust(self, amount: float):
+        """Takes amount more, or gives it back if negative. The bucket may
+        go below zero, later requests then wait longer."""
+        self._refill()
+        self.available = min(self.rate, self.available - amount)
+
+
+class FairQueue:
+    """Weighted fair queue of the requests of several users.
+
+    Each request gets a virtual finish time: its cost divided by the
+    user's weight, added to the finish time of the user's previous request
+    (or to the current virtual time if the user has nothing waiting).
+    Requests are served in finish time order.
+    """
+
+    def __init__(self) -> None:
+        self._heap = []
+        self._order = itertools.count()
+        self._finish = {}
+        self._virtual_time = 0.0
+
+    def push(self, user, item, cost: float = 1.0, weight: float = 1.0):
+        start = max(self._virtual_time, self._finish.get(user, 0.0))
+        finish = start + max(cost, 1.0) / weight
+        self._finish[user] = finish
+        heapq.heappush(self._heap, (finish, next(self._order), item))
+
+    def peek(self):
+        return self._heap[0][2] if self._heap else None
+
+    def items(self):
+        """Returns the items in service order."""
+        return [item for _, _, item in sorted(self._heap)]
+
+    def pop(self, item=None):
+        """Removes the first item, or the given one."""
+        if item is None or item == self._heap[0][2]:
+            finish, _, item = heapq.heappop(self._heap)
+        else:
+            position = next(i for i, entry in enumerate(self._heap) if entry[2] == item)
+            finish = self._heap.pop(position)[0]
+            heapq.heapify(self._heap)
+        self._virtual_time = max(self._virtual_time, finish)
+        if not self._heap:
+            # Nothing waits, forget the users.
+            self._finish.clear()
+        return item
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+
+class AdmissionController:
+    """Grants LLM call slots to the workers through multiprocessing queues.
+    Workers get their end with client(index)."""
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        rpm: float = 3500,
+        tpm: float = 90000,
+        group_limit: int = 0,
+    ) -> None:
+        self.max_concurrency = max(1, max_concurrency)
+        # Calls of a group (bot) in progress at most, 0 for no limit.
+        self.group_limit = group_limit
+        self._group_in_flight = {}
+        self.requests_per_min = TokenBucket(rpm)
+        self.tokens_per_min = TokenBucket(tpm)
+        self.requests = multiprocessing.Queue()
+        # {(worker, epoch): grants queue}, epoch counts the incarnations of
+        # a worker so a restarted one never gets the grants of the dead one.
+        self._grants = {}
+        self._epochs = {}
+        # {(worker, epoch, request id): request}, requests whose turn has
+        # not come.
+        self._waiting = {}
+        self._queues = {True: FairQueue(), False: FairQueue()}
+        # {(worker, epoch, request id): (estimated tokens, group)}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.granted = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def client(self, index: int):
+        """Returns the client of a new incarnation of worker index, create
+        it before the worker process starts. The requests of the previous
+        one are forgotten."""
+        grants = multiprocessing.Queue()
+        with self._lock:
+            epoch = self._epochs.get(index, 0) + 1
+            self._epochs[index] = epoch
+            self._grants.pop((index, epoch - 1), None)
+            self._forget(index, epoch)
+            self._grants[(index, epoch)] = grants
+        return AdmissionClient(self.requests, grants, index, epoch)
+
+    def reset(self, index: int):
+        """Frees the slots of a worker which died."""
+        with self._lock:
+            self._forget(index, self._epochs.get(index, 0) + 1)
+
+    def _forget(self, index: int, epoch: int):
+        # Requests of the incarnations of worker index before epoch.
+        for key in [key for key in self._waiting if key[0] == index and key[1] < epoch]:
+            del self._waiting[key]
+        for key in [key for key in self._in_flight if key[0] == index and key[1] < epoch]:
+            self._end(key)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="admission", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self.requests.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            # Poll while requests wait for the rate limits to refill.
+            timeout = 0.05 if self._waiting else None
+            try:
+                msg = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                msg = ()
+            if msg is None:
+                return
+            with self._lock:
+                if msg:
+                    self._handle(msg)
+                self._dispatch()
+
+    def _handle(self, msg):
+        kind, key = msg[0], msg[1]
+        if key[1] != self._epochs.get(key[0]):
+            # Sent by a worker which died since.
+            return
+        if kind == "acquire":
+            _, key, user, vip, tokens, enqueued_at, group, weight = msg
+            tokens = min(tokens, self.tokens_per_min.rate)
+            self._waiting[key] = (vip, tokens, enqueued_at, group)
+            self._queues[vip].push(user, key, cost=tokens, weight=weight)
+        elif kind == "release":
+            _, key, tokens = msg
+            entry = self._end(key)
+            if entry is not None:
+                self.tokens_per_min.adjust(tokens - entry[0])
+        elif kind == "cancel":
+            _, key = msg
+            # Removed from its queue when it comes first.
+            self._waiting.pop(key, None)
+            self._end(key)
+
+    def _end(self, key):
+        entry = self._in_flight.pop(key, None)
+        if entry is not None and entry[1] is not None:
+            self._group_in_flight[entry[1]] -= 1
+        return entry
+
+    def _group_full(self, group) -> bool:
+        return (
+            self.group_limit > 0
+            and group is not None
+            and self._group_in_flight.get(group, 0) >= self.group_limit
+        )
+
+    def _next_request(self):
+        """Returns the key of the next request, VIP users first. Requests
+        of groups at their limit are passed over."""
+        for vip in (True, False):
+            fair_queue = self._queues[vip]
+            while len(fair_queue) > 0 and fair_queue.peek() not in self._waiting:
+                # Cancelled.
+                fair_queue.pop()
+            if self.group_limit <= 0:
+                if len(fair_queue) > 0:
+                    return fair_queue.peek(), fair_queue
+                continue
+            for key in fair_queue.items():
+                request = self._waiting.get(key)
+                if request is not None and not self._group_full(request[3]):
+                    return key, fair_queue
+        return None, None
+
+    def _dispatch(self):
+        while len(self._in_flight) < self.max_concurrency:
+            key, fair_queue = self._next_request()
+            if key is None:
+                return
+            _, tokens, enqueued_at, group = self._waiting[key]
+            if not self.requests_per_min.take(1):
+                return
+            if not self.tokens_per_min.take(tokens):
+                self.requests_per_min.adjust(-1)
+                return
+            fair_queue.pop(key)
+            del self._waiting[key]
+            self._in_flight[key] = (tokens, group)
+            if group is not None:
+                self._group_in_flight[group] = self._group_in_flight.get(group, 0) + 1
+            index, epoch, request_id = key
+            self._grants[(index, epoch)].put(request_id)
+            waited = time.time() - enqueued_at
+            self.granted += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            metrics.observe("admission.wait", waited)
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.time()
+            vip = sum(1 for request in self._waiting.values() if request[0])
+            oldest = min((request[2] for request in self._waiting.values()), default=now)
+            return {
+                "in_flight": len(self._in_flight),
+                "max_concurrency": self.max_concurrency,
+                "waiting_vip": vip,
+                "waiting_free": len(self._waiting) - vip,
+                "oldest_wait": now - oldest,
+                "granted": self.granted,
+                "wait_avg": self.wait_total / self.granted if self.granted else 0.0,
+                "wait_max": self.wait_max,
+            }
+
+
+class AdmissionClient:
+    """The worker end of the controller."""
+
+    def __init__(self, requests, grants, index: int, epoch: int = 1) -> None:
+        self.requests = requests
+        self.grants = grants
+        self.index = index
+        self.epoch = epoch
+        self._request_ids = itertools.count(1)
+
+    def _key(self, request_id: int):
+        return (self.index, self.epoch, request_id)
+
+    def acquire(
+        self,
+        user,
+        vip: bool,
+        tokens: int,
+        timeout: float = ADMISSION_TIMEOUT,
+        group=None,
+        weight: float = 1.0,
+    ) -> int:
+        """Blocks until a slot is granted, returns the request id to release.
+        A user of weight 2 gets twice the share of a user of weight 1.
+        Raises Overloaded after timeout seconds."""
+        request_id = next(self._request_ids)
+        self.requests.put(
+            ("acquire", self._key(request_id), user, vip, tokens, time.time(), group, weight))
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.requests.put(("cancel", self._key(request_id)))
+                raise Overloaded(f"no LLM slot in {timeout} seconds")
+            try:
+                granted = self.grants.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            # Older grants belong to cancelled requests.
+            if granted == request_id:
+                return request_id
+
+    def release(self, request_id: int, tokens: int):
+        self.requests.put(("release", self._key(request_id), tokens))
+
+
+class Slot:
+    def __init__(self, tokens: int) -> None:
+        # Set to the tokens actually used before the slot is released.
+        self.tokens = tokens
+
+
+# The client of this worker process, None runs calls unrestricted.
+_client = None
+
+
+def configure(client):
+    global _client
+    _client = client
+
+
+@contextlib.contextmanager
+def slot(user, vip: bool, tokens: int, group=None, weight: float = 1.0):
+    """Holds an LLM call slot of the user, of the bot `group`."""
+    if _client is None:
+        yield Slot(tokens)
+        return
+    start = time.perf_counter()
+    request_id = _client.acquire(user, vip, tokens, group=group, weight=weight)
+    metrics.observe("admission.acquire", time.perf_counter() - start)
+    held = Slot(tokens)
+    try:
+        yield held
+    finally:
+        _client.release(request_id, held.tokens)
+        logging.debug("Released LLM slot %d, %d tokens", request_id, held.tokens)
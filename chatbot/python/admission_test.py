@@ -0,0 +1,99 @@
+import threading
+import unittest
+import admission
+
+
+class TestAdmission(unittest.TestCase):
+    def test_fair_queue(self):
+        fair_queue = admission.FairQueue()
+        for i in range(3):
+            fair_queue.push("a", f"a{i}")
+        fair_queue.push("b", "b0")
+        order = [fair_queue.pop() for _ in range(4)]
+        # b does not wait behind all the requests of a.
+        self.assertLess(order.index("b0"), 2)
+
+    def test_fair_queue_weights(self):
+        fair_queue = admission.FairQueue()
+        for i in range(4):
+            fair_queue.push("light", f"l{i}")
+            fair_queue.push("heavy", f"h{i}", weight=2)
+        first = [fair_queue.pop() for _ in range(6)]
+        # Twice the share for the user of weight 2.
+        self.assertEqual(sum(item.startswith("h") for item in first), 4)
+
+    def test_restarted_worker(self):
+        controller = admission.AdmissionController(max_concurrency=1)
+        dead = controller.client(0)
+        controller.start()
+        try:
+            dead.acquire("a", False, 10)
+            # The worker dies holding the slot, its last request is queued.
+            dead.requests.put(("acquire", dead._key(2), "a", False, 10, 0.0, None, 1.0))
+            controller.reset(0)
+            restarted = controller.client(0)
+            # Gets the slot for its own request 1, not the dead one's grant.
+            self.assertEqual(restarted.acquire("b", False, 10, timeout=1), 1)
+            self.assertTrue(restarted.grants.empty())
+            self.assertEqual(controller.stats()["in_flight"], 1)
+            self.assertEqual(controller.stats()["waiting_free"], 0)
+        finally:
+            controller.stop()
+
+    def test_vip_first(self):
+        controller = admission.AdmissionController(max_concurrency=1)
+        free = controller.client(0)
+        vip = controller.client(1)
+        controller.start()
+        try:
+            first = free.acquire("free", False, 10)
+            result = []
+
+            def wait(client, user, is_vip):
+                request_id = client.acquire(user, is_vip, 10, timeout=5)
+                result.append(user)
+                client.release(request_id, 10)
+
+            threads = [
+                threading.Thread(target=wait, args=(free, "free2", False)),
+                threading.Thread(target=wait, args=(vip, "vip", True)),
+            ]
+            threads[0].start()
+            threads[1].start()
+            # Both wait for the single slot.
+            while controller.stats()["waiting_free"] + controller.stats()["waiting_vip"] < 2:
+                threading.Event().wait(0.01)
+            free.release(first, 10)
+            for thread in threads:
+                thread.join(timeout=5)
+            self.assertEqual(result, ["vip", "free2"])
+        finally:
+            controller.stop()
+
+    def test_timeout(self):
+        controller = admission.AdmissionController(max_concurrency=1)
+        client = controller.client(0)
+        controller.start()
+        try:
+            client.acquire("a", False, 10)
+            with self.assertRaises(admission.Overloaded):
+                client.acquire("b", False, 10, timeout=0.1)
+        finally:
+            controller.stop()
+
+    def test_group_limit(self):
+        controller = admission.AdmissionController(max_concurrency=4, group_limit=1)
+        client = controller.client(0)
+        controller.start()
+        try:
+            client.acquire("a", False, 10, group="noisy")
+            with self.assertRaises(admission.Overloaded):
+                client.acquire("b", False, 10, timeout=0.1, group="noisy")
+            # The other bot is not held back.
+            client.acquire("c", False, 10, timeout=1, group="quiet")
+        finally:
+            controller.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
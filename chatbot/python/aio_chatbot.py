@@ -0,0 +1,202 @@
+"""asyncio implementation of the chatbot engine built on grpc.aio."""
+import asyncio
+import logging
+import signal
+import threading
+import time
+import traceback
+
+import grpc
+
+# Import generated grpc modules
+import model_pb2_grpc as pbx
+import metrics
+import utils
+from chatbot import ChatBot, reconnect_delay
+
+
+class AsyncChatBot(ChatBot):
+    """Drives the MessageLoop stream from a single event loop.
+
+    Outbound messages go through an asyncio.Queue and every inbound message
+    is handled by a task, so there is no idle timeout and no retry counter.
+    The {hi}, {login}, {sub} and {pub} builders and the onCompletion futures
+    are inherited from ChatBot unchanged.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.loop_thread_id = None
+        self.aio_queue_out = None
+        # Keep references to the running handlers so they are not collected.
+        self.tasks = set()
+
+    def client_post(self, msg):
+        # Queued with the time, as the messages of the workers.
+        if threading.get_ident() == self.loop_thread_id:
+            self.aio_queue_out.put_nowait((time.time(), msg))
+        else:
+            self.loop.call_soon_threadsafe(self.aio_queue_out.put_nowait, (time.time(), msg))
+
+    async def client_generate(self):
+        # The queue of this stream, see client_reset.
+        out = self.aio_queue_out
+        while True:
+            queued_at, msg = await out.get()
+            if msg == None:
+                logging.warning("Msg Is None.")
+                return
+            metrics.observe("out.enqueue_to_send", time.time() - queued_at)
+            logging.debug("out: %s", utils.lazy_json(msg), extra={"category": "msg.out"})
+            yield msg
+
+    def client_reset(self):
+        # A new queue for the new stream: the generator of the old stream
+        # may still wait on its queue, it would take the {login}.
+        logging.info("Dropping the out queue...")
+        self.aio_queue_out = asyncio.Queue()
+        # The responses to the requests of the old stream will not come.
+        dropped = self.onCompletion.clear()
+        if dropped:
+            logging.info("Dropped %d pending requests", dropped)
+
+    def pump_worker_replies(self):
+        # The workers post their replies into a multiprocessing queue,
+        # forward them to the event loop.
+        while True:
+            queued_at, msg = self.queue_out.get_timed()
+            if msg == None:
+                continue
+            try:
+                self.loop.call_soon_threadsafe(self.aio_queue_out.put_nowait, (queued_at, msg))
+            except RuntimeError:
+                # Event loop is closed, the bot is shutting down.
+                return
+
+    def init_client(self, addr, schema, secret, cookie_file_name=".tn-cookie", secure=False, ssl_host=""):
+        logging.info(
+            "Connecting to %s %s %s %s",
+            "secure" if secure else "",
+            "server at",
+            addr,
+            "SNI=" + ssl_host if ssl_host else "",
+        )
+
+        if secure:
+            opts = (("grpc.ssl_target_name_override", ssl_host),) if ssl_host else None
+            self.channel = grpc.aio.secure_channel(
+                addr, grpc.ssl_channel_credentials(), opts
+            )
+        else:
+            channel_options = [
+                ("grpc.keepalive_time_ms", 60000),  # 1 minute
+                ("grpc.keepalive_timeout_ms", 10000),  # 10 seconds
+                ("grpc.keepalive_permit_without_calls", 1),  # enabled
+            ]
+            self.channel = grpc.aio.insecure_channel(addr, channel_options)
+
+        # Call the server
+        stream = pbx.NodeStub(self.channel).MessageLoop(self.client_generate())
+
+        # Session initialization sequence: {hi}, {login}, {sub topic='me'}
+        self.client_post(self.hello())
+        self.client_post(self.login(cookie_file_name, schema, secret))
+
+        return stream
+
+    def call_soon(self, func, *args):
+        # Called from the threads of the Plugin server.
+        self.loop.call_soon_threadsafe(func, *args)
+
+    async def handle_server_msg_async(self, msg):
+        try:
+            self.handle_server_msg(msg)
+        except Exception as err:
+            logging.error(traceback.format_exc())
+            logging.error("Error handling server message: %s", err)
+
+    async def expire_futures_async(self):
+        # Fails the requests left without a response.
+        while True:
+            await asyncio.sleep(self.onCompletion.tick)
+            self.onCompletion.expire()
+
+    async def client_message_loop(self, stream):
+        try:
+            # Read server responses
+            async for msg in stream:
+                logging.debug("in: %s", utils.lazy_json(msg), extra={"category": "msg.in"})
+                task = self.loop.create_task(self.handle_server_msg_async(msg))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        except grpc.aio.AioRpcError as err:
+            logging.error("Disconnected: %s", err)
+
+    def run(self, host_addr):
+        asyncio.run(self.run_async(host_addr))
+
+    async def run_async(self, host_addr):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.aio_queue_out = asyncio.Queue()
+
+        # Start the workers before any grpc channel is created,
+        # grpc does not survive a fork.
+        self.start_metrics()
+        metrics.gauge("out_queue_depth", lambda: self.queue_out.qsize() + self.aio_queue_out.qsize())
+        self.pool.start()
+        threading.Thread(target=self.pump_worker_replies, daemon=True).start()
+        if self.plugin_listen:
+            self.plugin_server = self.init_server(self.plugin_listen, self.plugin_workers)
+
+        main_task = asyncio.current_task()
+
+        # Setup closure for graceful termination
+        def exit_gracefully(signo):
+            logging.info("Terminated with signal %s ", signo)
+            main_task.cancel()
+
+        # Add signal handlers
+        self.loop.add_signal_handler(signal.SIGINT, exit_gracefully, signal.SIGINT)
+        self.loop.add_signal_handler(signal.SIGTERM, exit_gracefully, signal.SIGTERM)
+
+        expiry = self.loop.create_task(self.expire_futures_async())
+        try:
+            await self.connect_loop(host_addr)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            expiry.cancel()
+            if self.plugin_server is not None:
+                self.plugin_server.stop(0)
+            self.pool.stop()
+
+    async def connect_loop(self, host_addr):
+        """Keeps the MessageLoop stream of the bot open until cancelled."""
+        schema = "basic"
+        secret = f"{self.name}:{self.passwd}".encode("utf-8")
+        try:
+            # Run the message loop in a cycle to handle server being down.
+            while True:
+                self.client = self.init_client(host_addr, schema, secret)
+                try:
+                    await self.client_message_loop(self.client)
+                except Exception as err:
+                    logging.error(traceback.format_exc())
+                    logging.error("Error: %s", err)
+                delay = reconnect_delay(self.reconnect_attempts)
+                self.reconnect_attempts += 1
+                logging.error("Disconnected. Reconnecting in %.1f seconds...", delay)
+                metrics.inc("reconnects")
+                self.client.cancel()
+                await self.channel.close()
+                await asyncio.sleep(delay)
+                logging.info("Resetting client")
+                self.client_reset()
+                logging.info("Reconnecting")
+        except asyncio.CancelledError:
+            if self.client is not None:
+                self.client.cancel()
+                await self.channel.close()
+            raise
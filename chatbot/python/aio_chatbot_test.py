@@ -0,0 +1,113 @@
+import asyncio
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import unittest
+import grpc
+import model_pb2 as pb
+import model_pb2_grpc as pbx
+import aio_chatbot
+
+
+class Node(pbx.NodeServicer):
+    """Answers the requests of the bot, sends what the test puts in out."""
+
+    def __init__(self) -> None:
+        self.received = []
+        self.out = asyncio.Queue()
+
+    async def MessageLoop(self, request_iterator, context):
+        async def read():
+            async for msg in request_iterator:
+                self.received.append(msg)
+                self.answer(msg)
+
+        reader = asyncio.ensure_future(read())
+        try:
+            while True:
+                msg = await self.out.get()
+                if msg is None:
+                    return
+                yield msg
+        finally:
+            reader.cancel()
+
+    def answer(self, msg):
+        kind = msg.WhichOneof("Message")
+        if kind in ("pub", "leave"):
+            # Not answered.
+            return
+        params = {}
+        if kind == "login":
+            params = {"user": json.dumps("usrBot").encode("utf-8")}
+        self.out.put_nowait(pb.ServerMsg(ctrl=pb.ServerCtrl(
+            id=getattr(msg, kind).id, code=200, text="ok", params=params)))
+
+    def kinds(self):
+        return [msg.WhichOneof("Message") for msg in self.received]
+
+
+class TestAsyncChatBot(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # The bot saves its login cookie in the current folder.
+        self.cwd = os.getcwd()
+        self.folder = tempfile.TemporaryDirectory()
+        os.chdir(self.folder.name)
+        self.node = Node()
+        self.server = grpc.aio.server()
+        pbx.add_NodeServicer_to_server(self.node, self.server)
+        port = self.server.add_insecure_port("127.0.0.1:0")
+        await self.server.start()
+        self.bot = aio_chatbot.AsyncChatBot("bot", "secret", None, workers=1)
+        self.bot.loop = asyncio.get_running_loop()
+        self.bot.loop_thread_id = threading.get_ident()
+        self.bot.aio_queue_out = asyncio.Queue()
+        self.processed = []
+        self.bot.process_data_msg = lambda msg: self.processed.append(msg) or True
+        self.task = asyncio.create_task(self.bot.connect_loop(f"127.0.0.1:{port}"))
+
+    async def asyncTearDown(self):
+        self.task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self.task
+        await self.server.stop(0)
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+
+    async def wait_for(self, condition, timeout=5.0):
+        async def check():
+            while not condition():
+                await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(check(), timeout)
+
+    async def test_session(self):
+        await self.wait_for(lambda: "sub" in self.node.kinds())
+        self.assertEqual(self.node.kinds(), ["hi", "login", "sub"])
+        self.assertEqual(self.node.received[-1].sub.topic, "me")
+        self.assertEqual(self.bot.botUID, "usrBot")
+        self.node.out.put_nowait(pb.ServerMsg(data=pb.ServerData(
+            topic="usrA", from_user_id="usrA", seq_id=1)))
+        await self.wait_for(lambda: self.processed)
+        self.assertEqual(self.processed[0].data.topic, "usrA")
+        # Replies posted from other threads go out on the stream.
+        thread = threading.Thread(
+            target=self.bot.client_post, args=(self.bot.publish("usrA", "hi"),))
+        thread.start()
+        thread.join()
+        await self.wait_for(lambda: "pub" in self.node.kinds())
+        self.assertEqual(len(self.bot.onCompletion), 0)
+
+    async def test_reconnect(self):
+        await self.wait_for(lambda: "sub" in self.node.kinds())
+        # A request of the closed stream is not answered.
+        self.bot.client_post(self.bot.leave("usrA"))
+        await self.wait_for(lambda: "leave" in self.node.kinds())
+        self.node.out.put_nowait(None)
+        await self.wait_for(lambda: self.node.kinds().count("hi") == 2)
+        self.assertEqual(self.bot.onCompletion.stats()["dropped"], 1)
+        # Logged in again.
+        await self.wait_for(lambda: self.node.kinds().count("sub") == 2)
+        self.assertEqual(self.node.kinds()[-3:], ["hi", "login", "sub"])
@@ -0,0 +1,32 @@
+"""Runs main.py and writes the number of forks of the bot process to
+$BENCH_FORKS_FILE when it exits. Started by run_bench.py."""
+import atexit
+import json
+import os
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+_forks = 0
+
+
+def _count_fork():
+    global _forks
+    _forks += 1
+
+
+def _report():
+    path = os.environ.get("BENCH_FORKS_FILE")
+    if path:
+        with open(path, "w") as f:
+            json.dump({"forks": _forks}, f)
+
+
+os.register_at_fork(before=_count_fork)
+atexit.register(_report)
+
+import main  # noqa: E402
+
+if __name__ == "__main__":
+    main.main()
@@ -0,0 +1,152 @@
+"""In-process stand-in for the Tinode Node gRPC service.
+
+It answers {hi}, {login}, {sub}, {leave}, {get}, {set} and {del} with a
+{ctrl}, acknowledges {pub} with a 202 and reports it through on_pub.
+Simulated users talk to the bot with send_data(), preceded by a {pres}
+on 'me' while the bot is not subscribed to the topic, as the real server
+does. Messages are fetched with the get query of a {sub} or {get}: newest
+first, then a {ctrl} of the same id.
+"""
+import base64
+import json
+import queue
+import threading
+import time
+from concurrent import futures
+
+import grpc
+
+import model_pb2 as pb
+import model_pb2_grpc as pbx
+
+BOT_UID = "usrBenchBot"
+
+
+class FakeNode(pbx.NodeServicer):
+    def __init__(self, on_pub=None) -> None:
+        # on_pub(topic, content, received_at) for each {pub} of the bot.
+        self.on_pub = on_pub
+        self.logged_in = threading.Event()
+        self._session = None
+        self._seq = {}
+        # {topic: [{data}]}, and the topics the bot is subscribed to.
+        self._messages = {}
+        self._subscribed = set()
+        self._lock = threading.Lock()
+        self.received = {}
+        self.sessions = 0
+
+    def MessageLoop(self, request_iterator, context):
+        out = queue.Queue()
+        with self._lock:
+            self._session = out
+            self._subscribed = set()
+            self.sessions += 1
+
+        def read():
+            try:
+                for msg in request_iterator:
+                    self._handle(msg, out)
+            except grpc.RpcError:
+                pass
+            out.put(None)
+
+        threading.Thread(target=read, daemon=True).start()
+        while True:
+            msg = out.get()
+            if msg is None:
+                return
+            yield msg
+
+    def _ctrl(self, out, id, code, topic="", params=None):
+        out.put(pb.ServerMsg(ctrl=pb.ServerCtrl(
+            id=id, topic=topic, code=code, text="ok", params=params or {})))
+
+    def _handle(self, msg, out):
+        kind = msg.WhichOneof("Message")
+        with self._lock:
+            self.received[kind] = self.received.get(kind, 0) + 1
+        if kind == "hi":
+            self._ctrl(out, msg.hi.id, 201, params={"build": b"fake", "ver": b"0.22"})
+        elif kind == "login":
+            token = base64.b64encode(b"bench-token").decode("ascii")
+            self._ctrl(out, msg.login.id, 200, params={
+                "user": json.dumps(BOT_UID).encode("utf-8"),
+                "token": json.dumps(token).encode("utf-8"),
+                "expires": json.dumps("2099-01-01T00:00:00Z").encode("utf-8"),
+            })
+            self.logged_in.set()
+        elif kind == "sub":
+            with self._lock:
+                self._subscribed.add(msg.sub.topic)
+            self._ctrl(out, msg.sub.id, 200, msg.sub.topic)
+            if msg.sub.get_query.what == "data":
+                self._get_data(out, msg.sub.id, msg.sub.topic, msg.sub.get_query.data)
+        elif kind == "leave":
+            with self._lock:
+                self._subscribed.discard(msg.leave.topic)
+            self._ctrl(out, msg.leave.id, 200, msg.leave.topic)
+        elif kind == "get" and msg.get.query.what == "data":
+            self._get_data(out, msg.get.id, msg.get.topic, msg.get.query.data)
+        elif kind in ("get", "set", "del", "acc"):
+            self._ctrl(out, getattr(msg, kind).id, 200)
+        elif kind == "pub":
+            self._ctrl(out, msg.pub.id, 202, msg.pub.topic)
+            if self.on_pub is not None:
+                self.on_pub(msg.pub.topic, msg.pub.content, time.perf_counter())
+
+    def _get_data(self, out, id, topic, opts):
+        with self._lock:
+            found = [
+                data for data in self._messages.get(topic, [])
+                if data.data.seq_id >= opts.since_id
+                and (not opts.before_id or data.data.seq_id < opts.before_id)
+            ]
+        found = found[::-1][:opts.limit or None]
+        for data in found:
+            out.put(data)
+        if found:
+            self._ctrl(out, id, 208, topic, {"what": b'"data"', "count": str(len(found)).encode()})
+        else:
+            self._ctrl(out, id, 204, topic, {"what": b'"data"'})
+
+    def send_data(self, topic: str, from_user_id: str, text: str) -> bool:
+        """Delivers a message of a user to the bot. Returns False if the
+        bot is not connected."""
+        with self._lock:
+            out = self._session
+            if out is None:
+                return False
+            seq = self._seq.get(topic, 0) + 1
+            self._seq[topic] = seq
+            data = pb.ServerMsg(data=pb.ServerData(
+                topic=topic,
+                from_user_id=from_user_id,
+                timestamp=int(time.time() * 1000),
+                seq_id=seq,
+                content=json.dumps(text).encode("utf-8"),
+            ))
+            self._messages.setdefault(topic, []).append(data)
+            subscribed = topic in self._subscribed
+        if subscribed:
+            out.put(data)
+        else:
+            out.put(pb.ServerMsg(pres=pb.ServerPres(
+                topic="me", src=topic, what=pb.ServerPres.MSG, seq_id=seq)))
+        return True
+
+    def close(self):
+        with self._lock:
+            out = self._session
+            self._session = None
+        if out is not None:
+            out.put(None)
+
+
+def serve(node: FakeNode, listen: str = "127.0.0.1:0"):
+    """Returns (server, port)."""
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=8))
+    pbx.add_NodeServicer_to_server(node, server)
+    port = server.add_insecure_port(listen)
+    server.start()
+    return server, port
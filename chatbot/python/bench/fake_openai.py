@@ -0,0 +1,128 @@
+"""Stand-in for the OpenAI chat completion endpoint.
+
+POST /v1/chat/completions answers after a random latency with a reply of a
+random number of tokens, streamed as server-sent events when asked. The
+random generator is seeded, runs with the same options see the same
+latencies and replies.
+"""
+import http.server
+import json
+import random
+import threading
+import time
+
+
+class Profile:
+    """Latency in seconds and reply size in tokens, both log-normal around
+    their median. Streamed tokens arrive every token_interval seconds."""
+
+    def __init__(
+        self,
+        latency: float = 0.5,
+        latency_sigma: float = 0.3,
+        tokens: int = 60,
+        tokens_sigma: float = 0.5,
+        token_interval: float = 0.0,
+        seed: int = 1,
+    ) -> None:
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.tokens = tokens
+        self.tokens_sigma = tokens_sigma
+        self.token_interval = token_interval
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self):
+        with self._lock:
+            latency = self.latency * self._random.lognormvariate(0, self.latency_sigma)
+            tokens = max(1, int(self.tokens * self._random.lognormvariate(0, self.tokens_sigma)))
+        return latency, tokens
+
+
+def _reply_words(tokens: int):
+    # One short word per token.
+    words = ["word"] * tokens
+    for i in range(11, tokens, 12):
+        words[i] = "end."
+    return [word + " " for word in words]
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        request = json.loads(body or b"{}")
+        latency, tokens = self.server.profile.sample()
+        self.server.count(request, tokens)
+        time.sleep(latency)
+        words = _reply_words(tokens)
+        if request.get("stream"):
+            self._stream(request, words)
+            return
+        data = json.dumps({
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", ""),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(words).strip()},
+                "finish_reason": "stop",
+            }],
+            "usage": {"completion_tokens": tokens},
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, request, words):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for word in words:
+            chunk = {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", ""),
+                "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}],
+            }
+            self.wfile.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+            self.wfile.flush()
+            if self.server.profile.token_interval:
+                time.sleep(self.server.profile.token_interval)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeOpenAI(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, profile: Profile = None, listen=("127.0.0.1", 0)) -> None:
+        super().__init__(listen, _Handler)
+        self.profile = profile or Profile()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.tokens = 0
+
+    def count(self, request, tokens: int):
+        with self._lock:
+            self.requests += 1
+            self.tokens += tokens
+
+    def start(self) -> str:
+        """Returns the api base url."""
+        threading.Thread(target=self.serve_forever, name="fake-openai", daemon=True).start()
+        host, port = self.server_address
+        return f"http://{host}:{port}/v1"
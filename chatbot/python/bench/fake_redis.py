@@ -0,0 +1,337 @@
+"""Minimal Redis server speaking RESP2 and RESP3, enough for the chatbot.
+
+Strings with expiry, hashes, sorted sets, keys/scan, pub/sub (PUBLISH
+only, no keyspace notifications) and the Lua scripts of db.py, which are
+run as their python equivalents.
+"""
+import fnmatch
+import hashlib
+import itertools
+import json
+import socketserver
+import threading
+import time
+
+import db
+
+
+class Store:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # {db: {key: value}}, value is bytes, dict or {member: score}.
+        self.data = {}
+        # {(db, key): expire at}
+        self.expires = {}
+        self.scripts = {}
+        self.commands = 0
+        # {channel or pattern: {handler}}
+        self.channels = {}
+        self.patterns = {}
+
+    def publish(self, channel: bytes, message: bytes) -> int:
+        receivers = 0
+        for handler in list(self.channels.get(channel, ())):
+            receivers += handler.push(_Push([b"message", channel, message]))
+        for pattern, handlers in self.patterns.items():
+            if fnmatch.fnmatchcase(channel, pattern):
+                for handler in list(handlers):
+                    receivers += handler.push(_Push([b"pmessage", pattern, channel, message]))
+        return receivers
+
+    def keyspace(self, index: int) -> dict:
+        return self.data.setdefault(index, {})
+
+    def alive(self, index: int, key: bytes) -> bool:
+        expire_at = self.expires.get((index, key))
+        if expire_at is not None and expire_at <= time.time():
+            self.keyspace(index).pop(key, None)
+            del self.expires[(index, key)]
+        return key in self.keyspace(index)
+
+    def ttl(self, index: int, key: bytes) -> int:
+        if not self.alive(index, key):
+            return -2
+        expire_at = self.expires.get((index, key))
+        return -1 if expire_at is None else max(0, int(round(expire_at - time.time())))
+
+    def set(self, index: int, key: bytes, value, ex=None):
+        self.keyspace(index)[key] = value
+        if ex is None:
+            self.expires.pop((index, key), None)
+        else:
+            self.expires[(index, key)] = time.time() + ex
+
+
+def _migrate_quota(store, index, key):
+    value = store.keyspace(index).get(key) if store.alive(index, key) else None
+    if isinstance(value, bytes):
+        ttl = store.ttl(index, key)
+        quota = json.loads(value)
+        store.set(index, key, {
+            b"times": str(quota.get("times", 0)).encode(),
+            b"tokens": str(quota.get("tokens", 0)).encode(),
+            b"type": str(quota.get("type", "free")).encode(),
+        }, ex=ttl if ttl > 0 else None)
+
+
+def _load_quota(store, index, keys, args):
+    _migrate_quota(store, index, keys[0])
+    if not store.alive(index, keys[0]):
+        store.set(index, keys[0], {b"times": args[0], b"tokens": args[1], b"type": args[2]},
+                  ex=int(args[3]))
+    quota = store.keyspace(index)[keys[0]]
+    return [quota[b"times"], quota[b"tokens"], quota[b"type"], store.ttl(index, keys[0]),
+            quota.get(b"weight")]
+
+
+def _debit_quota(store, index, keys, args):
+    _migrate_quota(store, index, keys[0])
+    if not store.alive(index, keys[0]):
+        return None
+    quota = store.keyspace(index)[keys[0]]
+    times, tokens = int(quota[b"times"]), int(quota[b"tokens"])
+    if quota[b"type"].lower() == b"vip":
+        return [times, tokens]
+    for used in args:
+        if tokens > 0:
+            tokens = max(0, tokens - int(used))
+        else:
+            times = max(0, times - 1)
+    quota[b"times"], quota[b"tokens"] = str(times).encode(), str(tokens).encode()
+    return [times, tokens]
+
+
+# Lua scripts of the chatbot and what they do.
+SCRIPTS = {
+    db._LOAD_QUOTA: _load_quota,
+    db._DEBIT_QUOTA: _debit_quota,
+}
+_SCRIPTS_BY_SHA = {
+    hashlib.sha1(script.encode("utf-8")).hexdigest(): func for script, func in SCRIPTS.items()
+}
+
+
+class Error(Exception):
+    pass
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.db = 0
+        self.subscribed = 0
+        self.resp3 = False
+        # Messages of PUBLISH are written from the publisher's thread.
+        self.write_lock = threading.Lock()
+
+    def finish(self):
+        store = self.server.store
+        with store.lock:
+            for handlers in itertools.chain(store.channels.values(), store.patterns.values()):
+                handlers.discard(self)
+        super().finish()
+
+    def push(self, message) -> bool:
+        try:
+            with self.write_lock:
+                self.wfile.write(encode(message, self.resp3))
+        except OSError:
+            return False
+        return True
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # Inline command.
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def reply(self, value):
+        with self.write_lock:
+            self.wfile.write(encode(value, self.resp3))
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            try:
+                args = self.read_command()
+            except (OSError, ValueError):
+                return
+            if args is None:
+                return
+            name = args[0].decode("ascii").upper()
+            try:
+                with store.lock:
+                    store.commands += 1
+                    value = self.execute(store, name, args[1:])
+            except Error as e:
+                value = e
+            except (IndexError, ValueError):
+                value = Error(f"ERR wrong arguments for '{name}'")
+            try:
+                self.reply(value)
+            except OSError:
+                return
+
+    def execute(self, store, name, args):
+        space = store.keyspace(self.db)
+        if name in ("PING",):
+            return b"PONG" if not args else args[0]
+        if name in ("AUTH", "CLIENT", "CONFIG", "READONLY"):
+            return "OK"
+        if name == "HELLO":
+            protocol = int(args[0]) if args else 2
+            self.resp3 = protocol == 3
+            return _Map({b"server": b"redis", b"version": b"7.0.0", b"proto": protocol})
+        if name == "SELECT":
+            self.db = int(args[0])
+            return "OK"
+        if name == "GET":
+            return space[args[0]] if store.alive(self.db, args[0]) else None
+        if name == "MGET":
+            return [space[key] if store.alive(self.db, key) else None for key in args]
+        if name == "SET":
+            ex = None
+            options = [arg.upper() for arg in args[2:]]
+            if b"NX" in options and store.alive(self.db, args[0]):
+                return None
+            if b"EX" in options:
+                ex = int(args[2 + options.index(b"EX") + 1])
+            elif b"KEEPTTL" in options:
+                ttl = store.ttl(self.db, args[0])
+                ex = ttl if ttl > 0 else None
+            store.set(self.db, args[0], args[1], ex)
+            return "OK"
+        if name == "SETEX":
+            store.set(self.db, args[0], args[2], int(args[1]))
+            return "OK"
+        if name == "DEL":
+            count = 0
+            for key in args:
+                if store.alive(self.db, key):
+                    del space[key]
+                    store.expires.pop((self.db, key), None)
+                    count += 1
+            return count
+        if name == "TTL":
+            return store.ttl(self.db, args[0])
+        if name == "EXPIRE":
+            if not store.alive(self.db, args[0]):
+                return 0
+            store.expires[(self.db, args[0])] = time.time() + int(args[1])
+            return 1
+        if name == "KEYS":
+            pattern = args[0].decode("utf-8")
+            return [key for key in list(space) if store.alive(self.db, key)
+                    and fnmatch.fnmatchcase(key.decode("utf-8"), pattern)]
+        if name == "SCAN":
+            pattern = "*"
+            if b"MATCH" in [arg.upper() for arg in args]:
+                pattern = args[[arg.upper() for arg in args].index(b"MATCH") + 1].decode("utf-8")
+            keys = [key for key in list(space) if store.alive(self.db, key)
+                    and fnmatch.fnmatchcase(key.decode("utf-8"), pattern)]
+            return [b"0", keys]
+        if name == "HGETALL":
+            value = space.get(args[0]) if store.alive(self.db, args[0]) else None
+            return _Map(value or {})
+        if name == "HINCRBY":
+            value = space.setdefault(args[0], {})
+            value[args[1]] = str(int(value.get(args[1], b"0")) + int(args[2])).encode()
+            return int(value[args[1]])
+        if name == "ZADD":
+            value = space.setdefault(args[0], {})
+            added = 0
+            for i in range(1, len(args), 2):
+                added += args[i + 1] not in value
+                value[args[i + 1]] = float(args[i])
+            return added
+        if name == "ZCARD":
+            return len(space.get(args[0], {}))
+        if name == "ZPOPMIN":
+            value = space.get(args[0], {})
+            count = int(args[1]) if len(args) > 1 else 1
+            result = []
+            for member, score in sorted(value.items(), key=lambda item: item[1])[:count]:
+                del value[member]
+                result.extend([member, repr(score).encode()])
+            return result
+        if name in ("SUBSCRIBE", "PSUBSCRIBE"):
+            kind = name.lower().encode()
+            subscriptions = store.channels if name == "SUBSCRIBE" else store.patterns
+            for channel in args:
+                subscriptions.setdefault(channel, set()).add(self)
+                self.subscribed += 1
+                self.reply(_Push([kind, channel, self.subscribed]))
+            return _NO_REPLY
+        if name == "PUBLISH":
+            return store.publish(args[0], args[1])
+        if name == "SCRIPT":
+            if args[0].upper() == b"LOAD":
+                sha = hashlib.sha1(args[1]).hexdigest()
+                store.scripts[sha] = args[1]
+                return sha.encode()
+            return "OK"
+        if name in ("EVAL", "EVALSHA"):
+            if name == "EVAL":
+                func = SCRIPTS.get(args[0].decode("utf-8"))
+            else:
+                func = _SCRIPTS_BY_SHA.get(args[0].decode("ascii"))
+            if func is None:
+                raise Error("NOSCRIPT No matching script.")
+            count = int(args[1])
+            return func(store, self.db, args[2: 2 + count], args[2 + count:])
+        raise Error(f"ERR unknown command '{name}'")
+
+
+_NO_REPLY = object()
+
+
+class _Map(dict):
+    pass
+
+
+class _Push(list):
+    pass
+
+
+def encode(value, resp3: bool = False) -> bytes:
+    if value is _NO_REPLY:
+        return b""
+    if value is None:
+        return b"_\r\n" if resp3 else b"$-1\r\n"
+    if isinstance(value, Error):
+        return f"-{value}\r\n".encode("utf-8")
+    if isinstance(value, str):
+        return f"+{value}\r\n".encode("utf-8")
+    if isinstance(value, bool) or isinstance(value, int):
+        return f":{int(value)}\r\n".encode("ascii")
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, _Map):
+        if not resp3:
+            return encode([item for pair in value.items() for item in pair])
+        return b"%%%d\r\n" % len(value) + b"".join(
+            encode(key, resp3) + encode(val, resp3) for key, val in value.items())
+    if isinstance(value, (list, tuple)):
+        kind = b">" if resp3 and isinstance(value, _Push) else b"*"
+        return kind + b"%d\r\n" % len(value) + b"".join(encode(item, resp3) for item in value)
+    raise TypeError(f"cannot encode {type(value)}")
+
+
+class FakeRedis(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, listen=("127.0.0.1", 0)) -> None:
+        super().__init__(listen, Handler)
+        self.store = Store()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-redis", daemon=True).start()
+        return self.server_address[1]
@@ -0,0 +1,350 @@
+"""End-to-end benchmark of the chatbot against local stand-ins.
+
+Starts a fake Tinode Node service, a fake Redis and a fake OpenAI endpoint
+in this process, runs the bot (main.py) against them in a child process
+and has simulated users send it messages at a target rate. Prints the
+results as JSON and appends them to --output with the git commit, so runs
+of different commits can be compared:
+    python bench/run_bench.py --users 50 --rate 20 --duration 60
+"""
+import argparse
+import json
+import math
+import os
+import pathlib
+import platform
+import random
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = pathlib.Path(__file__).resolve().parent
+CHATBOT_DIR = BENCH_DIR.parent
+sys.path.insert(0, str(CHATBOT_DIR))
+sys.path.insert(0, str(BENCH_DIR))
+
+import common  # noqa: E402
+import db  # noqa: E402
+import fake_node  # noqa: E402
+import fake_openai  # noqa: E402
+import fake_redis  # noqa: E402
+
+BOT_NAME = "bench"
+BOT_DEFINITION = {
+    "name": BOT_NAME,
+    "preset": [{"role": "system", "content": "You are a friendly assistant."}],
+    "story": "bench",
+    "user_prefix": "",
+    "robot_prefix": "",
+    "memory": True,
+}
+TEXTS = [
+    "你好，今天过得怎么样？",
+    "Tell me a short story about a cat.",
+    "What should I cook for dinner tonight?",
+    "请把这句话翻译成英文：天气很好。",
+    "Why is the sky blue?",
+]
+ERROR_TEXTS = {json.dumps(text) for text in common.COMMON_MSG.values()}
+
+
+def percentile(values, pct: float):
+    if not values:
+        return None
+    # Nearest rank.
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=CHATBOT_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=CHATBOT_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+
+def _tree_rss(pid: int):
+    """Returns the RSS in bytes of pid and its descendants, None without /proc."""
+    proc = pathlib.Path("/proc")
+    if not proc.is_dir():
+        return None
+    children = {}
+    rss = {}
+    for stat_path in proc.glob("[0-9]*/stat"):
+        try:
+            fields = stat_path.read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        child = int(stat_path.parent.name)
+        children.setdefault(int(fields[1]), []).append(child)
+        rss[child] = int(fields[21]) * resource.getpagesize()
+    total = 0
+    todo = [pid]
+    while todo:
+        current = todo.pop()
+        total += rss.get(current, 0)
+        todo.extend(children.get(current, []))
+    return total
+
+
+class Load:
+    """Users send a message, wait for the reply and send the next one when
+    the scheduler picks them. The scheduler sends at `rate` messages per
+    second to the idle users in turn."""
+
+    def __init__(self, node, users: int, rate: float, seed: int) -> None:
+        self.node = node
+        self.rate = rate
+        self.topics = [f"usrBenchUser{i:05d}" for i in range(users)]
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # {topic: sent at}
+        self.waiting = {}
+        self.latencies = []
+        self.sent = 0
+        self.skipped = 0
+        self.errors = 0
+        self.chunks = 0
+
+    def on_pub(self, topic, content, received_at):
+        with self._lock:
+            self.chunks += 1
+            sent_at = self.waiting.pop(topic, None)
+            if sent_at is None:
+                # A later chunk of a streamed reply.
+                return
+            self.latencies.append(received_at - sent_at)
+            if content.decode("utf-8") in ERROR_TEXTS:
+                self.errors += 1
+
+    def run(self, duration: float):
+        start = time.perf_counter()
+        next_user = 0
+        sent = 0
+        while True:
+            now = time.perf_counter()
+            if now - start >= duration:
+                return
+            due = start + sent / self.rate
+            if due > now:
+                time.sleep(due - now)
+            sent += 1
+            with self._lock:
+                for _ in range(len(self.topics)):
+                    topic = self.topics[next_user]
+                    next_user = (next_user + 1) % len(self.topics)
+                    if topic not in self.waiting:
+                        break
+                else:
+                    # Every user waits for a reply.
+                    self.skipped += 1
+                    continue
+                self.waiting[topic] = time.perf_counter()
+                self.sent += 1
+            text = self._random.choice(TEXTS)
+            self.node.send_data(topic, topic, text)
+
+    def drain(self, timeout: float):
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            with self._lock:
+                if not self.waiting:
+                    return
+            time.sleep(0.05)
+
+
+def run(args) -> dict:
+    commit = git_commit()
+
+    redis_server = fake_redis.FakeRedis()
+    redis_port = redis_server.start()
+    db.configure(host="127.0.0.1", port=redis_port, password=None)
+    definition = dict(BOT_DEFINITION, memory=not args.no_memory, stream=args.stream)
+    db.get_redis(db.BOT_DB).set(BOT_NAME, json.dumps(definition))
+
+    profile = fake_openai.Profile(
+        latency=args.llm_latency,
+        tokens=args.llm_tokens,
+        token_interval=args.llm_token_interval,
+        seed=args.seed,
+    )
+    llm = fake_openai.FakeOpenAI(profile)
+    api_base = llm.start()
+
+    node = fake_node.FakeNode()
+    load = Load(node, args.users, args.rate, args.seed)
+    node.on_pub = load.on_pub
+    node_server, node_port = fake_node.serve(node)
+
+    workdir = tempfile.TemporaryDirectory(prefix="chatbot-bench-")
+    root = pathlib.Path(workdir.name)
+    (root / "openai.key").write_text("sk-bench")
+    (root / "photos").mkdir()
+    forks_file = root / "forks.json"
+    env = dict(
+        os.environ,
+        CHATBOT_REDIS_HOST="127.0.0.1",
+        CHATBOT_REDIS_PORT=str(redis_port),
+        CHATBOT_REDIS_PASSWORD="",
+        OPENAI_API_BASE=api_base,
+        OPENAI_BASE_URL=api_base,
+        CHATBOT_LOG_LEVEL=args.log_level,
+        BENCH_FORKS_FILE=str(forks_file),
+    )
+    command = [
+        sys.executable,
+        str(BENCH_DIR / "bot_launcher.py"),
+        "--host", f"127.0.0.1:{node_port}",
+        "--login-basic", f"{BOT_NAME}:bench",
+        "--photos_root", "photos",
+        "--workers", str(args.workers),
+        "--metrics-listen", "",
+    ]
+    if args.aio:
+        command.append("--aio")
+
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    bot = subprocess.Popen(command, cwd=root, env=env)
+    peak_rss = None
+    stop_sampling = threading.Event()
+
+    def sample_rss():
+        nonlocal peak_rss
+        while not stop_sampling.wait(0.5):
+            rss = _tree_rss(bot.pid)
+            if rss is not None:
+                peak_rss = max(peak_rss or 0, rss)
+
+    threading.Thread(target=sample_rss, daemon=True).start()
+    try:
+        if not node.logged_in.wait(args.startup_timeout):
+            raise RuntimeError("the bot did not log in")
+        started = time.perf_counter()
+        load.run(args.duration)
+        load.drain(args.drain_timeout)
+        elapsed = time.perf_counter() - started
+    finally:
+        stop_sampling.set()
+        bot.send_signal(signal.SIGTERM)
+        try:
+            bot.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+            bot.wait()
+        node.close()
+        node_server.stop(0)
+        llm.shutdown()
+        redis_server.shutdown()
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    try:
+        forks = json.loads(forks_file.read_text())["forks"]
+    except (OSError, ValueError):
+        forks = None
+    workdir.cleanup()
+
+    replies = len(load.latencies)
+    cpu = (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 1)
+
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "config": {
+            "users": args.users,
+            "rate": args.rate,
+            "duration": args.duration,
+            "workers": args.workers,
+            "aio": args.aio,
+            "stream": args.stream,
+            "memory": not args.no_memory,
+            "llm_latency": args.llm_latency,
+            "llm_tokens": args.llm_tokens,
+            "seed": args.seed,
+        },
+        "sent": load.sent,
+        "skipped": load.skipped,
+        "replies": replies,
+        "errors": load.errors,
+        "unanswered": len(load.waiting),
+        "msgs_per_sec": round(replies / elapsed, 2) if elapsed else 0,
+        "latency_ms": {
+            "p50": ms(percentile(load.latencies, 50)),
+            "p95": ms(percentile(load.latencies, 95)),
+            "p99": ms(percentile(load.latencies, 99)),
+            "max": ms(max(load.latencies, default=None)),
+        },
+        "cpu_seconds": round(cpu, 2),
+        "cpu_percent": round(100 * cpu / elapsed, 1) if elapsed else 0,
+        # ru_maxrss is in KiB on Linux.
+        "max_process_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        "peak_tree_rss_mb": None if peak_rss is None else round(peak_rss / 2**20, 1),
+        "forks": forks,
+        "sessions": node.sessions,
+        "llm_requests": llm.requests,
+        "redis_commands": redis_server.store.commands,
+    }
+
+
+def invalid_reason(result: dict):
+    """Returns why the numbers of the run don't measure the bot answering,
+    None if they do."""
+    if result["replies"] == 0:
+        return "the bot sent no reply"
+    if result["llm_requests"] == 0:
+        return "the bot never called the LLM, see the worker logs (it needs openai<1)"
+    if result["errors"] * 2 > result["replies"]:
+        return f"{result['errors']} of {result['replies']} replies are errors, see the worker logs"
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chatbot against local stand-ins.")
+    parser.add_argument("--users", default=20, type=int, help="number of simulated users")
+    parser.add_argument("--rate", default=10, type=float, help="messages per second sent")
+    parser.add_argument("--duration", default=30, type=float, help="seconds of load")
+    parser.add_argument("--workers", default=4, type=int)
+    parser.add_argument("--aio", action="store_true", help="run the asyncio engine")
+    parser.add_argument("--stream", action="store_true", help="stream the replies")
+    parser.add_argument("--no-memory", action="store_true", help="answer each message alone")
+    parser.add_argument("--llm-latency", default=0.5, type=float, help="median LLM latency in seconds")
+    parser.add_argument("--llm-tokens", default=60, type=int, help="median reply tokens")
+    parser.add_argument("--llm-token-interval", default=0.0, type=float,
+                        help="seconds between streamed tokens")
+    parser.add_argument("--seed", default=1, type=int)
+    parser.add_argument("--log-level", default="INFO", help="log level of the bot")
+    parser.add_argument("--startup-timeout", default=30, type=float)
+    parser.add_argument("--drain-timeout", default=30, type=float,
+                        help="seconds to wait for the last replies")
+    parser.add_argument("--output", default=str(BENCH_DIR / "results.jsonl"),
+                        help="file the results are appended to")
+    args = parser.parse_args()
+
+    result = run(args)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    reason = invalid_reason(result)
+    if reason is not None:
+        # Not recorded, the numbers are those of the error path.
+        sys.exit(f"Invalid run: {reason}")
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
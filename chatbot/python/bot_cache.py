@@ -0,0 +1,120 @@
+"""Process wide cache of parsed bot definitions.
+
+Bot definitions live in redis and rarely change. They are parsed once per
+process and dropped when redis reports a change, either by a keyspace
+notification on the bot database (needs notify-keyspace-events to include
+"K$" on the server) or by a message on db.BOTS_CHANNEL. The entries
+also expire after a TTL in case a notification is lost.
+"""
+import copy
+import json
+import logging
+import os
+import threading
+import time
+
+import db
+
+
+class BotCache:
+    def __init__(self, ttl: float = 600) -> None:
+        self.ttl = ttl
+        # {bot_name: (definition, loaded_at)}
+        self._entries = {}
+        self._lock = threading.Lock()
+        # Counts the invalidations, a definition read before one is stale.
+        self._generation = 0
+        self._listener_pid = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, bot_name: str):
+        """Returns a private copy of the bot definition, or None."""
+        self._ensure_listener()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(bot_name)
+            if entry is not None and now - entry[1] < self.ttl:
+                self.hits += 1
+                # Persona edits its preset, never hand out the cached one.
+                return copy.deepcopy(entry[0])
+            self.misses += 1
+            generation = self._generation
+
+        bot_data = db.get_bot_data(bot_name)
+        if bot_data == None:
+            return None
+        definition = json.loads(bot_data)
+        if "memory" not in definition:
+            # 默认记忆开启
+            definition["memory"] = True
+        with self._lock:
+            if generation == self._generation:
+                self._entries[bot_name] = (definition, now)
+        return copy.deepcopy(definition)
+
+    def invalidate(self, bot_name: str = "*"):
+        with self._lock:
+            if bot_name == "*":
+                self._entries.clear()
+            else:
+                self._entries.pop(bot_name, None)
+            self._generation += 1
+            self.invalidations += 1
+        logging.info("Bot definition cache invalidated: %s", bot_name)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+    def _ensure_listener(self):
+        # The listener thread does not survive a fork, start one per process.
+        if self._listener_pid == os.getpid():
+            return
+        self._listener_pid = os.getpid()
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    def _listen(self):
+        keyspace = f"__keyspace@{db.BOT_DB}__:"
+        while True:
+            try:
+                pubsub = db.get_redis(db.BOT_DB).pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(db.BOTS_CHANNEL)
+                pubsub.psubscribe(keyspace + "*")
+                while True:
+                    # Polls, listen() would time out with the pool's
+                    # socket_timeout when no bot changes for a while.
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    channel = message["channel"].decode("utf-8")
+                    if channel == db.BOTS_CHANNEL:
+                        self.invalidate(message["data"].decode("utf-8"))
+                    elif channel.startswith(keyspace):
+                        self.invalidate(channel[len(keyspace):])
+            except Exception as e:
+                logging.error("Bot definition listener failed: %s", e)
+            # Updates may have been missed while disconnected.
+            self.invalidate()
+            time.sleep(5)
+
+
+_cache = BotCache()
+
+
+def get_bot_definition(bot_name: str):
+    return _cache.get(bot_name)
+
+
+def invalidate(bot_name: str = "*"):
+    _cache.invalidate(bot_name)
+
+
+def cache_stats() -> dict:
+    return _cache.stats()
@@ -0,0 +1,49 @@
+import json
+import os
+import unittest
+import bot_cache
+import db
+
+
+class TestBotCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = bot_cache.BotCache()
+        # No redis here, the listener is not started.
+        self.cache._listener_pid = os.getpid()
+        self.reads = []
+        self.get_bot_data = db.get_bot_data
+        db.get_bot_data = self.read
+
+    def tearDown(self):
+        db.get_bot_data = self.get_bot_data
+
+    def read(self, bot_name):
+        self.reads.append(bot_name)
+        return json.dumps({"name": bot_name, "preset": ["hi"]}).encode("utf-8")
+
+    def test_cached_copy(self):
+        definition = self.cache.get("bot")
+        self.assertTrue(definition["memory"])
+        definition["preset"].append("edited")
+        self.assertEqual(self.cache.get("bot")["preset"], ["hi"])
+        self.assertEqual(self.reads, ["bot"])
+        self.cache.invalidate("bot")
+        self.cache.get("bot")
+        self.assertEqual(self.reads, ["bot", "bot"])
+
+    def test_invalidated_while_reading(self):
+        def read_then_change(bot_name):
+            data = self.read(bot_name)
+            # The definition changes before the read one is stored.
+            self.cache.invalidate(bot_name)
+            return data
+
+        db.get_bot_data = read_then_change
+        self.cache.get("bot")
+        db.get_bot_data = self.read
+        self.cache.get("bot")
+        self.assertEqual(self.reads, ["bot", "bot"])
+
+
+if __name__ == "__main__":
+    unittest.main()
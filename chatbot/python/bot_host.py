@@ -0,0 +1,251 @@
+"""Hosts many bots in one process.
+
+Each bot keeps its own authenticated MessageLoop stream, driven by one
+event loop. The worker pool, the LLM admission controller, the Redis
+pools and the caches of the workers are shared by the bots. A bot has at
+most bot_limit messages on the workers and bot_limit LLM calls in
+progress, so a busy bot does not starve the others.
+"""
+import asyncio
+import logging
+import pathlib
+import signal
+import threading
+from concurrent import futures
+
+import grpc
+
+import metrics
+import model_pb2_grpc as pbx
+import timer_wheel
+from admission import AdmissionController
+from aio_chatbot import AsyncChatBot
+from chatbot import Plugin
+from msg_proc import error_msg
+from worker_pool import JOB_DONE, WARM_UP, OutQueue, WorkerPool
+
+
+class HostedBot(AsyncChatBot):
+    """A bot of a BotHost, its jobs are tagged with its name."""
+
+    def __init__(
+        self,
+        name,
+        passwd,
+        photos_root,
+        pool: WorkerPool,
+        plugin_listen: str = "",
+        coalesce_window: float = 0.0,
+    ) -> None:
+        super().__init__(name, passwd, photos_root, pool=pool, plugin_listen=plugin_listen)
+        # The workers read it from the jobs of the bot.
+        self.coalesce_window = coalesce_window
+        self.task = None
+
+    def init_client(self, addr, schema, secret, cookie_file_name=None, secure=False, ssl_host=""):
+        # The bots of a host must not share the cookie file.
+        return super().init_client(
+            addr, schema, secret, f".tn-cookie-{self.name}", secure, ssl_host
+        )
+
+    def login_failed(self, errcode):
+        # Stops this bot only, the others of the host keep running.
+        if errcode.get("code") == 409:
+            logging.info("%s already authenticated", self.name)
+            return
+        if errcode.get("code") == timer_wheel.TIMEOUT_CODE:
+            super().login_failed(errcode)
+            return
+        logging.error("Login of %s failed: %s", self.name, errcode.get("text"))
+        if self.task is not None:
+            self.task.cancel()
+
+    def subscription_failed(self, topic, errcode):
+        if topic == "me" and errcode.get("code") not in (502, timer_wheel.TIMEOUT_CODE):
+            logging.error("%s failed to subscribe to 'me': %s", self.name, errcode.get("text"))
+            if self.task is not None:
+                self.task.cancel()
+            return
+        super().subscription_failed(topic, errcode)
+
+    def submit(self, topic, job) -> bool:
+        job = job + ((self.name, str(self.photos_root), self.coalesce_window),)
+        return self.pool.submit(topic, job, tag=self.name)
+
+
+class BotHost:
+    """Runs the bots added with add_bot over one shared worker pool."""
+
+    def __init__(
+        self,
+        host_addr: str,
+        workers: int = 4,
+        worker_queue_size: int = 64,
+        coalesce_window: float = 0.0,
+        bot_limit: int = 8,
+        llm_concurrency: int = 8,
+        llm_rpm: float = 3500,
+        llm_tpm: float = 90000,
+        metrics_listen: str = "",
+        name: str = "host",
+        plugin_listen: str = "",
+        plugin_workers: int = 16,
+        firehose: bool = False,
+        warm_up_bots=(),
+    ) -> None:
+        self.host_addr = host_addr
+        self.name = name
+        self.metrics_listen = metrics_listen
+        self.metrics_server = None
+        # One Plugin API server pushes the messages of all the bots.
+        self.plugin_listen = plugin_listen
+        self.plugin_workers = plugin_workers
+        self.plugin_server = None
+        # The Plugin server takes the {pub} of the users from FireHose.
+        self.firehose = firehose
+        # Names of the bots attaching to the topics of new users.
+        self.warm_up_bots = warm_up_bots
+        self.queue_out = OutQueue()
+        self.admission = AdmissionController(
+            llm_concurrency, llm_rpm, llm_tpm, group_limit=bot_limit
+        )
+        self.pool = WorkerPool(
+            self.queue_out,
+            name,
+            None,
+            workers=workers,
+            queue_size=worker_queue_size,
+            coalesce_window=coalesce_window,
+            admission=self.admission,
+            metrics_folder=pathlib.Path("cache/metrics") / name,
+            tag_limit=bot_limit,
+        )
+        # {bot name: HostedBot}
+        self.bots = {}
+        self.loop = None
+
+    def add_bot(self, name, passwd, photos_root, coalesce_window=None) -> HostedBot:
+        """Adds a bot, coalescing the messages of its topics for
+        coalesce_window seconds, the window of the host if None."""
+        if coalesce_window is None:
+            coalesce_window = self.pool.coalesce_window
+        bot = HostedBot(
+            name,
+            passwd,
+            pathlib.Path(photos_root),
+            self.pool,
+            self.plugin_listen,
+            coalesce_window=coalesce_window,
+        )
+        self.bots[name] = bot
+        return bot
+
+    def pump_worker_replies(self):
+        # Routes the replies of the workers to the stream of their bot.
+        while True:
+            queued_at, tag, msg = self.queue_out.get_tagged()
+            if msg == None:
+                continue
+            bot = self.bots.get(tag)
+            if bot is None:
+                logging.warning("Reply of unknown bot %s dropped", tag)
+                continue
+            if isinstance(msg, tuple) and msg[0] == JOB_DONE:
+                _, index, count = msg
+                for job in self.pool.done(tag, index, count):
+                    if job[0] == WARM_UP:
+                        continue
+                    bot.client_post(error_msg("SERVER_BUSY", job[1], job[0].data.topic))
+                continue
+            try:
+                self.loop.call_soon_threadsafe(bot.aio_queue_out.put_nowait, (queued_at, msg))
+            except RuntimeError:
+                # Event loop is closed, the host is shutting down.
+                return
+
+    async def expire_futures(self):
+        # Fails the requests of the bots left without a response.
+        while True:
+            await asyncio.sleep(timer_wheel.TICK)
+            for bot in self.bots.values():
+                bot.onCompletion.expire()
+
+    def start_metrics(self):
+        metrics.clear_snapshots(self.pool.metrics_folder)
+        metrics.gauge(
+            "out_queue_depth",
+            lambda: self.queue_out.qsize()
+            + sum(bot.aio_queue_out.qsize() for bot in self.bots.values()),
+        )
+        metrics.gauge(
+            "subscriptions_attached",
+            lambda: sum(len(bot.subscriptions) for bot in self.bots.values()),
+        )
+        metrics.gauge("admission_in_flight", lambda: self.admission.stats()["in_flight"])
+        metrics.gauge(
+            "admission_waiting",
+            lambda: self.admission.stats()["waiting_vip"] + self.admission.stats()["waiting_free"],
+        )
+        if self.metrics_listen:
+            try:
+                self.metrics_server = metrics.serve(
+                    self.metrics_listen, self.pool.metrics_folder, status=self.status
+                )
+            except OSError as e:
+                logging.error("Failed to serve metrics at %s: %s", self.metrics_listen, e)
+
+    def status(self) -> dict:
+        """Returns {bot name: status} of the bots, served at /status."""
+        return {name: bot.status() for name, bot in self.bots.items()}
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        self.loop = asyncio.get_running_loop()
+        for bot in self.bots.values():
+            bot.loop = self.loop
+            bot.loop_thread_id = threading.get_ident()
+            bot.aio_queue_out = asyncio.Queue()
+
+        # Start the workers before any grpc channel is created,
+        # grpc does not survive a fork.
+        self.start_metrics()
+        self.pool.start()
+        threading.Thread(target=self.pump_worker_replies, daemon=True).start()
+        if self.plugin_listen:
+            self.plugin_server = grpc.server(futures.ThreadPoolExecutor(max_workers=self.plugin_workers))
+            plugin = Plugin(
+                list(self.bots.values()),
+                firehose=self.firehose,
+                warm_up_bots=[self.bots[name] for name in self.warm_up_bots if name in self.bots],
+            )
+            pbx.add_PluginServicer_to_server(plugin, self.plugin_server)
+            self.plugin_server.add_insecure_port(self.plugin_listen)
+            self.plugin_server.start()
+            logging.info("Plugin server running at '%s'", self.plugin_listen)
+
+        main_task = asyncio.current_task()
+
+        def exit_gracefully(signo):
+            logging.info("Terminated with signal %s ", signo)
+            main_task.cancel()
+
+        self.loop.add_signal_handler(signal.SIGINT, exit_gracefully, signal.SIGINT)
+        self.loop.add_signal_handler(signal.SIGTERM, exit_gracefully, signal.SIGTERM)
+
+        expiry = self.loop.create_task(self.expire_futures())
+        for bot in self.bots.values():
+            bot.task = self.loop.create_task(bot.connect_loop(self.host_addr))
+        logging.info("Hosting %d bots: %s", len(self.bots), ", ".join(self.bots))
+        try:
+            await asyncio.gather(*(bot.task for bot in self.bots.values()), return_exceptions=True)
+        except asyncio.CancelledError:
+            for bot in self.bots.values():
+                bot.task.cancel()
+            await asyncio.gather(*(bot.task for bot in self.bots.values()), return_exceptions=True)
+        finally:
+            expiry.cancel()
+            if self.plugin_server is not None:
+                self.plugin_server.stop(0)
+            self.pool.stop()
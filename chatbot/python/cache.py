@@ -0,0 +1,136 @@
+"""Bounded in-memory and on-disk caches."""
+import collections
+import logging
+import os
+import pathlib
+import threading
+import time
+
+
+class LRUCache:
+    """Keeps the max_entries most recently used values. Values older than
+    ttl seconds are dropped, a ttl of 0 keeps them until evicted."""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 0) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # {key: (value, stored_at)}
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[0] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class DiskCache:
+    """Stores bytes in files named by their key, which must be safe as a
+    file name (e.g. a hex digest). Files are written atomically, so several
+    processes can share the folder. When the folder holds more than
+    max_entries files the least recently written ones are removed."""
+
+    def __init__(self, folder, max_entries: int = 10000, ttl: float = 0) -> None:
+        self.folder = pathlib.Path(folder)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> pathlib.Path:
+        # Two levels keep the folders small.
+        return self.folder / key[:2] / key
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            if self.ttl and time.time() - path.stat().st_mtime > self.ttl:
+                path.unlink(missing_ok=True)
+                raise FileNotFoundError(path)
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{key}.{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error("Failed to write cache file %s: %s", path, e)
+            return
+        self._puts += 1
+        # Checking the size walks the folder, do it once in a while.
+        if self._puts % 100 == 0:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.folder.glob("*/*"):
+            if path.name.endswith(".tmp"):
+                continue
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except OSError:
+                # Removed by another process.
+                pass
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for _, path in entries[: len(entries) - self.max_entries]:
+            path.unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,39 @@
+import tempfile
+import time
+import unittest
+import cache
+
+
+class TestCache(unittest.TestCase):
+    def test_lru(self):
+        lru = cache.LRUCache(max_entries=2)
+        lru.put("a", 1)
+        lru.put("b", 2)
+        self.assertEqual(lru.get("a"), 1)
+        lru.put("c", 3)
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual((lru.get("a"), lru.get("c")), (1, 3))
+        self.assertEqual(lru.stats()["hits"], 3)
+        self.assertEqual(lru.stats()["misses"], 1)
+
+    def test_lru_ttl(self):
+        lru = cache.LRUCache(ttl=0.01)
+        lru.put("a", 1)
+        time.sleep(0.02)
+        self.assertIsNone(lru.get("a"))
+
+    def test_disk(self):
+        with tempfile.TemporaryDirectory() as folder:
+            disk = cache.DiskCache(folder, max_entries=2)
+            self.assertIsNone(disk.get("abcd"))
+            for key in ("abcd", "bcde", "cdef"):
+                disk.put(key, key.encode())
+                time.sleep(0.01)
+            self.assertEqual(disk.get("bcde"), b"bcde")
+            disk.evict()
+            self.assertIsNone(disk.get("abcd"))
+            self.assertEqual(disk.get("cdef"), b"cdef")
+
+
+if __name__ == '__main__':
+    unittest.main()
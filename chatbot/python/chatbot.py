@@ -4,6 +4,7 @@
 from __future__ import print_function
 
 import argparse
+import collections
 import traceback
 import pathlib
 import base64
@@ -12,42 +13,147 @@ from datetime import datetime
 import json
 import logging
 import platform
+import random
 import signal
 import sys
+import threading
 import time
 import utils
 import common
+import db
+import metrics
+import state_store
+import subscriptions
+import timer_wheel
 
 import grpc
 
 # Import generated grpc modules
 import model_pb2 as pb
 import model_pb2_grpc as pbx
-from msg_proc import process_chat
+from msg_proc import error_msg
+from worker_pool import WorkerPool, OutQueue, WARM_UP
+from admission import AdmissionController
 import multiprocessing
 import queue
 
+# Seconds before reconnecting after the first disconnect, doubled after each
+# failed attempt up to RECONNECT_MAX_DELAY.
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+# Subscriptions waiting for their {ctrl} at most while resubscribing.
+RESUBSCRIBE_WINDOW = 64
+# Messages of a topic fetched at once to catch up after a reconnect.
+CATCH_UP_LIMIT = 20
+
+
+def catch_up_query(since_id: int, before_id: int = 0):
+    """The get_query fetching the messages from since_id on, before
+    before_id if given. The server sends the newest CATCH_UP_LIMIT first."""
+    return pb.GetQuery(
+        what="data",
+        data=pb.GetOpts(since_id=since_id, before_id=before_id, limit=CATCH_UP_LIMIT),
+    )
+
+
+def reconnect_delay(attempt: int) -> float:
+    """Seconds to wait before reconnect attempt (from 0). Jittered, so the
+    bots do not all come back at once after a server restart."""
+    return random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_DELAY * 2 ** attempt))
+
 
 class ChatBot:
-    def __init__(self, name: str, passwd:str, photos_root: pathlib.Path) -> None:
+    def __init__(
+        self,
+        name: str,
+        passwd: str,
+        photos_root: pathlib.Path,
+        workers: int = 4,
+        worker_queue_size: int = 64,
+        coalesce_window: float = 0.0,
+        llm_concurrency: int = 8,
+        llm_rpm: float = 3500,
+        llm_tpm: float = 90000,
+        metrics_listen: str = "",
+        pool: WorkerPool = None,
+        max_topics: int = subscriptions.MAX_TOPICS,
+        plugin_listen: str = "",
+        plugin_workers: int = 16,
+        firehose: bool = False,
+        warm_up: bool = True,
+    ) -> None:
         # User ID of the current user
         self.botUID = None
-        # Dictionary wich contains lambdas to be executed when server response is received
-        self.onCompletion = {}
+        # Lambdas to be executed when server response is received, by tid.
+        # Requests without a response in time fail with a 504.
+        self.onCompletion = timer_wheel.PendingRequests()
+        # Held while handling a server message or a timeout.
+        self.lock = threading.RLock()
         self.name = name
         self.passwd = passwd
         self.photos_root = photos_root
 
-        # List of active subscriptions
-        self.subscriptions = {}
+        # Topics attached, the least recently active ones are left.
+        self.subscriptions = subscriptions.Subscriptions(max_topics)
+        # {topic: seq_id of the last message received}, to fetch the
+        # messages sent while the bot was disconnected.
+        self.last_seq = {}
+        # {topic: first seq_id fetched}, older messages were answered.
+        self.catch_up_since = {}
+        # {topic: {"msgs": {seq_id: msg}, "page": messages of the last
+        # page}}, the messages of the topics catching up, answered in
+        # seq_id order once all are fetched.
+        self.catching_up = {}
+        # Topics to resubscribe after login, and subscriptions not answered yet.
+        self.resubscribe_pending = collections.deque()
+        self.resubscribe_in_flight = 0
+        self.reconnect_attempts = 0
         # Keep grpc channel from being collected.
         self.channel = None
         self.client = None
 
         self.retry_time = 0
 
-        # Message Queue
-        self.queue_out = multiprocessing.Queue()
+        # "host:port" serving the Plugin API, empty for none. The server
+        # then pushes the messages to the bot with Plugin.Message, the
+        # {data} of the MessageLoop are ignored.
+        self.plugin_listen = plugin_listen
+        self.plugin_workers = plugin_workers
+        self.plugin_server = None
+        # Take the {pub} of the users from Plugin.FireHose instead, before
+        # the server stores them.
+        self.firehose = firehose
+        # Attach to the topics of new users when the Plugin server tells
+        # of their accounts.
+        self.warm_up_new_users = warm_up
+
+        # "host:port" serving /metrics, empty for none.
+        self.metrics_listen = metrics_listen
+        self.metrics_server = None
+        if pool is not None:
+            # The workers of a BotHost, shared with other bots.
+            self.pool = pool
+            self.queue_out = pool.queue_out
+            self.admission = pool.admission
+            self.metrics_folder = pool.metrics_folder
+        else:
+            # Message Queue. It's shared with the workers so it lives as long as the bot.
+            self.queue_out = OutQueue()
+            # Metrics of the workers are added up from their snapshots.
+            self.metrics_folder = pathlib.Path("cache/metrics") / name
+            # Limits the LLM calls of all workers.
+            self.admission = AdmissionController(llm_concurrency, llm_rpm, llm_tpm)
+            # Workers processing the {data} messages.
+            self.pool = WorkerPool(
+                self.queue_out,
+                name,
+                photos_root,
+                workers=workers,
+                queue_size=worker_queue_size,
+                coalesce_window=coalesce_window,
+                admission=self.admission,
+                metrics_folder=self.metrics_folder,
+            )
 
         self.tid = 100
 
@@ -55,15 +161,14 @@ class ChatBot:
         self.tid += 1
         return str(self.tid)
 
-    def add_future(self, tid, bundle):
+    def add_future(self, tid, bundle, timeout=None):
         # Add bundle for future execution
-        self.onCompletion[tid] = bundle
+        self.onCompletion.add(tid, bundle, timeout)
 
     # Resolve or reject the future
     def exec_future(self, tid, code, text, params):
-        bundle = self.onCompletion.get(tid)
+        bundle = self.onCompletion.pop(tid)
         if bundle != None:
-            del self.onCompletion[tid]
             try:
                 if code >= 200 and code < 400:
                     arg = bundle.get("arg")
@@ -77,32 +182,98 @@ class ChatBot:
                 logging.error("Error handling server response", err)
 
     def add_subscription(self, topic):
-        self.subscriptions[topic] = True
+        self.subscriptions.touch(topic)
+
+    def subscribed(self, tid, topic):
+        self.add_subscription(topic)
+        self.await_catch_up(tid, topic)
 
     def del_subscription(self, topic):
-        self.subscriptions.pop(topic, None)
+        self.subscriptions.remove(topic)
+
+    def attach(self, topic, seq_id: int = 0):
+        """Subscribes to a topic with news, fetching the messages the bot
+        missed. Leaves the least recently active topics if needed."""
+        for evicted in self.subscriptions.attach(topic):
+            logging.debug("Leaving idle topic %s", evicted)
+            self.last_seq.pop(evicted, None)
+            self.catch_up_since.pop(evicted, None)
+            self.catching_up.pop(evicted, None)
+            self.client_post(self.leave(evicted))
+        last_seq = None if self.plugin_listen else self.last_seq.get(topic)
+        since_id = last_seq + 1 if last_seq is not None else seq_id
+        self.client_post(self.subscribe(topic, since_id=since_id))
+
+    def start_catch_up(self, topic, since_id: int):
+        self.catch_up_since[topic] = since_id
+        self.catching_up[topic] = {"msgs": {}, "page": 0}
+
+    def await_catch_up(self, tid, topic):
+        """The {data} of the catch-up follow the {ctrl} of the {sub}, the
+        server ends them with another {ctrl} of the same id."""
+        if topic not in self.catching_up:
+            return
+        self.add_future(
+            tid,
+            {
+                "arg": topic,
+                "onsuccess": lambda topicName, unused: self.caught_up(topicName),
+                "onerror": lambda topicName, errcode: self.caught_up(topicName, errcode),
+            },
+        )
+
+    def caught_up(self, topic, errcode=None):
+        """Fetches the older page if the last one was full, otherwise
+        answers the messages fetched in order."""
+        catching = self.catching_up.get(topic)
+        if catching is None:
+            return
+        since_id = self.catch_up_since.get(topic, 0)
+        oldest = min(catching["msgs"], default=0)
+        if errcode is None and catching["page"] >= CATCH_UP_LIMIT and oldest > since_id:
+            catching["page"] = 0
+            tid = self.next_id()
+            self.await_catch_up(tid, topic)
+            self.client_post(pb.ClientMsg(get=pb.ClientGet(
+                id=tid, topic=topic, query=catch_up_query(since_id, before_id=oldest))))
+            return
+        del self.catching_up[topic]
+        for seq_id in sorted(catching["msgs"]):
+            self.deliver(catching["msgs"][seq_id])
+
+    def expire_futures(self):
+        # Fails the requests left without a response.
+        while True:
+            time.sleep(self.onCompletion.tick)
+            with self.lock:
+                self.onCompletion.expire()
 
     def subscription_failed(self, topic, errcode):
         if topic == "me":
             # Failed 'me' subscription means the bot is disfunctional.
-            if errcode.get("code") == 502:
+            if errcode.get("code") in (502, timer_wheel.TIMEOUT_CODE):
                 # Cluster unreachable. Break the loop and retry in a few seconds.
                 self.client_post(None)
             else:
                 exit(1)
+        else:
+            # Attached again on its next message.
+            self.del_subscription(topic)
+            self.caught_up(topic, errcode)
 
     def client_generate(self):
         while True:
             try:
                 # If we cannot get any message from queue in 10 mins
                 # exit the current queue, causing the client to reconnect.
-                msg = self.queue_out.get(timeout=60)
+                queued_at, msg = self.queue_out.get_timed(timeout=60)
                 if msg == None:
                     logging.warn("Msg Is None.")
                     if self.client != None:
                         self.client.cancel()
                     return
-                logging.debug("out: %s", utils.to_json(msg))
+                metrics.observe("out.enqueue_to_send", time.time() - queued_at)
+                logging.debug("out: %s", utils.lazy_json(msg), extra={"category": "msg.out"})
                 # Clear retry time.
                 self.retry_time = 0
                 yield msg
@@ -148,13 +319,12 @@ class ChatBot:
             logging.error(traceback.format_exc())
             logging.error(e)
 
-        try:
-            logging.info("Closing the queue...")
-            self.queue_out.close()
-            logging.info("Clearing the processors...")
-        except Exception as e:
-            logging.error(traceback.format_exc())
-            logging.error(e)
+        # The responses to the requests of the old stream will not come.
+        dropped = self.onCompletion.clear()
+        if dropped:
+            logging.info("Dropped %d pending requests", dropped)
+
+        # The queue is kept open: the workers keep posting replies into it.
         # logging.info("Clearing the subscriptions...")
         # self.subscriptions.clear()
 
@@ -190,27 +360,84 @@ class ChatBot:
             {
                 "arg": cookie_file_name,
                 "onsuccess": lambda fname, params: self.on_login(fname, params),
-                "onerror": lambda unused, errcode: login_error(unused, errcode),
+                "onerror": lambda unused, errcode: self.login_failed(errcode),
             },
         )
         return pb.ClientMsg(login=pb.ClientLogin(id=tid, scheme=scheme, secret=secret))
 
-    def subscribe(self, topic, add_to_future=True):
+    def login_failed(self, errcode):
+        if errcode.get("code") == timer_wheel.TIMEOUT_CODE:
+            # No answer, break the loop and log in again.
+            self.client_post(None)
+            return
+        login_error(None, errcode)
+
+    def subscribe(self, topic, add_to_future=True, since_id: int = 0):
         tid = self.next_id()
         if add_to_future:
             self.add_future(
                 tid,
                 {
                     "arg": topic,
-                    "onsuccess": lambda topicName, unused: self.add_subscription(
-                        topicName
-                    ),
+                    "onsuccess": lambda topicName, unused: self.subscribed(tid, topicName),
                     "onerror": lambda topicName, errcode: self.subscription_failed(
                         topicName, errcode
                     ),
                 },
             )
-        return pb.ClientMsg(sub=pb.ClientSub(id=tid, topic=topic))
+        query = None
+        if since_id > 0:
+            self.start_catch_up(topic, since_id)
+            query = catch_up_query(since_id)
+        return pb.ClientMsg(sub=pb.ClientSub(id=tid, topic=topic, get_query=query))
+
+    def resubscribe(self):
+        """Subscribes again to the topics of the previous session, at most
+        RESUBSCRIBE_WINDOW at a time. Messages sent to a topic while the
+        bot was away are fetched with the subscription."""
+        self.resubscribe_pending = collections.deque(self.subscriptions)
+        self.resubscribe_in_flight = 0
+        self.catch_up_since = {}
+        self.catching_up = {}
+        if self.resubscribe_pending:
+            logging.info("Resubscribing to %d topics", len(self.resubscribe_pending))
+        self.resubscribe_next()
+
+    def resubscribe_next(self):
+        while self.resubscribe_pending and self.resubscribe_in_flight < RESUBSCRIBE_WINDOW:
+            topic = self.resubscribe_pending.popleft()
+            self.resubscribe_in_flight += 1
+            tid = self.next_id()
+            self.add_future(
+                tid,
+                {
+                    "arg": topic,
+                    # tid is bound now, the loop goes on to other topics.
+                    "onsuccess": lambda topicName, unused, tid=tid: self.resubscribed(
+                        topicName, tid=tid
+                    ),
+                    "onerror": lambda topicName, errcode: self.resubscribed(topicName, errcode),
+                },
+            )
+            query = None
+            # Missed messages are pushed through the Plugin API.
+            last_seq = None if self.plugin_listen else self.last_seq.get(topic)
+            if last_seq is not None:
+                self.start_catch_up(topic, last_seq + 1)
+                query = catch_up_query(last_seq + 1)
+            self.client_post(pb.ClientMsg(sub=pb.ClientSub(id=tid, topic=topic, get_query=query)))
+
+    def resubscribed(self, topic, errcode=None, tid=None):
+        self.resubscribe_in_flight = max(0, self.resubscribe_in_flight - 1)
+        if errcode is not None:
+            logging.warning("Failed to resubscribe to %s: %s", topic, errcode.get("text"))
+            self.del_subscription(topic)
+            self.last_seq.pop(topic, None)
+            self.catching_up.pop(topic, None)
+        else:
+            self.await_catch_up(tid, topic)
+        metrics.inc("resubscribed", result="error" if errcode else "ok")
+        self.resubscribe_next()
 
     def leave(self, topic):
         tid = self.next_id()
@@ -218,7 +445,9 @@ class ChatBot:
             tid,
             {
                 "arg": topic,
-                "onsuccess": lambda topicName, unused: self.del_subscription(topicName),
+                # Removed from the subscriptions when the bot decided to leave,
+                # it may be attached again by now.
+                "onsuccess": lambda topicName, unused: logging.debug("Left %s", topicName),
             },
         )
         return pb.ClientMsg(leave=pb.ClientLeave(id=tid, topic=topic))
@@ -260,7 +489,6 @@ class ChatBot:
 
         self.channel.subscribe(self.channel_callback)
 
-        self.queue_out = multiprocessing.Queue()
         # Call the server
         stream = pbx.NodeStub(self.channel).MessageLoop(self.client_generate())
 
@@ -270,73 +498,129 @@ class ChatBot:
 
         return stream
 
-    def process_data_msg(self, msg):
-        processor = multiprocessing.Process(
-            target=process_chat,
-            args=(
-                msg,
-                self.next_id(),
-                self.queue_out,
-                self.name,
-                self.photos_root,
-            ),
-        )
-        processor.daemon = True
-        processor.start()
+    def submit(self, topic, job) -> bool:
+        return self.pool.submit(topic, job)
+
+    def process_data_msg(self, msg) -> bool:
+        tid = self.next_id()
+        if not self.submit(msg.data.topic, (msg, tid)):
+            # Let the user know instead of silently dropping the message.
+            self.client_post(error_msg("SERVER_BUSY", tid, msg.data.topic))
+            return False
+        return True
+
+    def handle_data(self, msg):
+        topic = msg.data.topic
+        since = self.catch_up_since.get(topic)
+        if since is not None and msg.data.seq_id < since:
+            # Answered before the reconnect.
+            return
+        last_seq = self.last_seq.get(topic)
+        if last_seq is not None and msg.data.seq_id <= last_seq:
+            # Fetched by the catch-up and received live.
+            return
+        catching = self.catching_up.get(topic)
+        if catching is not None:
+            catching["msgs"][msg.data.seq_id] = msg
+            catching["page"] += 1
+            return
+        self.deliver(msg)
+
+    def deliver(self, msg):
+        topic = msg.data.topic
+        self.subscriptions.touch(topic)
+        # Protection against the bot talking to self from another session.
+        if msg.data.from_user_id != self.botUID and not self.process_data_msg(msg):
+            # Fetched again after a reconnect.
+            return
+        if msg.data.seq_id > self.last_seq.get(topic, 0):
+            self.last_seq[topic] = msg.data.seq_id
+
+    def handle_pushed(self, msg):
+        # A message pushed by the server through the Plugin API. The bot
+        # attaches to the topic to publish the reply.
+        if msg.data.topic not in self.subscriptions:
+            self.attach(msg.data.topic)
+        self.handle_data(msg)
+
+    def call_soon(self, func, *args):
+        """Runs func as the bot's message handlers do, for the threads of
+        the Plugin server."""
+        with self.lock:
+            func(*args)
+
+    def warm_up(self, user_id):
+        """Prepares for the first message of a new user: attaches to the
+        user's topic, the worker owning it loads the quota and the bot."""
+        if not self.submit(user_id, (WARM_UP, user_id)):
+            logging.warning("No room to warm up %s", user_id)
+        if user_id not in self.subscriptions:
+            self.attach(user_id)
+
+    def forget_user(self, user_id):
+        """Leaves the topic of a deleted user and forgets it."""
+        if user_id in self.subscriptions:
+            self.subscriptions.remove(user_id)
+            self.client_post(self.leave(user_id))
+        self.last_seq.pop(user_id, None)
+        self.catch_up_since.pop(user_id, None)
+        self.catching_up.pop(user_id, None)
+
+    def handle_server_msg(self, msg):
+        if msg.HasField("ctrl"):
+            # Run code on command completion
+            self.exec_future(
+                msg.ctrl.id, msg.ctrl.code, msg.ctrl.text, msg.ctrl.params
+            )
+
+        elif msg.HasField("data"):
+            if not self.plugin_listen:
+                self.handle_data(msg)
+        elif msg.HasField("pres"):
+            # log("presence:", msg.pres.topic, msg.pres.what)
+            # Wait for peers to appear online and subscribe to their topics
+            if msg.pres.topic == "me" and not self.plugin_listen:
+                if (
+                    msg.pres.what == pb.ServerPres.ON
+                    or msg.pres.what == pb.ServerPres.MSG
+                ) and msg.pres.src not in self.subscriptions:
+                    self.attach(msg.pres.src, msg.pres.seq_id)
+                elif (
+                    msg.pres.what == pb.ServerPres.OFF
+                    and msg.pres.src in self.subscriptions
+                ):
+                    # Left when idle for long and room is needed.
+                    logging.info("OFF msg received from %s", msg.pres.src)
+
+        else:
+            # Ignore everything else
+            pass
 
     def client_message_loop(self, stream):
         try:
             # Read server responses
             for msg in stream:
-                logging.debug("in: %s", utils.to_json(msg))
-                if msg.HasField("ctrl"):
-                    # Run code on command completion
-                    self.exec_future(
-                        msg.ctrl.id, msg.ctrl.code, msg.ctrl.text, msg.ctrl.params
-                    )
-
-                elif msg.HasField("data"):
-                    # Protection against the bot talking to self from another session.
-                    if msg.data.from_user_id != self.botUID:
-                        self.process_data_msg(msg)
-                elif msg.HasField("pres"):
-                    # log("presence:", msg.pres.topic, msg.pres.what)
-                    # Wait for peers to appear online and subscribe to their topics
-                    if msg.pres.topic == "me":
-                        if (
-                            msg.pres.what == pb.ServerPres.ON
-                            or msg.pres.what == pb.ServerPres.MSG
-                        ) and self.subscriptions.get(msg.pres.src) == None:
-                            self.client_post(self.subscribe(msg.pres.src))
-                        elif (
-                            msg.pres.what == pb.ServerPres.OFF
-                            and self.subscriptions.get(msg.pres.src) != None
-                        ):
-                            logging.info("OFF msg received from %s", msg.pres.src)
-                            # Chatbot never leave.
-                            # self.client_post(self.leave(msg.pres.src))
-
-                else:
-                    # Ignore everything else
-                    pass
-                logging.debug("msg processed: %s", utils.to_json(msg))
+                logging.debug("in: %s", utils.lazy_json(msg), extra={"category": "msg.in"})
+                with self.lock:
+                    self.handle_server_msg(msg)
 
         except grpc._channel._Rendezvous as err:
             logging.error("Disconnected: %s", err)
 
     def on_login(self, cookie_file_name, params):
+        self.reconnect_attempts = 0
         self.client_post(self.subscribe("me"))
         # Subscribe post before.
-        for topic in self.subscriptions:
-            self.client_post(self.subscribe(topic, False))
+        self.resubscribe()
+
+        if params is not None and "user" in params:
+            # The params are JSON, the user id is a quoted string.
+            self.botUID = json.loads(params["user"].decode("utf-8"))
 
         """Save authentication token to file"""
         if params == None or cookie_file_name == None:
             return
 
-        if "user" in params:
-            self.botUID = params["user"].decode("ascii")
-
         # Protobuf map 'params' is not a python object or dictionary. Convert it.
         nice = {"schema": "token"}
         for key_in in params:
@@ -357,12 +641,45 @@ class ChatBot:
         logging.debug("Channel connectivity: %s", channel_connectivity)
         self.channel_state = channel_connectivity
 
+    def start_metrics(self):
+        # Counters of an earlier run would be added to this one.
+        metrics.clear_snapshots(self.metrics_folder)
+        metrics.gauge("out_queue_depth", self.queue_out.qsize)
+        metrics.gauge("requests_in_flight", lambda: len(self.onCompletion))
+        metrics.gauge("subscriptions_attached", lambda: len(self.subscriptions))
+        metrics.gauge("admission_in_flight", lambda: self.admission.stats()["in_flight"])
+        metrics.gauge(
+            "admission_waiting",
+            lambda: self.admission.stats()["waiting_vip"] + self.admission.stats()["waiting_free"],
+        )
+        if self.metrics_listen:
+            try:
+                self.metrics_server = metrics.serve(
+                    self.metrics_listen, self.metrics_folder, status=self.status
+                )
+            except OSError as e:
+                logging.error("Failed to serve metrics at %s: %s", self.metrics_listen, e)
+
+    def status(self) -> dict:
+        """The requests waiting for the server and the topics attached,
+        served at /status."""
+        return {
+            "requests": self.onCompletion.stats(),
+            "subscriptions": self.subscriptions.stats(),
+        }
+
     def run(self, host_addr):
         schema = 'basic'
         secret = f"{self.name}:{self.passwd}".encode("utf-8")
 
         if schema:
-            # Load random quotes from file
+            # Start the workers before any grpc channel is created,
+            # grpc does not survive a fork.
+            self.start_metrics()
+            self.pool.start()
+            threading.Thread(target=self.expire_futures, daemon=True).start()
+            if self.plugin_listen:
+                self.plugin_server = self.init_server(self.plugin_listen, self.plugin_workers)
 
             # Initialize and launch client
             self.client = self.init_client(
@@ -374,6 +691,7 @@ class ChatBot:
                 logging.info("Terminated with signal %s ", signo)
                 # server.stop(0)
                 self.client.cancel()
+                self.pool.stop()
                 sys.exit(0)
 
             # Add signal handlers
@@ -388,8 +706,11 @@ class ChatBot:
                 except Exception as err:
                     logging.error(traceback.format_exc())
                     logging.error("Error: %s", err)
-                logging.error("Disconnected. Reconnecting in 3 seconds...")
-                time.sleep(3)
+                delay = reconnect_delay(self.reconnect_attempts)
+                self.reconnect_attempts += 1
+                logging.error("Disconnected. Reconnecting in %.1f seconds...", delay)
+                metrics.inc("reconnects")
+                time.sleep(delay)
                 # Close connections gracefully before exiting
                 # server.stop(None)
                 logging.info("Resetting client")
@@ -405,10 +726,15 @@ class ChatBot:
         else:
             logging.error("Error: authentication scheme not defined")
 
-    def init_server(self, listen):
+    def init_server(self, listen, workers=16):
         # Launch plugin server: accept connection(s) from the Tinode server.
-        server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
-        pbx.add_PluginServicer_to_server(Plugin(), server)
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=workers))
+        plugin = Plugin(
+            [self],
+            firehose=self.firehose,
+            warm_up_bots=[self] if self.warm_up_new_users else [],
+        )
+        pbx.add_PluginServicer_to_server(plugin, server)
         server.add_insecure_port(listen)
         server.start()
 
@@ -449,20 +775,131 @@ def server_version(params):
     )
 
 
+def p2p_users(topic: str):
+    """Returns the two user ids of a p2p topic name, () if it is not one."""
+    if not topic.startswith("p2p"):
+        return ()
+    try:
+        raw = base64.urlsafe_b64decode(topic[3:] + "=" * (-len(topic[3:]) % 4))
+    except ValueError:
+        return ()
+    if len(raw) != 16:
+        return ()
+    return tuple(
+        "usr" + base64.urlsafe_b64encode(part).decode("ascii").rstrip("=")
+        for part in (raw[:8], raw[8:])
+    )
+
+
 class Plugin(pbx.PluginServicer):
+    """Plugin API of the bots: the server pushes the messages sent to them.
+
+    Message gets the {data} stored in the p2p topics of the bots. FireHose,
+    if the server is configured to call it, gets the {pub} of the users to
+    the bots before they are stored; set firehose to take the messages from
+    there instead of Message.
+    """
+
+    def __init__(self, bots, firehose: bool = False, warm_up_bots=()) -> None:
+        self.bots = bots
+        self.firehose = firehose
+        # Bots attaching to the topics of new users right away.
+        self.warm_up_bots = warm_up_bots
+        # Account events are handled in the background, in order.
+        self.account_executor = futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="account")
+
+    def bot_of(self, user_id):
+        for bot in self.bots:
+            if bot.botUID == user_id:
+                return bot
+        return None
+
+    def Message(self, msg_event, context):
+        if self.firehose or msg_event.action != pb.CREATE:
+            return pb.Unused()
+        data = msg_event.msg
+        for user_id in p2p_users(data.topic):
+            bot = self.bot_of(user_id)
+            if bot is None or data.from_user_id == user_id:
+                continue
+            metrics.inc("plugin_messages", rpc="Message")
+            # The bot sees the topic as its peer's user id.
+            msg = pb.ServerMsg(data=pb.ServerData(
+                topic=data.from_user_id,
+                from_user_id=data.from_user_id,
+                timestamp=data.timestamp,
+                seq_id=data.seq_id,
+                head=data.head,
+                content=data.content,
+            ))
+            try:
+                bot.call_soon(bot.handle_pushed, msg)
+            except Exception as err:
+                logging.error(traceback.format_exc())
+                logging.error("Error handling pushed message: %s", err)
+        return pb.Unused()
+
+    def FireHose(self, req, context):
+        if self.firehose and req.msg.HasField("pub"):
+            topic = req.msg.pub.topic
+            bot = None
+            for user_id in p2p_users(topic) or (topic,):
+                bot = bot or self.bot_of(user_id)
+            if bot is not None and req.sess.user_id != bot.botUID:
+                metrics.inc("plugin_messages", rpc="FireHose")
+                msg = pb.ServerMsg(data=pb.ServerData(
+                    topic=req.sess.user_id,
+                    from_user_id=req.sess.user_id,
+                    timestamp=int(time.time() * 1000),
+                    head=req.msg.pub.head,
+                    content=req.msg.pub.content,
+                ))
+                try:
+                    bot.call_soon(bot.handle_pushed, msg)
+                except Exception as err:
+                    logging.error(traceback.format_exc())
+                    logging.error("Error handling pushed message: %s", err)
+        # The server goes on with the message.
+        return pb.ServerResp(status=pb.CONTINUE)
+
     def Account(self, acc_event, context):
         action = None
         if acc_event.action == pb.CREATE:
             action = "created"
-            # TODO: subscribe to the new user.
-
+            self.account_executor.submit(self.account_created, acc_event.user_id)
         elif acc_event.action == pb.UPDATE:
             action = "updated"
         elif acc_event.action == pb.DELETE:
             action = "deleted"
+            self.account_executor.submit(self.account_deleted, acc_event.user_id)
         else:
             action = "unknown"
 
-        logging.info("Account", action, ":", acc_event.user_id, acc_event.public)
+        logging.info("Account %s: %s", action, acc_event.user_id)
+        metrics.inc("accounts", action=action)
 
         return pb.Unused()
+
+    def account_created(self, user_id):
+        for bot in self.warm_up_bots:
+            try:
+                bot.call_soon(bot.warm_up, user_id)
+            except Exception as err:
+                logging.error("Error warming up %s for %s: %s", bot.name, user_id, err)
+
+    def account_deleted(self, user_id):
+        # The state of the user with every bot, in every topic.
+        try:
+            store = state_store.get_store()
+            keys = store.keys(prefix=f"{user_id}_")
+            for key in keys:
+                store.delete(key)
+            deleted = db.delete_user(user_id)
+            logging.info(
+                "Deleted user %s: %d state entries, %d redis keys", user_id, len(keys), deleted)
+        except Exception as err:
+            logging.error(traceback.format_exc())
+            logging.error("Error deleting user %s: %s", user_id, err)
+        for bot in self.bots:
+            bot.call_soon(bot.forget_user, user_id)
@@ -0,0 +1,197 @@
+import base64
+import json
+import unittest
+import model_pb2 as pb
+import chatbot
+
+
+class TestChatBot(unittest.TestCase):
+    def setUp(self):
+        self.bot = chatbot.ChatBot("bot", "secret", None, workers=1)
+        self.posted = []
+        self.bot.client_post = self.posted.append
+
+    def test_reconnect_delay(self):
+        for attempt in range(20):
+            delay = chatbot.reconnect_delay(attempt)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, chatbot.RECONNECT_MAX_DELAY)
+
+    def test_resubscribe_window(self):
+        for i in range(chatbot.RESUBSCRIBE_WINDOW + 10):
+            self.bot.subscriptions.attach(f"usr{i}")
+        self.bot.last_seq["usr0"] = 41
+        self.bot.on_login(None, None)
+        subs = [msg.sub for msg in self.posted]
+        # 'me' and a full window.
+        self.assertEqual(len(subs), 1 + chatbot.RESUBSCRIBE_WINDOW)
+        self.assertEqual(subs[1].get_query.data.since_id, 42)
+        # Each answer lets the next subscription go.
+        self.bot.exec_future(subs[1].id, 200, "ok", None)
+        self.assertEqual(len(self.posted), 2 + chatbot.RESUBSCRIBE_WINDOW)
+
+    def test_status(self):
+        self.bot.subscriptions.attach("usrA")
+        self.bot.on_login(None, None)
+        self.bot.exec_future(self.posted[0].sub.id, 200, "ok", None)
+        status = self.bot.status()
+        self.assertEqual(status["requests"]["completed"], 1)
+        self.assertEqual(status["requests"]["in_flight"], 1)
+        self.assertEqual(status["subscriptions"]["topics"], 1)
+
+    def login(self, user_id):
+        # The user id comes JSON-encoded in the params of the {ctrl}.
+        self.bot.on_login(None, {"user": json.dumps(user_id).encode("utf-8")})
+        self.assertEqual(self.bot.botUID, user_id)
+
+    def process(self, processed, accepted=True):
+        def process_data_msg(msg):
+            processed.append(msg)
+            return accepted
+        self.bot.process_data_msg = process_data_msg
+
+    def data(self, topic, seq):
+        return pb.ServerMsg(data=pb.ServerData(topic=topic, from_user_id=topic, seq_id=seq))
+
+    def test_catch_up_skips_answered(self):
+        self.bot.subscriptions.attach("usrA")
+        self.bot.last_seq["usrA"] = 5
+        self.bot.on_login(None, None)
+        sub = self.posted[-1].sub
+        processed = []
+        self.process(processed)
+        self.bot.exec_future(sub.id, 200, "ok", None)
+        # Newest first, as the server sends them.
+        for seq in (7, 6, 5):
+            self.bot.handle_server_msg(self.data("usrA", seq))
+        self.assertEqual(processed, [])
+        self.bot.exec_future(sub.id, 208, "delivered", None)
+        self.assertEqual([msg.data.seq_id for msg in processed], [6, 7])
+        self.assertEqual(self.bot.last_seq["usrA"], 7)
+
+    def test_catch_up_topics(self):
+        for topic in ("usrA", "usrB"):
+            self.bot.subscriptions.attach(topic)
+            self.bot.last_seq[topic] = 5
+        self.bot.on_login(None, None)
+        subs = {msg.sub.topic: msg.sub for msg in self.posted[1:]}
+        processed = []
+        self.process(processed)
+        for topic in ("usrA", "usrB"):
+            self.bot.exec_future(subs[topic].id, 200, "ok", None)
+        for topic in ("usrA", "usrB"):
+            self.bot.handle_server_msg(self.data(topic, 6))
+        for topic in ("usrA", "usrB"):
+            self.bot.exec_future(subs[topic].id, 208, "delivered", None)
+        self.assertEqual([msg.data.topic for msg in processed], ["usrA", "usrB"])
+        self.assertEqual(self.bot.catching_up, {})
+
+    def test_catch_up_pages(self):
+        self.bot.subscriptions.attach("usrA")
+        self.bot.last_seq["usrA"] = 0
+        self.bot.on_login(None, None)
+        sub = self.posted[-1].sub
+        processed = []
+        self.process(processed)
+        self.bot.exec_future(sub.id, 200, "ok", None)
+        missed = range(chatbot.CATCH_UP_LIMIT + 5, 0, -1)
+        for seq in list(missed)[:chatbot.CATCH_UP_LIMIT]:
+            self.bot.handle_server_msg(self.data("usrA", seq))
+        self.bot.exec_future(sub.id, 208, "delivered", None)
+        # The page was full, the older messages are fetched before any
+        # is answered.
+        get = self.posted[-1].get
+        self.assertEqual(get.query.data.since_id, 1)
+        self.assertEqual(get.query.data.before_id, 6)
+        self.assertEqual(processed, [])
+        for seq in list(missed)[chatbot.CATCH_UP_LIMIT:]:
+            self.bot.handle_server_msg(self.data("usrA", seq))
+        self.bot.exec_future(get.id, 208, "delivered", None)
+        self.assertEqual([msg.data.seq_id for msg in processed], sorted(missed))
+
+    def test_rejected_fetched_again(self):
+        self.bot.last_seq["usrA"] = 4
+        processed = []
+        self.process(processed, accepted=False)
+        self.bot.handle_server_msg(self.data("usrA", 5))
+        self.assertEqual(self.bot.last_seq["usrA"], 4)
+
+    def test_attach_fetches_missed(self):
+        self.bot.subscriptions = chatbot.subscriptions.Subscriptions(max_topics=1, min_idle=0)
+        self.bot.attach("usrA", 3)
+        self.assertEqual(self.posted[-1].sub.get_query.data.since_id, 3)
+        self.bot.last_seq["usrA"] = 3
+        self.bot.attach("usrB")
+        # usrA is left to make room.
+        self.assertEqual(self.posted[-2].leave.topic, "usrA")
+        self.assertEqual(list(self.bot.subscriptions), ["usrB"])
+        self.assertNotIn("usrA", self.bot.last_seq)
+
+    def test_plugin_message(self):
+        bot_uid, user_uid = b"\x01" * 8, b"\x02" * 8
+
+        def uid(raw):
+            return "usr" + base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+        topic = "p2p" + base64.urlsafe_b64encode(user_uid + bot_uid).decode().rstrip("=")
+        self.assertEqual(chatbot.p2p_users(topic), (uid(user_uid), uid(bot_uid)))
+        self.bot.plugin_listen = "127.0.0.1:0"
+        self.login(uid(bot_uid))
+        processed = []
+        self.bot.process_data_msg = processed.append
+        plugin = chatbot.Plugin([self.bot])
+        for sender in (uid(user_uid), uid(bot_uid)):
+            plugin.Message(pb.MessageEvent(action=pb.CREATE, msg=pb.ServerData(
+                topic=topic, from_user_id=sender, seq_id=1)), None)
+        # The bot's own message is not answered, the user's is, in the
+        # topic as the bot sees it.
+        self.assertEqual([msg.data.topic for msg in processed], [uid(user_uid)])
+        self.assertEqual(self.posted[-1].sub.topic, uid(user_uid))
+        # Messages of the stream are ignored in plugin mode.
+        self.bot.handle_server_msg(pb.ServerMsg(data=pb.ServerData(
+            topic=uid(user_uid), from_user_id=uid(user_uid), seq_id=2)))
+        self.assertEqual(len(processed), 1)
+
+    def test_plugin_firehose(self):
+        self.bot = chatbot.ChatBot(
+            "bot", "secret", None, workers=1, plugin_listen="127.0.0.1:0", firehose=True)
+        self.bot.client_post = self.posted.append
+        self.login("usrBot")
+        processed = []
+        self.process(processed)
+        plugin = chatbot.Plugin([self.bot], firehose=self.bot.firehose)
+        # The {pub} of a user to the bot, and of the bot itself.
+        for sender in ("usrA", "usrBot"):
+            resp = plugin.FireHose(pb.ClientReq(
+                msg=pb.ClientMsg(pub=pb.ClientPub(topic="usrBot" if sender == "usrA" else "usrA")),
+                sess=pb.Session(user_id=sender)), None)
+            self.assertEqual(resp.status, pb.CONTINUE)
+        self.assertEqual([msg.data.topic for msg in processed], ["usrA"])
+        self.assertEqual(self.posted[-1].sub.topic, "usrA")
+        # Message does not answer it twice once stored.
+        plugin.Message(pb.MessageEvent(action=pb.CREATE, msg=pb.ServerData(
+            topic="usrA", from_user_id="usrA", seq_id=1)), None)
+        self.assertEqual(len(processed), 1)
+
+    def test_account_events(self):
+        submitted = []
+        self.bot.submit = lambda topic, job: submitted.append((topic, job)) or True
+        plugin = chatbot.Plugin([self.bot], warm_up_bots=[self.bot])
+        plugin.account_created("usrNew")
+        # The worker of the topic warms up, the bot attaches before the
+        # first message comes.
+        self.assertEqual(submitted, [("usrNew", (chatbot.WARM_UP, "usrNew"))])
+        self.assertIn("usrNew", self.bot.subscriptions)
+        self.bot.last_seq["usrNew"] = 3
+        self.bot.forget_user("usrNew")
+        self.assertNotIn("usrNew", self.bot.subscriptions)
+        self.assertNotIn("usrNew", self.bot.last_seq)
+        self.assertEqual(self.posted[-1].leave.topic, "usrNew")
+        # Not attached, nothing to leave.
+        posted = len(self.posted)
+        self.bot.forget_user("usrOld")
+        self.assertEqual(len(self.posted), posted)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,6 +13,7 @@ COMMON_MSG = {
     "INVALID_MESSAGE_FORMAT":"信息格式错误, 请报告BUG",
     "AUDIO_MSG_NOT_RECOGNISED":"我没听懂您说的是什么，可以再重复一遍吗？",
     "AUDIO_MSG_NOT_SUPPORTED":"目前只有VIP用户可以使用语音功能哦",
+    "SERVER_BUSY":"现在找我聊天的人太多了，请稍后再发一次哦",
 }
 
 CTRL_CMDS = {
@@ -67,6 +68,8 @@ APP_NAME = "Puppet-chatbot"
 APP_VERSION = "1.0.0"
 LIB_VERSION = pkg_resources.get_distribution("tinode_grpc").version
 
-MAX_PROMPT_LEN = 2000
+# Maximum number of tokens of a prompt, the rest of the 4k context of
+# the model is left for the reply.
+MAX_PROMPT_TOKENS = 3000
 # Maximum length of string to log. Shorten longer strings.
 MAX_LOG_LEN = 128
@@ -1,7 +1,148 @@
 import logging
+import os
 import redis
-import json
 import datetime
+import metrics
+
+# Redis databases used by the chatbot.
+BOT_DB = 6
+QUOTA_DB = 7
+USER_DB = 8
+RESPONSE_CACHE_DB = 9
+
+_config = {
+    "host": os.environ.get("CHATBOT_REDIS_HOST", "47.103.17.145"),
+    "port": int(os.environ.get("CHATBOT_REDIS_PORT", "8010")),
+    "password": os.environ.get("CHATBOT_REDIS_PASSWORD", "godword"),
+    # Seconds.
+    "socket_timeout": float(os.environ.get("CHATBOT_REDIS_TIMEOUT", "5")),
+    "connect_timeout": float(os.environ.get("CHATBOT_REDIS_CONNECT_TIMEOUT", "3")),
+    "max_connections": int(os.environ.get("CHATBOT_REDIS_MAX_CONNECTIONS", "32")),
+    # {db: "redis://..."} overrides the endpoint of a single database.
+    "urls": {},
+}
+# One connection pool per database, shared by everything in the process.
+_pools = {}
+
+# The quota of a user is the hash TTL:{uid} with the fields times, tokens
+# and type. Quotas written as JSON strings are converted first, keeping
+# their expiry.
+_MIGRATE_QUOTA = """
+local key = KEYS[1]
+if redis.call('TYPE', key)['ok'] == 'string' then
+    local ttl = redis.call('TTL', key)
+    local quota = cjson.decode(redis.call('GET', key))
+    redis.call('DEL', key)
+    redis.call('HSET', key, 'times', quota['times'] or 0, 'tokens', quota['tokens'] or 0,
+               'type', quota['type'] or 'free')
+    if ttl > 0 then
+        redis.call('EXPIRE', key, ttl)
+    end
+end
+"""
+# Returns times, tokens, type, TTL and weight (share of the LLM slots,
+# optional) of the quota, creating it from ARGV (times, tokens, type,
+# expire) if the user has none.
+_LOAD_QUOTA = _MIGRATE_QUOTA + """
+if redis.call('EXISTS', key) == 0 then
+    redis.call('HSET', key, 'times', ARGV[1], 'tokens', ARGV[2], 'type', ARGV[3])
+    redis.call('EXPIRE', key, ARGV[4])
+end
+local quota = redis.call('HMGET', key, 'times', 'tokens', 'type', 'weight')
+return {quota[1], quota[2], quota[3], redis.call('TTL', key), quota[4]}
+"""
+# Debits the turns of ARGV, the tokens used by each, with HINCRBY, which
+# keeps the expiry. A turn costs its tokens while tokens are left, then a
+# time. VIP quotas are not debited, expired ones are not recreated.
+# Returns the times and tokens left.
+_DEBIT_QUOTA = _MIGRATE_QUOTA + """
+if redis.call('EXISTS', key) == 0 then
+    return nil
+end
+local quota = redis.call('HMGET', key, 'times', 'tokens', 'type')
+local times, tokens = tonumber(quota[1]) or 0, tonumber(quota[2]) or 0
+if string.lower(quota[3] or '') == 'vip' then
+    return {times, tokens}
+end
+local left_times, left_tokens = times, tokens
+for _, used in ipairs(ARGV) do
+    if left_tokens > 0 then
+        left_tokens = math.max(0, left_tokens - tonumber(used))
+    else
+        left_times = math.max(0, left_times - 1)
+    end
+end
+if left_times ~= times then
+    redis.call('HINCRBY', key, 'times', left_times - times)
+end
+if left_tokens ~= tokens then
+    redis.call('HINCRBY', key, 'tokens', left_tokens - tokens)
+end
+return {left_times, left_tokens}
+"""
+# {script: registered script}, registered on first use.
+_scripts = {}
+
+# The quota of a free user, renewed every day.
+FREE_QUOTA = {
+    "times": 30,
+    "tokens": 30000,
+    "type": "free",
+}
+
+
+def _script(source: str):
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = get_redis(QUOTA_DB).register_script(source)
+    return script
+
+
+def configure(urls=None, **kwargs):
+    """Changes the redis endpoints and timeouts. Existing pools are closed."""
+    for key, val in kwargs.items():
+        if key not in _config:
+            raise ValueError(f"Unknown redis option: {key}")
+        if val is not None:
+            _config[key] = val
+    if urls is not None:
+        _config["urls"] = dict(urls)
+    for pool in _pools.values():
+        pool.disconnect()
+    _pools.clear()
+    _scripts.clear()
+
+
+def get_redis(db: int) -> redis.Redis:
+    pool = _pools.get(db)
+    if pool is None:
+        options = {
+            "socket_timeout": _config["socket_timeout"],
+            "socket_connect_timeout": _config["connect_timeout"],
+            "max_connections": _config["max_connections"],
+            "health_check_interval": 30,
+        }
+        url = _config["urls"].get(db)
+        if url:
+            pool = redis.ConnectionPool.from_url(url, **options)
+        else:
+            pool = redis.ConnectionPool(
+                host=_config["host"],
+                port=_config["port"],
+                db=db,
+                password=_config["password"],
+                **options,
+            )
+        _pools[db] = pool
+    return redis.Redis(connection_pool=pool)
+
+
+def latency_stats() -> dict:
+    return {
+        name: stat
+        for name, stat in metrics.latency_stats().items()
+        if name.startswith("redis.")
+    }
 
 
 def get_time_left_of_today() -> int:
@@ -12,6 +153,94 @@ def get_time_left_of_today() -> int:
     return (tomorrow - now).seconds
 
 
+def get_bot_data(bot_name: str):
+    """Returns the raw bot definition or None."""
+    try:
+        with metrics.timed("redis.get_bot_data"):
+            return get_redis(BOT_DB).get(bot_name)
+    except Exception as e:
+        logging.error("Error in get_bot_data %s", e)
+        return None
+
+
+# The name of a bot is published here after its definition is added,
+# changed or removed, or "*" for all bots. The bots and the manager listen.
+BOTS_CHANNEL = "chatbot:bot_updates"
+
+
+def scan_bots(batch: int = 500) -> dict:
+    """Returns {name: raw definition} of all the bots. Keys are read with
+    SCAN and their values with MGET, pipelined per batch of keys."""
+    redis_bots = get_redis(BOT_DB)
+    bots = {}
+    with metrics.timed("redis.scan_bots"):
+        keys = list(redis_bots.scan_iter(count=batch))
+        pipe = redis_bots.pipeline(transaction=False)
+        for start in range(0, len(keys), batch):
+            pipe.mget(keys[start:start + batch])
+        values = [value for chunk in pipe.execute() for value in chunk]
+    for key, value in zip(keys, values):
+        if value is not None:
+            bots[key.decode("utf-8")] = value
+    return bots
+
+
+def load_quota(from_user_id: str) -> dict:
+    """Returns the quota of a user with its "ttl", creating the free quota
+    if the user has none."""
+    with metrics.timed("redis.load_quota"):
+        times, tokens, kind, ttl, weight = _script(_LOAD_QUOTA)(
+            keys=[f"TTL:{from_user_id}"],
+            args=[
+                FREE_QUOTA["times"],
+                FREE_QUOTA["tokens"],
+                FREE_QUOTA["type"],
+                max(1, get_time_left_of_today()),
+            ],
+        )
+    return {
+        "times": int(times),
+        "tokens": int(tokens),
+        "type": kind.decode("utf-8") if isinstance(kind, bytes) else kind,
+        "ttl": ttl,
+        "weight": float(weight) if weight is not None else 1.0,
+    }
+
+
+def create_free_quota(from_user_id: str) -> dict:
+    """Creates the daily quota of a free user unless the user has one.
+    Returns the quota."""
+    return load_quota(from_user_id)
+
+
+def debit_quotas(turns: dict) -> dict:
+    """Debits {user: [tokens used by each turn]} in one round trip.
+    Returns {user: (times, tokens) left}, None for expired quotas."""
+    pipe = get_redis(QUOTA_DB).pipeline(transaction=False)
+    debit = _script(_DEBIT_QUOTA)
+    for user, used in turns.items():
+        debit(keys=[f"TTL:{user}"], args=used, client=pipe)
+    with metrics.timed("redis.debit_quotas"):
+        results = pipe.execute()
+    return {
+        user: tuple(result) if result is not None else None
+        for user, result in zip(turns, results)
+    }
+
+
+def delete_user(from_user_id: str) -> int:
+    """Deletes the quota and the per bot data of a user, returns the
+    number of keys deleted."""
+    deleted = 0
+    with metrics.timed("redis.delete_user"):
+        deleted += get_redis(QUOTA_DB).delete(f"TTL:{from_user_id}")
+        redis_user = get_redis(USER_DB)
+        keys = list(redis_user.scan_iter(match=f"{from_user_id}:*", count=500))
+        keys.append(from_user_id)
+        deleted += redis_user.delete(*keys)
+    return deleted
+
+
 def get_user_validity(from_user_id: str):
     # 当前用户的有效性原则：
     # 1. 付费用户
@@ -20,67 +249,25 @@ def get_user_validity(from_user_id: str):
     # 2. 免费用户
     #    -- 每天30次聊天+300000 TOKEN余量，未用完清零
     logging.debug("Checking user validity: %s", from_user_id)
-    ttl_key = f"TTL:{from_user_id}"
     try:
-        with redis.Redis(
-            host="47.103.17.145", port=8010, db=7, password="godword"
-        ) as redis_ttl:
-            token_left = redis_ttl.get(ttl_key)
-            if token_left == None:
-                # 免费用户，KEY不存在，初始化30次
-                free_tokens = {
-                    "times": 30,
-                    "tokens": 30000,
-                    "type": "free",
-                }
-                redis_ttl.set(ttl_key, json.dumps(free_tokens))
-                redis_ttl.expire(ttl_key, get_time_left_of_today())
-                return [True, free_tokens]
-
-            tokens = json.loads(token_left.decode("utf-8"))
-            # token string is like:
-            # {"times": 10, "tokens": 20, "type": "free"}
-            tokens["ttl"] = redis_ttl.ttl(ttl_key)
-            if tokens["times"] <= 0 and tokens["tokens"] <= 0:
-                return [False, 0]
-            logging.debug("User %s has %s tokens left", from_user_id, tokens)
-            return [True, tokens]
+        # {"times": 10, "tokens": 20, "type": "free", "ttl": 3600}
+        tokens = load_quota(from_user_id)
+        if tokens["times"] <= 0 and tokens["tokens"] <= 0:
+            return [False, 0]
+        logging.debug("User %s has %s tokens left", from_user_id, tokens)
+        return [True, tokens]
     except Exception as e:
         logging.error("Error in get_user_validity %s", e)
         return [False, 0]
 
 
-def save_tokens_left(from_user_id: str, tokens_left):
-    logging.debug("Decreasing tokens for user %s : %s", from_user_id, tokens_left)
-    ttl_key = f"TTL:{from_user_id}"
-    try:
-        with redis.Redis(
-            host="47.103.17.145", port=8010, db=7, password="godword"
-        ) as redis_ttl:
-            # VIP用户不计算TOKEN和TIMES，也不会过期
-            if tokens_left["type"] == "vip":
-                tokens_left["times"] = 999999999
-                tokens_left["tokens"] = 999999999
-            # delete ttl key
-            tokens_left.pop("ttl")
-            json_str = json.dumps(tokens_left)
-            ttl = redis_ttl.ttl(ttl_key)
-            redis_ttl.set(ttl_key, json_str)
-            if ttl > 0:
-                redis_ttl.expire(ttl_key, ttl)
-    except Exception as e:
-        logging.error("Error in save_tokens_left %s", e)
-
-
 def get_user_data(from_user_id: str) -> str:
     try:
-        with redis.Redis(
-            host="47.103.17.145", port=8010, db=8, password="godword"
-        ) as redis_con:
-            json_data = redis_con.get(from_user_id)
-            if json_data == None:
-                return ""
-            return json_data.decode("utf-8")
+        with metrics.timed("redis.get_user_data"):
+            json_data = get_redis(USER_DB).get(from_user_id)
+        if json_data == None:
+            return ""
+        return json_data.decode("utf-8")
     except Exception as e:
         logging.error("Error in get_user_data %s", e)
         return ""
@@ -89,9 +276,7 @@ def get_user_data(from_user_id: str) -> str:
 def save_user_data(from_user_id: str, json_data: str):
     logging.debug("Saving user data for %s: %s", from_user_id, json_data)
     try:
-        with redis.Redis(
-            host="47.103.17.145", port=8010, db=8, password="godword"
-        ) as redis_con:
-            redis_con.set(from_user_id, json_data)
+        with metrics.timed("redis.save_user_data"):
+            get_redis(USER_DB).set(from_user_id, json_data)
     except Exception as e:
         logging.error("Error in save_user_data %s", e)
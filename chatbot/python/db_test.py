@@ -0,0 +1,71 @@
+import pathlib
+import sys
+import unittest
+import db
+import metrics
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent / "bench"))
+import fake_redis  # noqa: E402
+
+
+class TestDb(unittest.TestCase):
+    def setUp(self):
+        self.config = dict(db._config)
+        self.server = fake_redis.FakeRedis()
+        self.port = self.server.start()
+        db.configure(host="127.0.0.1", port=self.port, password=None)
+        metrics.reset()
+
+    def tearDown(self):
+        db.configure(**self.config)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pools(self):
+        # One pool per database, shared by the calls.
+        pool = db.get_redis(db.USER_DB).connection_pool
+        self.assertIs(db.get_redis(db.USER_DB).connection_pool, pool)
+        self.assertIsNot(db.get_redis(db.QUOTA_DB).connection_pool, pool)
+        self.assertEqual(pool.connection_kwargs["db"], db.USER_DB)
+        db.configure(urls={db.USER_DB: f"redis://127.0.0.1:{self.port}/3"}, socket_timeout=2)
+        pool = db.get_redis(db.USER_DB).connection_pool
+        self.assertEqual(pool.connection_kwargs["db"], 3)
+        self.assertEqual(pool.connection_kwargs["socket_timeout"], 2)
+        with self.assertRaises(ValueError):
+            db.configure(timeout=2)
+
+    def test_user_data(self):
+        self.assertEqual(db.get_user_data("usrA"), "")
+        db.save_user_data("usrA", '{"feeling": 1}')
+        self.assertEqual(db.get_user_data("usrA"), '{"feeling": 1}')
+        self.assertEqual(db.latency_stats()["redis.get_user_data"]["count"], 2)
+
+    def test_quota(self):
+        quota = db.load_quota("usrA")
+        self.assertEqual(
+            {key: quota[key] for key in ("times", "tokens", "type", "weight")},
+            dict(db.FREE_QUOTA, weight=1.0),
+        )
+        self.assertGreater(quota["ttl"], 0)
+        # The tokens first, then a time per turn.
+        self.assertEqual(
+            db.debit_quotas({"usrA": [29000, 2000, 10], "usrB": [10]}),
+            {"usrA": (29, 0), "usrB": None},
+        )
+        self.assertEqual(db.get_user_validity("usrA")[1]["times"], 29)
+        db.save_user_data("usrA:bot", "{}")
+        self.assertEqual(db.delete_user("usrA"), 2)
+        self.assertEqual(db.load_quota("usrA")["tokens"], db.FREE_QUOTA["tokens"])
+
+    def test_json_quota_migrated(self):
+        db.get_redis(db.QUOTA_DB).set(
+            "TTL:usrA", '{"times": 3, "tokens": 0, "type": "vip"}', ex=600)
+        quota = db.load_quota("usrA")
+        self.assertEqual((quota["times"], quota["type"]), (3, "vip"))
+        self.assertGreater(quota["ttl"], 590)
+        # VIP quotas are not debited.
+        self.assertEqual(db.debit_quotas({"usrA": [10]}), {"usrA": (3, 0)})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+"""Bounded conversation history with a running token total."""
+import collections
+
+import tokenizer
+
+
+class HistoryWindow:
+    """The turns of a conversation, oldest first.
+
+    Appending and dropping the oldest turn are O(1) and keep the token
+    total of all turns up to date, so measuring a prompt never walks the
+    history. Every turn has a sequence id, `start` is the id of the oldest
+    one. The window supports the list operations used on the history
+    (append, pop from either end, clear, indexing, iteration) and is
+    saved as a plain list with to_list().
+    """
+
+    def __init__(self, turns=(), start: int = 0, max_turns: int = 0) -> None:
+        self._turns = collections.deque()
+        self._tokens = collections.deque()
+        self.start = start
+        # 0 for unbounded.
+        self.max_turns = max_turns
+        self.tokens = 0
+        for turn in turns:
+            self.append(turn)
+
+    def append(self, turn):
+        count = tokenizer.message_tokens(turn)
+        self._turns.append(turn)
+        self._tokens.append(count)
+        self.tokens += count
+        if self.max_turns and len(self._turns) > self.max_turns:
+            self.pop(0)
+
+    def pop(self, index: int = -1):
+        if not self._turns:
+            raise IndexError("pop from empty history")
+        if index == 0:
+            self.start += 1
+            self.tokens -= self._tokens.popleft()
+            return self._turns.popleft()
+        if index == -1 or index == len(self._turns) - 1:
+            self.tokens -= self._tokens.pop()
+            return self._turns.pop()
+        raise IndexError("only the oldest or the newest turn can be removed")
+
+    def clear(self):
+        self.start += len(self._turns)
+        self._turns.clear()
+        self._tokens.clear()
+        self.tokens = 0
+
+    def to_list(self):
+        return list(self._turns)
+
+    def __len__(self) -> int:
+        return len(self._turns)
+
+    def __iter__(self):
+        return iter(self._turns)
+
+    def __getitem__(self, index):
+        return self._turns[index]
+
+    def __repr__(self) -> str:
+        return f"HistoryWindow(start={self.start}, turns={list(self._turns)})"
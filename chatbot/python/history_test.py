@@ -0,0 +1,40 @@
+import json
+import unittest
+import cmd_proc
+import tokenizer
+from history import HistoryWindow
+
+
+def turn(content):
+    return {"role": "user", "content": content}
+
+
+class TestHistoryWindow(unittest.TestCase):
+    def test_running_total(self):
+        history = HistoryWindow([turn("a"), turn("bb")], start=5)
+        expected = tokenizer.message_tokens(turn("a")) + tokenizer.message_tokens(turn("bb"))
+        self.assertEqual(history.tokens, expected)
+        self.assertEqual(history.pop(0), turn("a"))
+        self.assertEqual(history.start, 6)
+        self.assertEqual(history.tokens, tokenizer.message_tokens(turn("bb")))
+        history.clear()
+        self.assertEqual((history.start, history.tokens, len(history)), (7, 0, 0))
+
+    def test_bounded(self):
+        history = HistoryWindow(max_turns=2)
+        for content in "abc":
+            history.append(turn(content))
+        self.assertEqual(history.to_list(), [turn("b"), turn("c")])
+        self.assertEqual(history.start, 1)
+        self.assertEqual(history[-1], turn("c"))
+        self.assertEqual(json.loads(json.dumps(history.to_list())), [turn("b"), turn("c")])
+
+    def test_sys_cmd(self):
+        history = HistoryWindow([turn("a"), turn("b")])
+        history, _ = cmd_proc.SysCmd("POP").process(history)
+        history, _ = cmd_proc.SysCmd("DEL").process(history)
+        self.assertEqual((history.start, len(history), history.tokens), (1, 0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+"""Ready to send inline images.
+
+The drafty IM entity of a photo (resized, encoded and base64'ed) is cached
+by path, modification time and target dimension, in memory and on disk.
+Run this module to pre-render the photos of bots:
+    python image_cache.py photos/AI-yor photos/writer-komi
+"""
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import pathlib
+from concurrent import futures
+from io import BytesIO as memory_io
+
+from PIL import Image
+
+import cache
+import common
+
+_memory = cache.LRUCache(max_entries=256)
+_disk = cache.DiskCache("cache/images", max_entries=10000)
+
+
+def render_image(filename: pathlib.Path, max_dim: int):
+    # Create drafty representation of a message with an inline image.
+    try:
+        im = Image.open(filename, "r")
+        width = im.width
+        height = im.height
+        format = im.format if im.format else "JPEG"
+        if width > max_dim or height > max_dim:
+            # Scale the image
+            scale = min(
+                min(width, max_dim) / width,
+                min(height, max_dim) / height,
+            )
+            width = int(width * scale)
+            height = int(height * scale)
+            resized = im.resize((width, height))
+            im.close()
+            im = resized
+
+        mimetype = "image/" + format.lower()
+        bitbuffer = memory_io()
+        im.save(bitbuffer, format=format)
+        data = base64.b64encode(bitbuffer.getvalue())
+
+        # python3 fix.
+        if type(data) is not str:
+            data = data.decode()
+
+        result = {
+            "txt": " ",
+            "fmt": [{"len": 1}],
+            "ent": [
+                {
+                    "tp": "IM",
+                    "data": {
+                        "val": data,
+                        "mime": mimetype,
+                        "width": width,
+                        "height": height,
+                        "name": filename.name,
+                    },
+                }
+            ],
+        }
+        im.close()
+        return result
+    except IOError as err:
+        logging.error("Failed processing image '%s': %s", filename, err)
+        return None
+
+
+def _cache_key(filename: pathlib.Path, max_dim: int) -> str:
+    # A changed photo gets a new mtime, and so a new key.
+    mtime = filename.stat().st_mtime_ns
+    return hashlib.sha256(
+        f"{filename.resolve()}:{mtime}:{max_dim}".encode("utf-8")
+    ).hexdigest()
+
+
+def get_inline_image(filename: pathlib.Path, max_dim: int = common.MAX_IMAGE_DIM):
+    """Returns the drafty message with the inline image, or None."""
+    filename = pathlib.Path(filename)
+    try:
+        key = _cache_key(filename, max_dim)
+    except OSError as err:
+        logging.error("Failed processing image '%s': %s", filename, err)
+        return None
+    result = _memory.get(key)
+    if result is not None:
+        return result
+    data = _disk.get(key)
+    if data is not None:
+        result = json.loads(data)
+    else:
+        result = render_image(filename, max_dim)
+        if result is None:
+            return None
+        _disk.put(key, json.dumps(result).encode("utf-8"))
+    _memory.put(key, result)
+    return result
+
+
+def cache_stats() -> dict:
+    return {"memory": _memory.stats(), "disk": _disk.stats()}
+
+
+def _warm_one(args) -> bool:
+    filename, max_dim = args
+    try:
+        key = _cache_key(filename, max_dim)
+    except OSError as err:
+        # Deleted since it was listed.
+        logging.warning("Skipping image '%s': %s", filename, err)
+        return False
+    if _disk.get(key) is not None:
+        return False
+    result = render_image(filename, max_dim)
+    if result is not None:
+        _disk.put(key, json.dumps(result).encode("utf-8"))
+    return result is not None
+
+
+def warm_up(photos_root, max_dim: int = common.MAX_IMAGE_DIM, workers: int = None) -> int:
+    """Renders every photo under photos_root/lv* in parallel.
+    Returns the number of newly rendered photos."""
+    photos = [
+        (photo, max_dim)
+        for level_path in sorted(pathlib.Path(photos_root).glob("lv*"))
+        for photo in sorted(level_path.iterdir())
+        if photo.is_file()
+    ]
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(_warm_one, photos, chunksize=8))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-render the photos of bots.")
+    parser.add_argument("photos_roots", nargs="+", type=pathlib.Path)
+    parser.add_argument("--max-dim", default=common.MAX_IMAGE_DIM, type=int)
+    parser.add_argument("--workers", default=None, type=int)
+    args = parser.parse_args()
+    for photos_root in args.photos_roots:
+        count = warm_up(photos_root, args.max_dim, args.workers)
+        print(f"{photos_root}: rendered {count} photos")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import os
+import pathlib
+import tempfile
+import unittest
+from PIL import Image
+import cache
+import image_cache
+
+
+class TestImageCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.folder.name)
+        self.caches = image_cache._memory, image_cache._disk
+        image_cache._memory = cache.LRUCache(max_entries=4)
+        image_cache._disk = cache.DiskCache(self.root / "cache")
+        self.photo = self.root / "photo.png"
+        Image.new("RGB", (40, 20), "red").save(self.photo)
+
+    def tearDown(self):
+        image_cache._memory, image_cache._disk = self.caches
+        self.folder.cleanup()
+
+    def test_inline_image(self):
+        result = image_cache.get_inline_image(self.photo, max_dim=10)
+        data = result["ent"][0]["data"]
+        self.assertEqual((data["width"], data["height"], data["mime"]), (10, 5, "image/png"))
+        # Rendered once, then read from memory
+        self.assertIs(image_cache.get_inline_image(self.photo, max_dim=10), result)
+        # and from the disk by another worker.
+        image_cache._memory = cache.LRUCache(max_entries=4)
+        self.assertEqual(image_cache.get_inline_image(self.photo, max_dim=10), result)
+        self.assertEqual(image_cache._disk.stats()["hits"], 1)
+        # A changed photo is rendered again.
+        Image.new("RGB", (20, 20), "blue").save(self.photo)
+        os.utime(self.photo, ns=(0, 0))
+        data = image_cache.get_inline_image(self.photo, max_dim=10)["ent"][0]["data"]
+        self.assertEqual((data["width"], data["height"]), (10, 10))
+
+    def test_missing_photo(self):
+        self.assertIsNone(image_cache.get_inline_image(self.root / "gone.png"))
+
+    def test_warm_one(self):
+        self.assertTrue(image_cache._warm_one((self.photo, 10)))
+        # Already on disk.
+        self.assertFalse(image_cache._warm_one((self.photo, 10)))
+        # Deleted between the listing and the rendering.
+        self.assertFalse(image_cache._warm_one((self.root / "gone.png", 10)))
+
+
+if __name__ == "__main__":
+    unittest.main()
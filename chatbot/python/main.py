@@ -5,11 +5,29 @@ import utils
 import logging
 import datetime
 from chatbot import ChatBot
+from aio_chatbot import AsyncChatBot
 
 def run(args):
     robot_name = args.login_basic.split(":")[0]
     robot_pass = args.login_basic.split(":")[1]
-    chatBot = ChatBot(robot_name, robot_pass ,args.photos_root)
+    bot_class = AsyncChatBot if args.aio else ChatBot
+    chatBot = bot_class(
+        robot_name,
+        robot_pass,
+        args.photos_root,
+        workers=args.workers,
+        worker_queue_size=args.worker_queue_size,
+        coalesce_window=args.coalesce_window,
+        llm_concurrency=args.llm_concurrency,
+        llm_rpm=args.llm_rpm,
+        llm_tpm=args.llm_tpm,
+        metrics_listen=args.metrics_listen,
+        max_topics=args.max_topics,
+        plugin_listen=args.listen if args.plugin else "",
+        plugin_workers=args.plugin_workers,
+        firehose=args.firehose,
+        warm_up=not args.no_warm_up,
+    )
     chatBot.run(args.host)
 
 
@@ -59,6 +77,79 @@ def main():
         type=pathlib.Path,
         help="root directory for storing aigirls' photos",
     )
+    parser.add_argument(
+        "--workers",
+        default=4,
+        type=int,
+        help="number of worker processes handling chat messages",
+    )
+    parser.add_argument(
+        "--worker-queue-size",
+        default=64,
+        type=int,
+        help="maximum number of messages waiting for each worker",
+    )
+    parser.add_argument(
+        "--coalesce-window",
+        default=0.0,
+        type=float,
+        help="seconds to wait for more lines from a user before replying",
+    )
+    parser.add_argument(
+        "--llm-concurrency",
+        default=8,
+        type=int,
+        help="maximum number of LLM calls in progress",
+    )
+    parser.add_argument(
+        "--llm-rpm",
+        default=3500,
+        type=float,
+        help="LLM requests per minute allowed by the provider",
+    )
+    parser.add_argument(
+        "--llm-tpm",
+        default=90000,
+        type=float,
+        help="LLM tokens per minute allowed by the provider",
+    )
+    parser.add_argument(
+        "--metrics-listen",
+        default="127.0.0.1:9108",
+        help="address serving the Prometheus /metrics page, empty to disable",
+    )
+    parser.add_argument(
+        "--max-topics",
+        default=10000,
+        type=int,
+        help="topics attached at most, the least recently active ones are left",
+    )
+    parser.add_argument(
+        "--plugin",
+        action="store_true",
+        help="take the messages pushed by the server to the Plugin API at --listen",
+    )
+    parser.add_argument(
+        "--firehose",
+        action="store_true",
+        help="with --plugin, take the users' messages from the Plugin API FireHose before they are stored",
+    )
+    parser.add_argument(
+        "--no-warm-up",
+        action="store_true",
+        help="with --plugin, don't attach to the topics of new users before their first message",
+    )
+    parser.add_argument(
+        "--plugin-workers",
+        default=16,
+        type=int,
+        help="threads handling the Plugin API calls",
+    )
+    parser.add_argument(
+        "--aio",
+        action="store_true",
+        help="run the asyncio engine built on grpc.aio",
+    )
     args = parser.parse_args()
 
     run(args)
@@ -1,82 +1,370 @@
 '''Robot manager module.'''
 
 from chatbot import ChatBot
+from bot_host import BotHost
+import argparse
+import fnmatch
+import logging
 import os
 import pathlib
 import json
 import multiprocessing
-import redis
+import signal
+import threading
+import time
+import traceback
+import zlib
+import db
+import metrics
 import utils
 
-def run_robot(name, password, photos_root, host):
+# Seconds between two scans of the robots, notifications trigger a scan
+# earlier.
+RESCAN_INTERVAL = 60
+# Seconds before restarting a crashed robot, doubled after each crash up
+# to RESTART_MAX_DELAY.
+RESTART_DELAY = 1
+RESTART_MAX_DELAY = 300
+# A robot running that long is healthy again, its next crash is restarted
+# after RESTART_DELAY.
+STABLE_AFTER = 600
+
+def run_robot(name, password, photos_root, host, coalesce_window=0.0):
+    # The robots of the manager run without a Plugin server: they attach
+    # to the topics of the users on their {pres}, the ones of new users
+    # are not warmed up. Run main.py --plugin for that.
     os.environ["GRPC_SSL_CIPHER_SUITES"] = "HIGH+ECDSA"
     utils.config_logging()
     print("Starting robot: ", name, password, photos_root, host)
-    chatBot = ChatBot(name,password,photos_root)
+    chatBot = ChatBot(
+        name, password, photos_root, coalesce_window=coalesce_window)
     chatBot.run(host)
 
+def run_host(robots, host, bot_limit=8):
+    # No Plugin server either, so no warm_up_bots, see run_robot.
+    os.environ["GRPC_SSL_CIPHER_SUITES"] = "HIGH+ECDSA"
+    utils.config_logging()
+    print("Starting host of robots: ", [robot['name'] for robot in robots], host)
+    bot_host = BotHost(
+        host,
+        bot_limit=bot_limit,
+        name="host-" + robots[0]['name'],
+    )
+    for robot in robots:
+        bot_host.add_bot(
+            robot['name'],
+            robot['password'],
+            robot['photos_root'],
+            coalesce_window=robot['coalesce_window'],
+        )
+    bot_host.run()
+
+def _run_unit(key, errors, target, args):
+    # Reports why the robot process died to the manager.
+    try:
+        target(*args)
+    except SystemExit as e:
+        if e.code:
+            errors.put((key, f"exit({e.code})"))
+        raise
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        errors.put((key, repr(e)))
+        raise
+
 def parse_json_str_to_dict(json_str: str)->dict:
     try:
         return json.loads(json_str)
     except Exception as e:
         return json_str
 
+def parse_robot(raw: bytes):
+    '''Returns the robot of a definition of db 6, None if it is not a robot
+    the manager can log in.'''
+    robot = parse_json_str_to_dict(raw.decode('utf-8'))
+    if not isinstance(robot, dict) or 'name' not in robot or 'password' not in robot:
+        return None
+    return {
+        'name': robot['name'],
+        'password': robot['password'],
+        'photos_root': pathlib.Path(robot.get('photos_root', "")),
+        # Seconds to wait for more lines from a user before replying.
+        'coalesce_window': float(robot.get('coalesce_window', 0.0)),
+    }
+
+def restart_delay(failures: int) -> float:
+    '''Seconds to wait before the restart after failures crashes in a row.'''
+    return min(RESTART_MAX_DELAY, RESTART_DELAY * 2 ** max(0, failures - 1))
+
+def plan_units(robots: dict, processes: int) -> dict:
+    '''Returns {unit key: [robot, ...]}, the processes running the robots.
+    Each robot runs alone, or in the host its name is hashed to.'''
+    units = {}
+    for name in sorted(robots):
+        if processes > 0:
+            key = f"host-{zlib.crc32(name.encode('utf-8')) % processes}"
+        else:
+            key = name
+        units.setdefault(key, []).append(robots[name])
+    return units
+
+
+class Unit(object):
+    '''A supervised process running one robot, or the robots of a host.'''
+
+    def __init__(self, key, robots):
+        self.key = key
+        self.robots = robots
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+        # Crashes since the unit last ran for STABLE_AFTER seconds.
+        self.failures = 0
+        self.last_error = None
+        # Whether the running process reported its error.
+        self.reported = False
+        self.last_exit_at = None
+        # Time of the next start after a crash.
+        self.start_at = 0.0
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def status(self) -> dict:
+        now = time.time()
+        return {
+            'robots': [robot['name'] for robot in self.robots],
+            'pid': self.process.pid if self.alive() else None,
+            'alive': self.alive(),
+            'uptime': now - self.started_at if self.alive() else 0.0,
+            'restarts': self.restarts,
+            'last_error': self.last_error,
+            'last_exit_at': self.last_exit_at,
+            'restart_in': max(0.0, self.start_at - now) if not self.alive() else 0.0,
+        }
 
 
 class RobotManager(object):
-    '''Robot manager class.'''
+    '''Robot manager class.
+
+    Finds the robots in Redis db 6, starts and stops their processes as
+    robots are added and removed, and restarts crashed ones with an
+    exponential backoff. Robots are rescanned every rescan_interval
+    seconds, and right away when a definition changes if Redis publishes
+    keyspace notifications or the writer publishes to db.BOTS_CHANNEL.
+    '''
 
-    def __init__(self):
+    def __init__(self, processes=0, bot_limit=8, robot_filter=None,
+                 rescan_interval=RESCAN_INTERVAL, status_listen=""):
         self.host = "47.103.17.145:16060"
+        # Processes hosting the robots, 0 runs each robot in its own process.
+        self.processes = processes
+        self.bot_limit = bot_limit
+        # Name patterns of the robots to run, None for all.
+        self.robot_filter = robot_filter
+        self.rescan_interval = rescan_interval
+        # "host:port" serving /status and /metrics, empty for none.
+        self.status_listen = status_listen
+        self.status_server = None
         self.all_robots = []
+        # {unit key: Unit}
+        self.units = {}
+        self.errors = multiprocessing.Queue()
+        self.changed = threading.Event()
+        self.stopping = threading.Event()
+        self._lock = threading.Lock()
         self.query_robots()
-        print(self.all_robots)
-    
+        print([robot['name'] for robot in self.all_robots])
+
     def query_robots(self):
-        with redis.Redis(
-            host="47.103.17.145", port=8010, db=6, password="godword"
-        ) as redis_db:
-            for key in redis_db.keys():
-                key_str = key.decode('utf-8')
-                if key_str == 'INITIAL_ROBOTS':
-                    continue
-                if key_str != "assistant" and key_str != "wukong":
+        robots = []
+        for key, raw in db.scan_bots().items():
+            if key == 'INITIAL_ROBOTS':
+                continue
+            if self.robot_filter and not any(
+                    fnmatch.fnmatchcase(key, pattern) for pattern in self.robot_filter):
+                continue
+            robot = parse_robot(raw)
+            if robot is None:
+                logging.debug("Skipped %s, not a robot", key)
+                continue
+            robots.append(robot)
+        self.all_robots = robots
+        return robots
+
+    def watch(self):
+        '''Sets self.changed when a robot definition changes.'''
+        while not self.stopping.is_set():
+            try:
+                pubsub = db.get_redis(db.BOT_DB).pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(db.BOTS_CHANNEL)
+                pubsub.psubscribe(f"__keyspace@{db.BOT_DB}__:*")
+                while not self.stopping.is_set():
+                    if pubsub.get_message(timeout=1.0) is not None:
+                        self.changed.set()
+            except Exception as e:
+                logging.warning("Robot notifications unavailable: %s", e)
+                self.stopping.wait(self.rescan_interval)
+
+    def sync(self):
+        '''Starts the units of new robots, stops the ones of removed robots
+        and restarts the units whose robots changed.'''
+        try:
+            self.query_robots()
+        except Exception as e:
+            logging.error("Failed to scan the robots: %s", e)
+            return
+        planned = plan_units({robot['name']: robot for robot in self.all_robots}, self.processes)
+        with self._lock:
+            for key in [key for key in self.units if key not in planned]:
+                logging.info("Stopping %s, its robots are gone", key)
+                self._stop_unit(self.units.pop(key))
+            for key, robots in planned.items():
+                unit = self.units.get(key)
+                if unit is not None and unit.robots == robots:
                     continue
-                robot = parse_json_str_to_dict(redis_db.get(key).decode('utf-8'))
-                if 'photos_root' not in robot:
-                    robot['photos_root'] = ""
-                self.all_robots.append({
-                    'name': robot['name'],
-                    'password': robot['password'],
-                    'photos_root': pathlib.Path(robot['photos_root']),
-                })
+                if unit is not None:
+                    logging.info("Restarting %s, its robots changed", key)
+                    self._stop_unit(unit)
+                    unit.robots = robots
+                    unit.start_at = 0.0
+                else:
+                    unit = self.units[key] = Unit(key, robots)
+                self._start_unit(unit)
 
-    def start(self):
-        self.processors = []
-        for robot in self.all_robots:
-            processor = multiprocessing.Process(
-                target=run_robot,
-                args=(
-                    robot['name'],
-                    robot['password'],
-                    robot['photos_root'],
-                    self.host,
-                ),
+    def _start_unit(self, unit):
+        if self.processes > 0:
+            target, args = run_host, (unit.robots, self.host, self.bot_limit)
+        else:
+            robot = unit.robots[0]
+            target, args = run_robot, (
+                robot['name'],
+                robot['password'],
+                robot['photos_root'],
+                self.host,
+                robot['coalesce_window'],
             )
-            self.processors.append(processor)
-            processor.start()
-        # Wait for all process to finish
-        for processor in self.processors:
-            processor.join()
+        unit.process = multiprocessing.Process(
+            target=_run_unit, args=(unit.key, self.errors, target, args), name=unit.key)
+        unit.process.start()
+        unit.started_at = time.time()
+        unit.reported = False
+        logging.info("Started %s (pid %d)", unit.key, unit.process.pid)
 
+    def _stop_unit(self, unit, timeout=10):
+        if not unit.alive():
+            return
+        unit.process.terminate()
+        unit.process.join(timeout)
+        if unit.process.is_alive():
+            unit.process.kill()
+            unit.process.join()
+
+    def supervise(self):
+        '''Restarts the crashed units once their backoff delay is over.'''
+        while True:
+            try:
+                key, error = self.errors.get_nowait()
+            except Exception:
+                break
+            unit = self.units.get(key)
+            if unit is not None:
+                unit.last_error = error
+                unit.reported = True
+        now = time.time()
+        with self._lock:
+            for unit in self.units.values():
+                if unit.alive():
+                    continue
+                if unit.process is not None:
+                    # Crashed since the last check.
+                    exitcode = unit.process.exitcode
+                    unit.process = None
+                    unit.last_exit_at = now
+                    if not unit.reported:
+                        unit.last_error = f"exit code {exitcode}"
+                    if now - unit.started_at >= STABLE_AFTER:
+                        unit.failures = 0
+                    unit.failures += 1
+                    unit.start_at = now + restart_delay(unit.failures)
+                    metrics.inc("robot_crashes", unit=unit.key)
+                    logging.error("%s exited with code %s, restarting in %.0f seconds",
+                                  unit.key, exitcode, unit.start_at - now)
+                if now >= unit.start_at:
+                    unit.restarts += 1
+                    self._start_unit(unit)
+
+    def status(self) -> dict:
+        '''Returns {unit key: status} of the robot processes.'''
+        with self._lock:
+            return {key: unit.status() for key, unit in self.units.items()}
+
+    def start(self):
+        if self.status_listen:
+            try:
+                self.status_server = metrics.serve(self.status_listen, status=self.status)
+            except OSError as e:
+                logging.error("Failed to serve status at %s: %s", self.status_listen, e)
+        metrics.gauge("robots", lambda: len(self.all_robots))
+        threading.Thread(target=self.watch, name="robot-watch", daemon=True).start()
+        self.sync()
+        next_scan = time.monotonic() + self.rescan_interval
+        while not self.stopping.is_set():
+            if self.changed.wait(1.0) or time.monotonic() >= next_scan:
+                self.changed.clear()
+                self.sync()
+                next_scan = time.monotonic() + self.rescan_interval
+            self.supervise()
+        with self._lock:
+            for unit in self.units.values():
+                self._stop_unit(unit)
 
     def stop(self):
-        pass
+        self.stopping.set()
 
 
 def main():
-    manager = RobotManager()
+    utils.config_logging()
+    parser = argparse.ArgumentParser(description="Runs the robots stored in Redis.")
+    parser.add_argument(
+        "--processes",
+        default=0,
+        type=int,
+        help="processes hosting the robots, 0 to run each robot in its own process",
+    )
+    parser.add_argument(
+        "--bot-limit",
+        default=8,
+        type=int,
+        help="messages and LLM calls of a hosted robot in progress at most",
+    )
+    parser.add_argument(
+        "--robots",
+        default="",
+        help="comma separated name patterns of the robots to run, all by default",
+    )
+    parser.add_argument(
+        "--rescan-interval",
+        default=RESCAN_INTERVAL,
+        type=float,
+        help="seconds between two scans of the robots",
+    )
+    parser.add_argument(
+        "--status-listen",
+        default="127.0.0.1:9100",
+        help="address serving the robot /status page, empty to disable",
+    )
+    args = parser.parse_args()
+    manager = RobotManager(
+        args.processes,
+        args.bot_limit,
+        [pattern for pattern in args.robots.split(",") if pattern] or None,
+        args.rescan_interval,
+        args.status_listen,
+    )
+    signal.signal(signal.SIGTERM, lambda signo, frame: manager.stop())
+    signal.signal(signal.SIGINT, lambda signo, frame: manager.stop())
     manager.start()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,75 @@
+import pathlib
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import db
+import manager
+
+DIR = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(DIR / "bench"))
+sys.path.insert(0, str(DIR / "tools"))
+import fake_redis  # noqa: E402
+import persona_db_helper  # noqa: E402
+
+
+def robot(name):
+    return {'name': name, 'password': 'p', 'photos_root': '', 'coalesce_window': 0.0}
+
+
+class TestManager(unittest.TestCase):
+    def test_parse_robot(self):
+        self.assertEqual(manager.parse_robot(b'{"name": "a", "password": "p"}')['name'], 'a')
+        # Persona definitions without a login are not robots.
+        self.assertIsNone(manager.parse_robot(b'{"name": "a"}'))
+        self.assertIsNone(manager.parse_robot(b'not json'))
+
+    def test_plan_units(self):
+        robots = {name: robot(name) for name in ('a', 'b', 'c')}
+        self.assertEqual(sorted(manager.plan_units(robots, 0)), ['a', 'b', 'c'])
+        hosts = manager.plan_units(robots, 2)
+        self.assertEqual(sum(len(robots) for robots in hosts.values()), 3)
+        # A robot stays on its host when others are added.
+        robots['d'] = robot('d')
+        for key, hosted in hosts.items():
+            for hosted_robot in hosted:
+                self.assertIn(hosted_robot, manager.plan_units(robots, 2)[key])
+
+    def test_restart_delay(self):
+        delays = [manager.restart_delay(failures) for failures in range(1, 5)]
+        self.assertEqual(delays, [1, 2, 4, 8])
+        self.assertEqual(manager.restart_delay(100), manager.RESTART_MAX_DELAY)
+
+    def test_watch_bot_updates(self):
+        config = dict(db._config)
+        server = fake_redis.FakeRedis()
+        db.configure(host="127.0.0.1", port=server.start(), password=None)
+        connect_bot_db = persona_db_helper.connect_bot_db
+        persona_db_helper.connect_bot_db = lambda: db.get_redis(db.BOT_DB)
+        robots = manager.RobotManager(rescan_interval=60)
+        watcher = threading.Thread(target=robots.watch, daemon=True)
+        folder = tempfile.TemporaryDirectory()
+        yaml_file = pathlib.Path(folder.name) / "persona.yaml"
+        yaml_file.write_text("bot:\n  name: bot\n  password: p\n", encoding="utf-8")
+        try:
+            watcher.start()
+            deadline = time.monotonic() + 5
+            while db.BOTS_CHANNEL.encode() not in server.store.channels:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+            # The helper's publish wakes the manager before the next scan.
+            persona_db_helper.load_yaml_to_redis(str(yaml_file))
+            self.assertTrue(robots.changed.wait(5))
+        finally:
+            robots.stopping.set()
+            watcher.join(5)
+            persona_db_helper.connect_bot_db = connect_bot_db
+            folder.cleanup()
+            db.configure(**config)
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,230 @@
+"""Latency histograms, counters and gauges.
+
+Every process keeps its own values. Workers write them to a snapshot file
+with start_reporter(), the bot process adds up the snapshots of all its
+processes and serves them in the Prometheus text format with serve().
+"""
+import bisect
+import contextlib
+import http.server
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+
+# Upper bounds of the latency buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Seconds between two snapshots of a worker.
+REPORT_INTERVAL = 5
+
+_lock = threading.Lock()
+# {name: {"count": int, "total": float, "max": float}}, times in seconds.
+_latency = {}
+# {name: [count of each bucket and +Inf]}, not cumulative.
+_buckets = {}
+# {(name, ((label, value), ...)): float}
+_counters = {}
+# {name: function returning the current value}, read when served.
+_gauges = {}
+
+
+def observe(name: str, seconds: float):
+    with _lock:
+        stat = _latency.get(name)
+        if stat is None:
+            stat = {"count": 0, "total": 0.0, "max": 0.0}
+            _latency[name] = stat
+            _buckets[name] = [0] * (len(BUCKETS) + 1)
+        stat["count"] += 1
+        stat["total"] += seconds
+        if seconds > stat["max"]:
+            stat["max"] = seconds
+        _buckets[name][bisect.bisect_left(BUCKETS, seconds)] += 1
+
+
+@contextlib.contextmanager
+def timed(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def inc(name: str, value: float = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge(name: str, func):
+    """Reports func() as the value of name, in this process only."""
+    with _lock:
+        _gauges[name] = func
+
+
+def reset():
+    """Forgets all values, a forked process must not report its parent's."""
+    with _lock:
+        _latency.clear()
+        _buckets.clear()
+        _counters.clear()
+        _gauges.clear()
+
+
+def latency_stats() -> dict:
+    with _lock:
+        return {name: dict(stat) for name, stat in _latency.items()}
+
+
+def snapshot() -> dict:
+    with _lock:
+        return {
+            "latency": {name: dict(stat) for name, stat in _latency.items()},
+            "buckets": {name: list(counts) for name, counts in _buckets.items()},
+            "counters": [[name, dict(labels), value] for (name, labels), value in _counters.items()],
+        }
+
+
+def _write_snapshot(folder: pathlib.Path):
+    path = folder / f"{os.getpid()}.json"
+    tmp_path = path.with_suffix(".tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot(), f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.error("Failed to write metrics snapshot %s: %s", path, e)
+
+
+def start_reporter(folder):
+    """Writes the values of this process to folder every REPORT_INTERVAL
+    seconds. Returns a function writing them immediately."""
+    folder = pathlib.Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+
+    def report():
+        while True:
+            time.sleep(REPORT_INTERVAL)
+            _write_snapshot(folder)
+
+    threading.Thread(target=report, name="metrics", daemon=True).start()
+    return lambda: _write_snapshot(folder)
+
+
+def clear_snapshots(folder):
+    """Removes the snapshots of earlier runs."""
+    folder = pathlib.Path(folder)
+    for path in folder.glob("*.json"):
+        path.unlink(missing_ok=True)
+
+
+def aggregate(folder=None) -> dict:
+    """Adds up the values of this process and the snapshots in folder.
+    The snapshots of exited workers are kept, so counters never go back."""
+    snapshots = [snapshot()]
+    if folder is not None:
+        own = f"{os.getpid()}.json"
+        for path in pathlib.Path(folder).glob("*.json"):
+            if path.name == own:
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError) as e:
+                logging.error("Failed to read metrics snapshot %s: %s", path, e)
+    total = {"latency": {}, "buckets": {}, "counters": {}}
+    for data in snapshots:
+        for name, stat in data["latency"].items():
+            merged = total["latency"].setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+            merged["count"] += stat["count"]
+            merged["total"] += stat["total"]
+            merged["max"] = max(merged["max"], stat["max"])
+        for name, counts in data["buckets"].items():
+            merged = total["buckets"].setdefault(name, [0] * len(counts))
+            for i, count in enumerate(counts):
+                merged[i] += count
+        for name, labels, value in data["counters"]:
+            key = (name, tuple(sorted(labels.items())))
+            total["counters"][key] = total["counters"].get(key, 0) + value
+    return total
+
+
+def _labels(pairs) -> str:
+    if not pairs:
+        return ""
+    text = ",".join(
+        '%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in pairs
+    )
+    return "{" + text + "}"
+
+
+def prometheus_text(folder=None, prefix: str = "chatbot") -> str:
+    total = aggregate(folder)
+    lines = [
+        f"# HELP {prefix}_latency_seconds Latency of each stage.",
+        f"# TYPE {prefix}_latency_seconds histogram",
+    ]
+    for name in sorted(total["latency"]):
+        stat = total["latency"][name]
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), total["buckets"][name]):
+            cumulative += count
+            labels = _labels((("stage", name), ("le", bound)))
+            lines.append(f"{prefix}_latency_seconds_bucket{labels} {cumulative}")
+        labels = _labels((("stage", name),))
+        lines.append(f"{prefix}_latency_seconds_sum{labels} {stat['total']}")
+        lines.append(f"{prefix}_latency_seconds_count{labels} {stat['count']}")
+    families = sorted({name for name, _ in total["counters"]})
+    for family in families:
+        lines.append(f"# TYPE {prefix}_{family}_total counter")
+        for (name, labels), value in sorted(total["counters"].items()):
+            if name == family:
+                lines.append(f"{prefix}_{name}_total{_labels(labels)} {value}")
+    with _lock:
+        gauges = dict(_gauges)
+    for name in sorted(gauges):
+        try:
+            value = gauges[name]()
+        except Exception as e:
+            logging.error("Failed to read gauge %s: %s", name, e)
+            continue
+        lines.append(f"# TYPE {prefix}_{name} gauge")
+        lines.append(f"{prefix}_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def serve(listen: str, folder=None, prefix: str = "chatbot", status=None):
+    """Serves GET /metrics on listen ("host:port") from a thread, and GET
+    /status as the JSON returned by status() if given.
+    Returns the server, shut it down with server.shutdown()."""
+    host, port = listen.rsplit(":", 1)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = prometheus_text(folder, prefix).encode("utf-8")
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path == "/status" and status is not None:
+                body = json.dumps(status(), ensure_ascii=False).encode("utf-8")
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("metrics: " + format, *args)
+
+    server = http.server.ThreadingHTTPServer((host, int(port)), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logging.info("Metrics served at http://%s/metrics", listen)
+    return server
@@ -0,0 +1,63 @@
+import json
+import multiprocessing
+import os
+import pathlib
+import tempfile
+import unittest
+import urllib.request
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_aggregate_snapshots(self):
+        metrics.observe("test.stage", 0.2)
+        metrics.inc("test_messages", mime="text/plain")
+        with tempfile.TemporaryDirectory() as folder:
+            # A worker's snapshot.
+            worker = metrics.snapshot()
+            (pathlib.Path(folder) / "1.json").write_text(json.dumps(worker))
+            total = metrics.aggregate(folder)
+            self.assertEqual(
+                total["latency"]["test.stage"]["count"],
+                2 * metrics.latency_stats()["test.stage"]["count"],
+            )
+            own = metrics.aggregate()["counters"]
+            key = ("test_messages", (("mime", "text/plain"),))
+            self.assertEqual(total["counters"][key], 2 * own[key])
+
+    def test_forked_reporter(self):
+        metrics.inc("test_forked")
+        key = ("test_forked", ())
+        with tempfile.TemporaryDirectory() as folder:
+            def worker():
+                metrics.reset()
+                metrics.inc("test_forked")
+                metrics.start_reporter(folder)()
+                os._exit(0)
+
+            process = multiprocessing.get_context("fork").Process(target=worker)
+            process.start()
+            process.join()
+            own = metrics.aggregate()["counters"][key]
+            # The parent's count once, and the worker's own.
+            self.assertEqual(metrics.aggregate(folder)["counters"][key], own + 1)
+
+    def test_serve(self):
+        metrics.observe("test.served", 0.3)
+        metrics.inc("test_errors", key="INTERNAL_ERROR")
+        metrics.gauge("test_depth", lambda: 3)
+        server = metrics.serve("127.0.0.1:0")
+        try:
+            host, port = server.server_address
+            with urllib.request.urlopen(f"http://{host}:{port}/metrics") as response:
+                text = response.read().decode("utf-8")
+        finally:
+            server.shutdown()
+        self.assertIn('chatbot_latency_seconds_bucket{stage="test.served",le="0.5"} 1', text)
+        self.assertIn('chatbot_latency_seconds_bucket{stage="test.served",le="+Inf"} 1', text)
+        self.assertIn('chatbot_test_errors_total{key="INTERNAL_ERROR"} 1', text)
+        self.assertIn("chatbot_test_depth 3", text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,3 @@
-import time
 import io
 import os
 import logging
@@ -13,6 +12,14 @@ import json
 import db
 import traceback
 import common
+import cmd_proc
+import cache
+import hashlib
+import metrics
+import admission
+import bot_cache
+import quota
+import pathlib
 
 
 def note_read(topic, seq):
@@ -53,6 +60,12 @@ def _recover_multiple_lines(json_msg):
     return json_msg
     
 
+def error_msg(key: str, tid, topic):
+    """Returns the {pub} of the common message key, counted as an error."""
+    metrics.inc("errors", key=key)
+    return publish_msg(common.COMMON_MSG[key], tid, topic)
+
+
 def _parse_msg(msg:str):
     # Check if msg is json string or complain string
     try:
@@ -61,79 +74,71 @@ def _parse_msg(msg:str):
         # This is not json string, just return the string
         return msg
 
-def process_audio(msg_data):
-    logging.debug("process_audio: %s", utils.clip_long_string(msg_data))
-    openai.api_key = utils.read_from_file("openai.key").strip()
-    byte_str_decoded = base64.b64decode(msg_data['val'])
+# Transcripts by the sha256 of the audio, forwarded voice notes are
+# transcribed once.
+_transcripts = cache.LRUCache(max_entries=1024)
+_transcripts_on_disk = cache.DiskCache("cache/transcripts", max_entries=100000)
 
-    file_name = msg_data['name']
-    with open(file_name, 'wb') as f:
-        f.write(byte_str_decoded)
 
-    with open(file_name, 'rb') as audio_file:
-        transcript = openai.Audio.transcribe("whisper-1", audio_file)
+def process_audio(msg_data, user=None, vip_user: bool = False):
+    logging.debug("process_audio: %s", utils.Lazy(utils.clip_long_string, msg_data))
+    with metrics.timed("audio.decode"):
+        byte_str_decoded = base64.b64decode(msg_data['val'])
+    digest = hashlib.sha256(byte_str_decoded).hexdigest()
 
-    os.remove(file_name)
-    logging.debug("Transcribed audio text: %s",transcript["text"])
-    return transcript["text"]
+    text = _transcripts.get(digest)
+    if text is None:
+        cached = _transcripts_on_disk.get(digest)
+        if cached is not None:
+            text = cached.decode("utf-8")
+            _transcripts.put(digest, text)
+    if text is not None:
+        logging.debug("Cached audio text: %s", text)
+        return text
 
-def process_chat(
-    msg,
-    tid,
-    queue_out,
-    bot_name,
-    photos_root,
-):
-    utils.config_logging(
-        logfile_name=f"{bot_name}_{msg.data.from_user_id}_{msg.data.topic}.log"
-    )
-    if msg == None:
-        return
-
-    # Respond to message.
-    # Mark received message as read.
-    queue_out.put(note_read(msg.data.topic, msg.data.seq_id))
-    # Notify user that we are responding.
-    queue_out.put(typing_reply(msg.data.topic))
-    # # Insert a small delay to prevent accidental DoS self-attack.
-    time.sleep(0.1)
-
-    ttl_valid, tokens_left = db.get_user_validity(msg.data.from_user_id)
-    if not ttl_valid:
-        # Respond with with chat persona for this topic.
-        queue_out.put(
-            publish_msg(common.COMMON_MSG["USER_TTL_INVALID"], tid, msg.data.topic)
-        )
-        return
+    # The API tells the format by the file name, no file is written.
+    audio_file = io.BytesIO(byte_str_decoded)
+    audio_file.name = pathlib.Path(msg_data.get('name') or "audio.m4a").name
+    openai.api_key = utils.openai_api_key()
+    with admission.slot(user, vip_user, 0), metrics.timed("audio.transcribe"):
+        transcript = openai.Audio.transcribe("whisper-1", audio_file)
+    text = transcript["text"]
+    _transcripts.put(digest, text)
+    _transcripts_on_disk.put(digest, text.encode("utf-8"))
+    logging.debug("Transcribed audio text: %s", text)
+    return text
 
-    if tokens_left['times'] <=0 and tokens_left['tokens'] <=0:
-        queue_out.put(
-            publish_msg(common.COMMON_MSG["USER_TOKEN_INVALID"], tid, msg.data.topic)
-        )
-        return
-    
-    vip_user:bool = str(tokens_left['type']).lower() == 'vip'
-    
+def _extract_text(msg, tid, queue_out, vip_user: bool):
+    """Returns the text of the {data} message, or None if the message
+    cannot be answered. In that case the user is already notified."""
     parsed_content = _parse_msg(msg.data.content.decode("utf-8").strip('"'))
-    logging.info("Received message: %s", utils.clip_long_string(parsed_content))
+    logging.info(
+        "Received message: %s",
+        utils.Lazy(utils.clip_long_string, parsed_content),
+        extra={"category": "msg.text"},
+    )
+    if not isinstance(parsed_content, dict):
+        metrics.inc("messages", mime="text/plain")
     if (isinstance(parsed_content, dict)):
         # Content is a json string
         try:
             mime: str = parsed_content['ent'][0]['data']['mime']
             logging.debug("Mime type: %s", mime)
+            metrics.inc("messages", mime=mime)
             if mime.startswith('audio/'):
                 if not vip_user:
                     queue_out.put(
-                        publish_msg(common.COMMON_MSG["AUDIO_MSG_NOT_SUPPORTED"], tid, msg.data.topic)
+                        error_msg("AUDIO_MSG_NOT_SUPPORTED", tid, msg.data.topic)
                     )
-                    return
+                    return None
                 try:
-                    msg_str = process_audio(parsed_content['ent'][0]['data'])
+                    msg_str = process_audio(
+                        parsed_content['ent'][0]['data'], msg.data.from_user_id, vip_user)
                     if msg_str.strip() == "":
                         queue_out.put(
-                            publish_msg(common.COMMON_MSG["AUDIO_MSG_NOT_RECOGNISED"], tid, msg.data.topic)
+                            error_msg("AUDIO_MSG_NOT_RECOGNISED", tid, msg.data.topic)
                         )
-                        return
+                        return None
                     else:
                         queue_out.put(
                             publish_msg(f"正在回复：“{msg_str}”...", tid, msg.data.topic)
@@ -142,47 +147,168 @@ def process_chat(
                         parsed_content = msg_str
                 except Exception as e:
                     logging.error("Failed to process audio with exception %s",e)
-                    return
+                    return None
             elif mime.startswith('image/'):
                 queue_out.put(
-                    publish_msg(common.COMMON_MSG["IMAGE_MSG_NOT_SUPPORTED"], tid, msg.data.topic)
+                    error_msg("IMAGE_MSG_NOT_SUPPORTED", tid, msg.data.topic)
                 )
-                return
+                return None
             elif mime == 'text/x-drafty':
                 # Supported now
                 pass
             else:
                 queue_out.put(
-                    publish_msg(common.COMMON_MSG["MESSAGE_NOT_SUPPORTED"], tid, msg.data.topic)
+                    error_msg("MESSAGE_NOT_SUPPORTED", tid, msg.data.topic)
                 )
-                return
+                return None
         except Exception as e:
             logging.error("Failed to parse mime type from: %s with exception %s", utils.clip_long_string(parsed_content),e)
 
-    msg_str = _recover_multiple_lines(parsed_content)
+    return _recover_multiple_lines(parsed_content)
 
-    logging.info("%s: User %s is valid", bot_name, msg.data.from_user_id)
-    if not vip_user:
-        # 免费用户延迟访问
-        time.sleep(2)
 
-    chat_persona = CreatePersona(
-        bot_name=bot_name,
-        from_user_id=msg.data.from_user_id,
-        topic=msg.data.topic,
-        photos=photos_root,
-        tokens_left=tokens_left,
+def _is_command(msg_str) -> bool:
+    # Commands are answered one by one, they are never merged with chat.
+    if not isinstance(msg_str, str):
+        return True
+    return (
+        cmd_proc.check_if_command_valid(msg_str)
+        or msg_str.strip('"') in common.CTRL_KEYS
+        or msg_str.lower() == "echo"
     )
-    if chat_persona is None:
+
+
+def merge_burst(texts):
+    """Merges consecutive chat lines into one user turn.
+    Returns the list of strings to answer, in order."""
+    turns = []
+    lines = []
+    for text in texts:
+        if _is_command(text):
+            if lines:
+                turns.append("\n".join(lines))
+                lines = []
+            turns.append(text)
+        else:
+            lines.append(text)
+    if lines:
+        turns.append("\n".join(lines))
+    return turns
+
+
+def warm_up(from_user_id: str, bot_name: str):
+    """Prepares what the first message of a new user needs: the free quota
+    and, in this worker, the bot definition."""
+    with metrics.timed("chat.warm_up"):
+        try:
+            db.create_free_quota(from_user_id)
+        except Exception as e:
+            logging.error("Error creating the quota of %s: %s", from_user_id, e)
+        bot_cache.get_bot_definition(bot_name)
+
+
+def process_chat(
+    msg,
+    tid,
+    queue_out,
+    bot_name,
+    photos_root,
+):
+    if msg == None:
         return
+    process_chat_burst([msg], tid, queue_out, bot_name, photos_root)
 
-    try:
+
+def process_chat_burst(
+    msgs,
+    tid,
+    queue_out,
+    bot_name,
+    photos_root,
+):
+    """Answers a burst of {data} messages of one topic, in arrival order.
+    Consecutive chat lines are answered with a single reply."""
+    # Logging is configured once by the worker running this function.
+    if not msgs:
+        return
+    first = msgs[0]
+    topic = first.data.topic
+    from_user_id = first.data.from_user_id
+
+    # Respond to message.
+    # Mark received messages as read.
+    queue_out.put(note_read(topic, msgs[-1].data.seq_id))
+    # Notify user that we are responding.
+    queue_out.put(typing_reply(topic))
+
+    with metrics.timed("chat.quota_check"):
+        ttl_valid, tokens_left = db.get_user_validity(from_user_id)
+    if not ttl_valid:
         # Respond with with chat persona for this topic.
-        msg = chat_persona.publish_msg(msg_str)
-        queue_out.put(msg)
-    except Exception as e:
-        logging.error("Error in publish_msg %s", e)
-        logging.error(traceback.format_exc())
         queue_out.put(
-            publish_msg(common.COMMON_MSG["INTERNAL_ERROR"], tid, msg.data.topic)
+            error_msg("USER_TTL_INVALID", tid, topic)
         )
+        return
+
+    if tokens_left['times'] <=0 and tokens_left['tokens'] <=0:
+        queue_out.put(
+            error_msg("USER_TOKEN_INVALID", tid, topic)
+        )
+        return
+    
+    vip_user:bool = str(tokens_left['type']).lower() == 'vip'
+
+    texts = []
+    for msg in msgs:
+        msg_str = _extract_text(msg, tid, queue_out, vip_user)
+        if msg_str is not None:
+            texts.append(msg_str)
+    turns = merge_burst(texts)
+    if not turns:
+        return
+    if len(msgs) > 1:
+        logging.info("Merged %d messages into %d turns", len(msgs), len(turns))
+
+    # Free users wait behind VIP users for LLM slots, see admission.
+    logging.info("%s: User %s is valid", bot_name, from_user_id)
+
+    with metrics.timed("chat.create_persona"):
+        chat_persona = CreatePersona(
+            bot_name=bot_name,
+            from_user_id=from_user_id,
+            topic=topic,
+            photos=photos_root,
+            tokens_left=tokens_left,
+        )
+    if chat_persona is None:
+        return
+
+    def publish_chunk(text, final):
+        # Streamed replies are sent as they are generated.
+        if text:
+            queue_out.put(publish_msg(text, tid, topic))
+        if not final:
+            queue_out.put(typing_reply(topic))
+
+    for msg_str in turns:
+        try:
+            # Respond with with chat persona for this topic.
+            reply = chat_persona.publish_msg(msg_str, publish_chunk)
+            if reply is not None:
+                queue_out.put(reply)
+        except quota.Exhausted as e:
+            logging.info("%s: %s", bot_name, e)
+            queue_out.put(
+                error_msg("USER_TOKEN_INVALID", tid, topic)
+            )
+        except admission.Overloaded as e:
+            logging.warning("No LLM slot for %s: %s", from_user_id, e)
+            queue_out.put(
+                error_msg("SERVER_BUSY", tid, topic)
+            )
+        except Exception as e:
+            logging.error("Error in publish_msg %s", e)
+            logging.error(traceback.format_exc())
+            queue_out.put(
+                error_msg("INTERNAL_ERROR", tid, topic)
+            )
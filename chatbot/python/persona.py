@@ -1,20 +1,26 @@
 """Define persona class for chatbot."""
 import requests
 import logging
-import redis
 import random
 import db
+import bot_cache
+import state_store
+import image_cache
+import response_cache
+import admission
+import metrics
+import quota
+import photo_index
+import tokenizer
+from history import HistoryWindow
 import time
 import json
-import base64
 import openai
 import pathlib
 from abc import ABC, abstractmethod
 from typing import Any
 import cmd_proc
-from PIL import Image
 import os
-from io import BytesIO as memory_io
 from enum import Enum
 
 # Import generated grpc modules
@@ -26,53 +32,7 @@ import common
 
 def inline_image(filename: pathlib.Path):
     # Create drafty representation of a message with an inline image.
-    try:
-        im = Image.open(filename, "r")
-        width = im.width
-        height = im.height
-        format = im.format if im.format else "JPEG"
-        if width > common.MAX_IMAGE_DIM or height > common.MAX_IMAGE_DIM:
-            # Scale the image
-            scale = min(
-                min(width, common.MAX_IMAGE_DIM) / width,
-                min(height, common.MAX_IMAGE_DIM) / height,
-            )
-            width = int(width * scale)
-            height = int(height * scale)
-            resized = im.resize((width, height))
-            im.close()
-            im = resized
-
-        mimetype = "image/" + format.lower()
-        bitbuffer = memory_io()
-        im.save(bitbuffer, format=format)
-        data = base64.b64encode(bitbuffer.getvalue())
-
-        # python3 fix.
-        if type(data) is not str:
-            data = data.decode()
-
-        result = {
-            "txt": " ",
-            "fmt": [{"len": 1}],
-            "ent": [
-                {
-                    "tp": "IM",
-                    "data": {
-                        "val": data,
-                        "mime": mimetype,
-                        "width": width,
-                        "height": height,
-                        "name": filename.name,
-                    },
-                }
-            ],
-        }
-        im.close()
-        return result
-    except IOError as err:
-        logging.error("Failed processing image '" + filename + "':", err)
-        return None
+    return image_cache.get_inline_image(filename, common.MAX_IMAGE_DIM)
 
 
 class Persona(ABC):
@@ -93,6 +53,7 @@ class Persona(ABC):
         self.from_user_id = from_user_id
         self.topic = topic
         self.photos_root = photos
+        self.photo_index = photo_index.get_index(photos)
         # The following data needs to be save locally.
         self.photo_pool = {}
         self.feeling = 0
@@ -106,15 +67,19 @@ class Persona(ABC):
         self.tokens_left = tokens_left
         # Format of history and persona_preset:
         # {chatmode: history/persona_preset}
-        self.history = []
+        # Read on first use, see history.
+        self._history = None
         self.persona_preset = []
+        # Tokens of persona_preset, kept up to date with it.
+        self.preset_tokens = 0
         # End of data to be saved locally.
 
-        openai.api_key = utils.read_from_file("openai.key").strip()
+        openai.api_key = utils.openai_api_key()
         logging.info("OpenAI API key: %s", openai.api_key)
         self.prepare_persona()
-        self.local_data_folder = pathlib.Path("runtime")
-        self.local_data_folder.mkdir(parents=True, exist_ok=True)
+        self.state_store = state_store.get_store()
+        # History as it was loaded, to save only the turns which changed.
+        self._stored_history = (0, [])
         # First need to load from local file if exists.
         self._load_data_from_local()
 
@@ -124,27 +89,58 @@ class Persona(ABC):
         self.user_prefix = self.initial_data['user_prefix']
         self.robot_prefix = self.initial_data['robot_prefix']
         self.memory = self.initial_data['memory']
-        self.history.clear()
-
-    def _get_local_file_name(self):
-        return f"{self.from_user_id}_{self.bot_name}_{self.topic}.json"
+        # Long-memory bots keep more turns.
+        self.max_history = self.initial_data.get('max_history', common.MAX_HISTORY_DATA)
+        self.preset_tokens = tokenizer.prompt_tokens(self.persona_preset)
+        # Publish the reply sentence by sentence while it's generated.
+        self.stream = self.initial_data.get('stream', False)
+        # Replies of bots without memory may be cached, see response_cache.
+        self.response_cache = response_cache.get_cache(
+            self.bot_name, self.initial_data.get('response_cache'))
+
+    def _get_state_key(self):
+        return f"{self.from_user_id}_{self.bot_name}_{self.topic}"
 
     def _load_data_from_local(self):
-        if not (self.local_data_folder / self._get_local_file_name()).exists():
-            # No local data file, a new user.
+        json_data = self.state_store.load(self._get_state_key())
+        if not json_data:
+            # No local data, a new user.
+            self._history = HistoryWindow(max_turns=self.max_history)
             return
-        with open(
-            self.local_data_folder / self._get_local_file_name(), "r", encoding="utf-8"
-        ) as f:
-            json_data = json.load(f)
-            self.feeling = json_data["feeling"]
-            self.photo_pool = json_data["photo_pool"]
-            self.tid = json_data["tid"]
-            self.last_cmd = json_data["last_cmd"]
-            self.history = json_data["history"]
-            self.tokens_used = json_data["tokens_used"]
-            self.persona_preset = json_data["persona_preset"]
-            self.memory = json_data["memory"]
+        self.feeling = json_data["feeling"]
+        self.photo_pool = self._migrate_photo_pool(json_data["photo_pool"])
+        self.tid = json_data["tid"]
+        self.last_cmd = json_data["last_cmd"]
+        self.tokens_used = json_data["tokens_used"]
+        self.persona_preset = json_data["persona_preset"]
+        self.memory = json_data["memory"]
+        self.preset_tokens = tokenizer.prompt_tokens(self.persona_preset)
+
+    @property
+    def history(self) -> HistoryWindow:
+        """The turns of the chat, read from the store on first use: the
+        commands not using them don't read them."""
+        if self._history is None:
+            history_start, turns = self.state_store.load_history(self._get_state_key())
+            self._history = HistoryWindow(turns, history_start, self.max_history)
+            self._stored_history = (self._history.start, self._history.to_list())
+        return self._history
+
+    @history.setter
+    def history(self, history: HistoryWindow) -> None:
+        self._history = history
+
+    def _history_changed_from(self) -> int:
+        """Returns the sequence id of the first turn which differs from
+        the stored history."""
+        stored_start, stored = self._stored_history
+        seq = self.history.start
+        for turn in self.history:
+            index = seq - stored_start
+            if index < 0 or index >= len(stored) or stored[index] != turn:
+                break
+            seq += 1
+        return seq
 
     def _save_data_to_local(self):
         json_data = {
@@ -152,21 +148,33 @@ class Persona(ABC):
             "photo_pool": self.photo_pool,
             "tid": self.tid,
             "last_cmd": self.last_cmd,
-            "history": self.history,
             "tokens_used": self.tokens_used,
             "persona_preset": self.persona_preset,
             "memory": self.memory,
         }
-        with open(
-            self.local_data_folder / self._get_local_file_name(), "w", encoding="utf-8"
-        ) as f:
-            json.dump(json_data, f)
-
-    def publish_msg(self, msg: str):
-        self._load_from_db()
-        reslut = self._publish_msg(msg)
-        self._save_to_db()
-        self._save_data_to_local()
+        if self._history is None:
+            # Not read, the stored history is kept.
+            self.state_store.save(self._get_state_key(), json_data, 0, None, 0)
+            return
+        self.state_store.save(
+            self._get_state_key(),
+            json_data,
+            self.history.start,
+            self.history.to_list(),
+            self._history_changed_from(),
+        )
+        self._stored_history = (self.history.start, self.history.to_list())
+
+    def publish_msg(self, msg: str, on_chunk=None):
+        """Returns the reply message, or None if the reply was already sent
+        in chunks through on_chunk(text, final)."""
+        with metrics.timed("persona.load_from_db"):
+            self._load_from_db()
+        reslut = self._publish_msg(msg, on_chunk)
+        with metrics.timed("persona.save_to_db"):
+            self._save_to_db()
+        with metrics.timed("persona.save_data_to_local"):
+            self._save_data_to_local()
         logging.info("Publish msg done")
         return reslut
 
@@ -187,23 +195,33 @@ class Persona(ABC):
         self.tokens_used['times'] = json_data["times"]
         self.tokens_used['tokens'] = json_data["tokens"]
 
+    def _migrate_photo_pool(self, photo_pool):
+        # Pools saved before the photo index are keyed by the photo path.
+        migrated = {}
+        for photo, status in photo_pool.items():
+            if not photo.isdigit():
+                photo_id = self.photo_index.id_of(photo)
+                if photo_id is None:
+                    continue
+                photo = str(photo_id)
+            migrated[photo] = status
+        return migrated
+
     def _reload_photo_pool(self):
         for i in range(0, int(self.feeling / 10)):
             self._load_photo_pool((i + 1) * 10)
 
     def _load_photo_pool(self, feeling):
         # Arrived at a new level
-        level_path = self.photos_root / f"lv{int(feeling / 10)}"
-        logging.info(f"Arrived at level {int(feeling / 10)}")
-        logging.info("Level photos path: " + str(level_path))
-        if level_path.exists():
-            available_photo = []
-            for photo in level_path.iterdir():
-                available_photo.append(photo)
+        level = int(feeling / 10)
+        logging.info(f"Arrived at level {level}")
+        available_photo = self.photo_index.photos(level)
+        if available_photo:
             # Choose 2-4 photos to add to the pool
             for _ in range(0, random.randint(2, 4)):
-                logging.info("Add photo to pool %s", photo)
                 photo = random.choice(available_photo)
+                logging.info("Add photo to pool %s", photo)
+                # Photo ids are saved as strings, they are json keys.
                 self.photo_pool[str(photo)] = 1
 
     def _save_to_db(self):
@@ -229,7 +247,7 @@ class Persona(ABC):
             content += his["role"] + ": " + his["content"] + "\n"
         return content
 
-    def _proc_normal_chat(self, msg_str: str):
+    def _proc_normal_chat(self, msg_str: str, on_chunk=None):
         msg_str = self.user_prefix + msg_str
         self.history.append(
             {
@@ -237,7 +255,7 @@ class Persona(ABC):
                 "content": msg_str,
             }
         )
-        content = self.ai_resp()
+        content = self.ai_resp(on_chunk)
         self.history.append(
             {
                 "role": "assistant",
@@ -246,21 +264,18 @@ class Persona(ABC):
         )
         content = content.lstrip(
             self.robot_prefix).strip(",.!?;:。，！？；：")
-        if len(self.history) > common.MAX_HISTORY_DATA:
-            # Remove the oldest 2 message
-            self.history.pop(0)
-            self.history.pop(0)
         # When user talk with ai, increase feeling according to the conversation
         self.increase_feeling(msg_str, content)
         return content
 
-    def _publish_msg(self, msg_str: str):
+    def _publish_msg(self, msg_str: str, on_chunk=None):
         head = {}
         head["mime"] = utils.encode_to_bytes("text/x-drafty")
 
         self.tid += 1
 
         logging.info("Received: %s", utils.clip_long_string(msg_str))
+        streamed = False
         if cmd_proc.check_if_command_valid(msg_str):
             content = self._proc_sys_cmd(msg_str)
         elif msg_str.strip('"') in common.CTRL_KEYS:
@@ -268,7 +283,8 @@ class Persona(ABC):
         elif msg_str.lower() == "echo":
             content = self._proc_echo_cmd()
         else:
-            content = self._proc_normal_chat(msg_str)
+            content = self._proc_normal_chat(msg_str, on_chunk)
+            streamed = self.stream and on_chunk is not None
 
         if not content:
             raise Exception("No reply")
@@ -276,6 +292,8 @@ class Persona(ABC):
         logging.info("Reply: %s", content)
 
         self.last_cmd = msg_str
+        if streamed:
+            return None
 
         return pb.ClientMsg(
             pub=pb.ClientPub(
@@ -296,22 +314,18 @@ class Persona(ABC):
     def generate_prompt(self):
         """Returns list[dict[str, str]]. During this process, the 
         history and persona_preset will be trimed to max prompt length."""
-        total_len = 0
-        for msg in self.persona_preset:
-            total_len += len(msg["content"])
-        for msg in self.history:
-            total_len += len(msg["content"])
-        while total_len > common.MAX_PROMPT_LEN:
+        # Both totals are kept up to date, measuring the prompt is O(1).
+        while self.preset_tokens + self.history.tokens > common.MAX_PROMPT_TOKENS:
             # Pop the oldest message from history first.
             if len(self.history) > 0:
-                content = self.history.pop(0)
-                total_len -= len(content["content"])
+                self.history.pop(0)
                 continue
             # Pop the oldest message from persona_preset because it's too long.
             if len(self.persona_preset) > 0:
                 content = self.persona_preset.pop(0)
-                total_len -= len(content["content"])
+                self.preset_tokens -= tokenizer.message_tokens(content)
                 continue
+            break
         messages = []
         messages.extend(self.persona_preset)
         if self.memory:
@@ -320,34 +334,101 @@ class Persona(ABC):
             messages.append(self.history[-1])
         return messages
 
-    def ai_resp(self) -> str:
+    def _chunker(self, on_chunk):
+        """Returns a SentenceChunker publishing the answer through on_chunk."""
+        first = True
+
+        def emit(text, final):
+            nonlocal first
+            if first:
+                text = text.lstrip('"').lstrip(self.robot_prefix)
+            if final:
+                text = text.rstrip().rstrip('"')
+            text = text.strip()
+            if not text and not final:
+                return
+            first = False
+            on_chunk(text, final)
+
+        return utils.SentenceChunker(emit)
+
+    def _stream_completion(self, prompt_data, on_chunk) -> str:
+        """Publishes the completion sentence by sentence through on_chunk
+        and returns the assembled answer."""
+        chunker = self._chunker(on_chunk)
+        answer = ""
+        response = openai.ChatCompletion.create(
+            model="gpt-3.5-turbo",
+            messages=prompt_data,
+            stream=True,
+        )
+        for chunk in response:
+            text = chunk.choices[0]["delta"].get("content")
+            if text:
+                answer += text
+                chunker.feed(text)
+        chunker.flush()
+        return answer.strip('"')
+
+    def _answer(self, prompt_data, on_chunk=None) -> str:
+        cache_key = None
+        answer = None
+        if self.response_cache is not None and not self.memory:
+            cache_key = response_cache.cache_key(tokenizer.MODEL, prompt_data)
+            answer = self.response_cache.get(cache_key)
+        if answer is not None:
+            if self.stream and on_chunk is not None:
+                chunker = self._chunker(on_chunk)
+                chunker.feed(answer)
+                chunker.flush()
+        else:
+            vip_user = str(self.tokens_left.get("type")).lower() == "vip"
+            prompt_tokens = tokenizer.prompt_tokens(prompt_data)
+            # Waits for a slot within the provider's limits.
+            with admission.slot(
+                self.from_user_id,
+                vip_user,
+                prompt_tokens + admission.REPLY_TOKENS,
+                group=self.bot_name,
+                weight=self.tokens_left.get("weight", 1.0),
+            ) as llm_slot, metrics.timed("persona.openai"):
+                if self.stream and on_chunk is not None:
+                    answer = self._stream_completion(prompt_data, on_chunk)
+                else:
+                    response = openai.ChatCompletion.create(
+                        model="gpt-3.5-turbo",
+                        messages=prompt_data,
+                    )
+                    answer = response.choices[0]["message"]["content"].strip('"')
+                llm_slot.tokens = prompt_tokens + tokenizer.count_tokens(answer)
+            if cache_key is not None:
+                self.response_cache.put(cache_key, answer)
+        return answer
+
+    def ai_resp(self, on_chunk=None) -> str:
         # Sleep 3 seconds to avoid too many requests.
         # time.sleep(3)
-        prompt_data = self.generate_prompt()
+        with metrics.timed("persona.generate_prompt"):
+            prompt_data = self.generate_prompt()
         words = 0
         # Don't calculate prompt as default.
         if self.memory:
-            words = len(self.history[-1]["content"])
+            words = tokenizer.count_tokens(self.history[-1]["content"])
         else:
             for msg in self.history:
-                words += len(msg["content"])
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=prompt_data,
-        )
-        answer = response.choices[0]["message"]["content"].strip('"')
-        words += len(answer)
-        if self.tokens_left["tokens"] > 0:
-            self.tokens_left["tokens"] -= words
+                words += tokenizer.count_tokens(msg["content"])
+        # Checks the user has quota left, it is debited in the background.
+        with quota.reserve(
+            self.from_user_id, self.tokens_left, words + admission.REPLY_TOKENS
+        ) as turn:
+            answer = self._answer(prompt_data, on_chunk)
+            # Cached answers are billed as if they were generated.
+            words += tokenizer.count_tokens(answer)
+            turn.tokens = words
+        if turn.left["tokens"] > 0:
             self.tokens_used['tokens'] += words
-            if self.tokens_left["tokens"] < 0:
-                self.tokens_left["tokens"] = 0
         else:
-            self.tokens_left["times"] -= 1
             self.tokens_used['times'] += 1
-            if self.tokens_left["times"] < 0:
-                self.tokens_left["times"] = 0
-        db.save_tokens_left(self.from_user_id,self.tokens_left)
         # logging.info(answer)
         return answer
 
@@ -387,8 +468,9 @@ class Persona(ABC):
         if str(self.tokens_left['type']).lower() == 'vip':
             state += f"剩余天数：{self.tokens_left['ttl'] // 86400}\n"
         else:
-            state+=f"""剩余次数：{self.tokens_left['times']}
-剩余tokens: {self.tokens_left['tokens']}
+            left = quota.get_ledger().available(self.from_user_id, self.tokens_left)
+            state+=f"""剩余次数：{left['times']}
+剩余tokens: {left['tokens']}
 """
         state += f"记忆：{'开' if self.memory else '关'}"
         return state
@@ -399,7 +481,9 @@ class Persona(ABC):
         if self.last_cmd.strip('"') == "看照片":
             return "刚刚发过了嘛，不能总是看照片啦！"
         unread_photos = [
-            photo for photo, status in self.photo_pool.items() if status == 1
+            photo for photo, status in self.photo_pool.items()
+            # Skip the photos removed from the library.
+            if status == 1 and self.photo_index.path(photo) is not None
         ]
         if len(unread_photos) == 0:
             return "暂时没有可以看的照片啦，和我聊聊天，解锁更多的照片把！"
@@ -411,7 +495,7 @@ class Persona(ABC):
             {"role": "assistant",
                 "content": self.robot_prefix + "我刚刚发了一张照片给你。"}
         )
-        return inline_image(pathlib.Path(photo))
+        return inline_image(self.photo_index.path(photo))
 
 
 def CreatePersona(bot_name: str,
@@ -422,22 +506,14 @@ def CreatePersona(bot_name: str,
                   ) -> Persona:
     logging.debug("Get robot data %s", bot_name)
     try:
-        with redis.Redis(
-            host="47.103.17.145", port=8010, db=6, password="godword"
-        ) as redis_ttl:
-            bot_data = redis_ttl.get(bot_name)
-            if bot_data == None:
-                logging.error(
-                    "Bot %s not found. Are you runnig a existing robot?", bot_name)
-                return None
-            json_data = json.loads(bot_data)
+        json_data = bot_cache.get_bot_definition(bot_name)
+        if json_data == None:
+            logging.error(
+                "Bot %s not found. Are you runnig a existing robot?", bot_name)
+            return None
     except Exception as e:
         logging.error("Error in get robot data %s", e)
         return None
-    
-    if "memory" not in json_data:
-        # 默认记忆开启
-        json_data["memory"] = True
 
     return Persona(
         bot_name=bot_name,
@@ -0,0 +1,188 @@
+"""Index of the photos of a bot by level.
+
+Photos live in photos_root/lvN. Each photo gets a small integer id which
+never changes: the ids are kept in photos_root/photo_ids.json and new
+photos get the next free id. Where the id file can't be written, the id
+of a photo is the crc32 of its path instead. The level folders are checked for changes
+every REFRESH_INTERVAL seconds, so new photos show up without a restart.
+"""
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+import zlib
+
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, the id file is not locked.
+    fcntl = None
+
+REFRESH_INTERVAL = 60
+ID_FILE = "photo_ids.json"
+
+
+class PhotoIndex:
+    def __init__(self, photos_root) -> None:
+        self.photos_root = pathlib.Path(photos_root)
+        # {level: [id, ...]}
+        self.levels = {}
+        # {id: {"path": str, "level": int, "size": int, "width": int, "height": int}}
+        self.entries = {}
+        self._ids_by_path = {}
+        # {level folder: mtime}, to tell when to rebuild.
+        self._mtimes = {}
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self.refresh(force=True)
+
+    def _level_dirs(self):
+        if not self.photos_root.is_dir():
+            return {}
+        dirs = {}
+        for level_path in self.photos_root.glob("lv*"):
+            if level_path.is_dir() and level_path.name[2:].isdigit():
+                dirs[level_path] = level_path.stat().st_mtime_ns
+        return dirs
+
+    def refresh(self, force: bool = False):
+        """Rebuilds the index if a level folder changed."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._checked_at < REFRESH_INTERVAL:
+                return
+            self._checked_at = now
+            dirs = self._level_dirs()
+            if not force and dirs == self._mtimes:
+                return
+            self._build(dirs)
+
+    def _build(self, dirs):
+        photos = []
+        for level_path in dirs:
+            level = int(level_path.name[2:])
+            for photo in sorted(level_path.iterdir()):
+                if photo.is_file():
+                    photos.append((level, photo))
+        ids = self._assign_ids([self._relative(photo) for _, photo in photos])
+
+        levels = {}
+        entries = {}
+        for level, photo in photos:
+            photo_id = ids[self._relative(photo)]
+            old = self.entries.get(photo_id)
+            stat = photo.stat()
+            if old is not None and old["size"] == stat.st_size:
+                entry = old
+            else:
+                entry = {
+                    "path": str(photo),
+                    "level": level,
+                    "size": stat.st_size,
+                    "width": 0,
+                    "height": 0,
+                }
+                try:
+                    # Only the header is read.
+                    with Image.open(photo) as im:
+                        entry["width"], entry["height"] = im.size
+                except IOError as err:
+                    logging.error("Not an image '%s': %s", photo, err)
+                    continue
+            entries[photo_id] = entry
+            levels.setdefault(level, []).append(photo_id)
+        self.entries = entries
+        self.levels = levels
+        self._ids_by_path = {
+            self._relative(entry["path"]): photo_id for photo_id, entry in entries.items()
+        }
+        self._mtimes = dirs
+        logging.info(
+            "Photo index of %s: %d photos in %d levels",
+            self.photos_root,
+            len(entries),
+            len(levels),
+        )
+
+    def _relative(self, path):
+        try:
+            return pathlib.Path(path).relative_to(self.photos_root).as_posix()
+        except ValueError:
+            return None
+
+    def _assign_ids(self, paths):
+        """Returns {path: id}, new paths get new ids in the id file."""
+        try:
+            return self._assign_ids_in_file(paths)
+        except OSError as err:
+            logging.error("Failed to update %s: %s", ID_FILE, err)
+            return self._hashed_ids(paths)
+
+    def _hashed_ids(self, paths):
+        """Returns {path: id} for read-only photos: ids derived from the
+        paths, so they are the same in every process and after a restart."""
+        ids = {}
+        used = set()
+        for path in sorted(paths):
+            # crc32 is stable across processes and restarts, unlike hash().
+            photo_id = zlib.crc32(path.encode("utf-8")) or 1
+            while photo_id in used:
+                # Collisions are rare, resolved in path order.
+                photo_id = photo_id % 0xFFFFFFFF + 1
+            used.add(photo_id)
+            ids[path] = photo_id
+        return ids
+
+    def _assign_ids_in_file(self, paths):
+        id_file = self.photos_root / ID_FILE
+        with open(self.photos_root / (ID_FILE + ".lock"), "a") as lock:
+            # Workers of several bots may build the index at the same time.
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(id_file, "r", encoding="utf-8") as f:
+                    ids = json.load(f)
+            except (OSError, ValueError):
+                ids = {}
+            new_paths = [path for path in paths if path not in ids]
+            if new_paths:
+                next_id = max(ids.values(), default=0) + 1
+                for path in new_paths:
+                    ids[path] = next_id
+                    next_id += 1
+                tmp_file = id_file.with_suffix(f".{os.getpid()}.tmp")
+                with open(tmp_file, "w", encoding="utf-8") as f:
+                    json.dump(ids, f)
+                os.replace(tmp_file, id_file)
+        return ids
+
+    def photos(self, level: int):
+        """Returns the ids of the photos of the level."""
+        self.refresh()
+        return self.levels.get(level, [])
+
+    def path(self, photo_id):
+        self.refresh()
+        entry = self.entries.get(int(photo_id))
+        return pathlib.Path(entry["path"]) if entry is not None else None
+
+    def id_of(self, path):
+        """Returns the id of the photo path, or None."""
+        return self._ids_by_path.get(self._relative(path))
+
+
+_indexes = {}
+
+
+def get_index(photos_root) -> PhotoIndex:
+    """Returns the index of photos_root, built once per process."""
+    key = str(photos_root)
+    index = _indexes.get(key)
+    if index is None:
+        index = PhotoIndex(photos_root)
+        _indexes[key] = index
+    return index
@@ -0,0 +1,66 @@
+import pathlib
+import tempfile
+import unittest
+from PIL import Image
+import photo_index
+
+
+class TestPhotoIndex(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.folder.name)
+        for name in ("lv1/a.png", "lv1/b.png", "lv2/c.png"):
+            self.add_photo(name)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def add_photo(self, name):
+        path = self.root / name
+        path.parent.mkdir(exist_ok=True)
+        Image.new("RGB", (4, 2)).save(path)
+        return path
+
+    def test_levels(self):
+        index = photo_index.PhotoIndex(self.root)
+        self.assertEqual(len(index.photos(1)), 2)
+        photo_id = index.photos(2)[0]
+        self.assertEqual(index.path(photo_id), self.root / "lv2/c.png")
+        self.assertEqual(index.id_of(self.root / "lv2/c.png"), photo_id)
+        self.assertEqual(index.entries[photo_id]["width"], 4)
+        self.assertEqual(index.photos(3), [])
+
+    def test_ids_kept(self):
+        ids = photo_index.PhotoIndex(self.root)._ids_by_path
+        self.add_photo("lv1/0.png")
+        index = photo_index.PhotoIndex(self.root)
+        for path, photo_id in ids.items():
+            self.assertEqual(index._ids_by_path[path], photo_id)
+        self.assertEqual(index._ids_by_path["lv1/0.png"], max(ids.values()) + 1)
+
+    def test_read_only_ids(self):
+        def read_only(index, paths):
+            raise PermissionError("read-only")
+
+        assign_ids = photo_index.PhotoIndex._assign_ids_in_file
+        photo_index.PhotoIndex._assign_ids_in_file = read_only
+        try:
+            ids = photo_index.PhotoIndex(self.root)._ids_by_path
+            # A new photo does not move the ids of the others.
+            self.add_photo("lv1/0.png")
+            index = photo_index.PhotoIndex(self.root)
+        finally:
+            photo_index.PhotoIndex._assign_ids_in_file = assign_ids
+        for path, photo_id in ids.items():
+            self.assertEqual(index._ids_by_path[path], photo_id)
+        self.assertEqual(len(set(index._ids_by_path.values())), 4)
+
+    def test_hashed_id_collision(self):
+        index = photo_index.PhotoIndex(self.root)
+        # "plumless" and "buckeroo" have the same crc32.
+        ids = index._hashed_ids(["plumless", "buckeroo"])
+        self.assertEqual(ids["buckeroo"] + 1, ids["plumless"])
+
+
+if __name__ == "__main__":
+    unittest.main()
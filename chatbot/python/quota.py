@@ -0,0 +1,201 @@
+"""Quota of the users, reserved before an LLM call and debited in the
+background.
+
+A worker reserves a turn of the user's quota before calling the LLM and
+settles it with the tokens actually used. Settled turns are kept per user
+and debited together, every FLUSH_INTERVAL seconds or FLUSH_TURNS turns,
+by db.debit_quotas: HINCRBY in a Lua script, so the workers of the same
+user never overwrite each other's debits. Until then they are deducted
+from the quota read from Redis by available().
+"""
+import contextlib
+import itertools
+import logging
+import os
+import threading
+import time
+
+import db
+import metrics
+
+# Seconds settled turns wait for their debit at most.
+FLUSH_INTERVAL = 0.5
+# Settled turns debited at once at most.
+FLUSH_TURNS = 32
+
+
+class Exhausted(Exception):
+    """The user has no quota left."""
+
+
+def debit(quota: dict, turns) -> tuple:
+    """Returns the times and tokens of quota left after the turns, the
+    tokens used by each. Same rule as the debit of db."""
+    times, tokens = quota["times"], quota["tokens"]
+    for used in turns:
+        if tokens > 0:
+            tokens = max(0, tokens - used)
+        else:
+            times = max(0, times - 1)
+    return times, tokens
+
+
+class Turn:
+    def __init__(self, tokens: int, left: dict) -> None:
+        # Set to the tokens actually used before the turn is settled.
+        self.tokens = tokens
+        # The quota left before the turn.
+        self.left = left
+
+
+class Ledger:
+    """The turns of this process reserved, and settled but not debited."""
+
+    def __init__(
+        self, flush_interval: float = FLUSH_INTERVAL, flush_turns: int = FLUSH_TURNS, debit=None
+    ) -> None:
+        self.flush_interval = flush_interval
+        self.flush_turns = flush_turns
+        # Called with {user: [tokens used by each turn]}.
+        self.debit = debit or db.debit_quotas
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # {user: [tokens used by each turn]}, settled and being debited.
+        self._settled = {}
+        self._flushing = {}
+        self._count = 0
+        # {user: {reservation: estimated tokens}}
+        self._reserved = {}
+        self._reservations = itertools.count(1)
+        self._flushed_at = time.monotonic()
+        self.debited = 0
+        self.failed = 0
+
+    def available(self, user, quota: dict) -> dict:
+        """Returns the quota read from Redis less the turns of this process
+        it does not count yet."""
+        with self._lock:
+            return self._available(user, quota)
+
+    def _available(self, user, quota: dict) -> dict:
+        if str(quota.get("type")).lower() == "vip":
+            return dict(quota)
+        turns = self._flushing.get(user, []) + self._settled.get(user, [])
+        turns += self._reserved.get(user, {}).values()
+        times, tokens = debit(quota, turns)
+        return dict(quota, times=times, tokens=tokens)
+
+    def reserve(self, user, quota: dict, tokens: int):
+        """Returns the reservation and the quota left before it. Raises
+        Exhausted if nothing is left."""
+        with self._lock:
+            left = self._available(user, quota)
+            if left["times"] <= 0 and left["tokens"] <= 0:
+                raise Exhausted(f"no quota left for {user}")
+            reservation = next(self._reservations)
+            self._reserved.setdefault(user, {})[reservation] = tokens
+            return reservation, left
+
+    def release(self, user, reservation):
+        with self._lock:
+            self._release(user, reservation)
+
+    def _release(self, user, reservation):
+        reserved = self._reserved.get(user)
+        if reserved is not None:
+            reserved.pop(reservation, None)
+            if not reserved:
+                del self._reserved[user]
+
+    def settle(self, user, reservation, tokens: int):
+        with self._lock:
+            self._release(user, reservation)
+            self._settled.setdefault(user, []).append(tokens)
+            self._count += 1
+            due = (
+                self._count >= self.flush_turns
+                or time.monotonic() - self._flushed_at >= self.flush_interval
+            )
+        if due:
+            self.flush()
+
+    def flush(self) -> int:
+        """Debits the settled turns, returns how many. Turns failing to be
+        debited are retried with the next flush."""
+        with self._flush_lock:
+            with self._lock:
+                self._flushing, self._settled = self._settled, {}
+                count, self._count = self._count, 0
+                self._flushed_at = time.monotonic()
+            if not self._flushing:
+                return 0
+            try:
+                self.debit(self._flushing)
+            except Exception as e:
+                logging.error("Error debiting %d turns: %s", count, e)
+                metrics.inc("quota_debit_errors")
+                self.failed += count
+                with self._lock:
+                    for user, turns in self._flushing.items():
+                        self._settled[user] = turns + self._settled.get(user, [])
+                    self._count += count
+                    self._flushing = {}
+                return 0
+            with self._lock:
+                self._flushing = {}
+            self.debited += count
+            metrics.inc("quota_turns_debited", count)
+            return count
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "settled": self._count,
+                "reserved": sum(len(reserved) for reserved in self._reserved.values()),
+                "debited": self.debited,
+                "failed": self.failed,
+            }
+
+
+_ledger = None
+_ledger_pid = None
+
+
+def get_ledger() -> Ledger:
+    """Returns the ledger of the current process."""
+    global _ledger, _ledger_pid
+    # Turns of the parent are not debited by a forked process.
+    if _ledger is None or _ledger_pid != os.getpid():
+        _ledger = Ledger()
+        _ledger_pid = os.getpid()
+    return _ledger
+
+
+@contextlib.contextmanager
+def reserve(user, quota: dict, tokens: int):
+    """Holds a turn of the user's quota for an LLM call of about tokens.
+    Raises Exhausted if nothing is left. Set .tokens of the turn to the
+    tokens used, it is settled on exit and released on an exception."""
+    ledger = get_ledger()
+    reservation, left = ledger.reserve(user, quota, tokens)
+    turn = Turn(tokens, left)
+    try:
+        yield turn
+    except BaseException:
+        ledger.release(user, reservation)
+        raise
+    ledger.settle(user, reservation, turn.tokens)
+
+
+def start_flusher():
+    """Debits the settled turns of this process every FLUSH_INTERVAL
+    seconds. Returns a function debiting them immediately."""
+    ledger = get_ledger()
+
+    def flush():
+        while True:
+            time.sleep(ledger.flush_interval)
+            ledger.flush()
+
+    threading.Thread(target=flush, name="quota", daemon=True).start()
+    return ledger.flush
@@ -0,0 +1,53 @@
+import unittest
+import quota
+
+
+class TestQuota(unittest.TestCase):
+    def setUp(self):
+        self.debits = []
+        self.ledger = quota.Ledger(flush_interval=60, flush_turns=3, debit=self.debits.append)
+
+    def test_debit_rule(self):
+        # Tokens first, then one time per turn.
+        self.assertEqual(quota.debit({"times": 2, "tokens": 100}, [60, 60, 10]), (1, 0))
+
+    def test_available_counts_pending_turns(self):
+        loaded = {"times": 1, "tokens": 100, "type": "free"}
+        reservation, left = self.ledger.reserve("u", loaded, 80)
+        self.assertEqual(left["tokens"], 100)
+        self.assertEqual(self.ledger.available("u", loaded)["tokens"], 20)
+        self.ledger.settle("u", reservation, 150)
+        self.assertEqual(self.ledger.available("u", loaded), dict(loaded, tokens=0))
+        reservation, _ = self.ledger.reserve("u", loaded, 80)
+        # The last time is reserved.
+        with self.assertRaises(quota.Exhausted):
+            self.ledger.reserve("u", loaded, 80)
+        self.ledger.release("u", reservation)
+        self.assertEqual(self.ledger.available("u", loaded)["times"], 1)
+        self.assertEqual(self.debits, [])
+
+    def test_flush_every_n_turns(self):
+        loaded = {"times": 30, "tokens": 30000, "type": "free"}
+        for user in ("a", "b", "a"):
+            reservation, _ = self.ledger.reserve(user, loaded, 10)
+            self.ledger.settle(user, reservation, 5)
+        self.assertEqual(self.debits, [{"a": [5, 5], "b": [5]}])
+        self.assertEqual(self.ledger.available("a", loaded), loaded)
+
+    def test_failed_flush_retried(self):
+        def fail(turns):
+            raise ConnectionError("down")
+
+        loaded = {"times": 30, "tokens": 30000, "type": "free"}
+        self.ledger.debit = fail
+        reservation, _ = self.ledger.reserve("a", loaded, 10)
+        self.ledger.settle("a", reservation, 5)
+        self.assertEqual(self.ledger.flush(), 0)
+        self.assertEqual(self.ledger.available("a", loaded)["tokens"], 29995)
+        self.ledger.debit = self.debits.append
+        self.assertEqual(self.ledger.flush(), 1)
+        self.assertEqual(self.debits, [{"a": [5]}])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+"""Cache of LLM replies for bots without memory.
+
+Bots like the translators answer every message from the preset and the
+message alone, so the same text gets the same reply. A bot opts in with
+a "response_cache" entry in its definition:
+    "response_cache": {"backend": "redis", "ttl": 86400, "max_entries": 10000}
+or simply "response_cache": true for the defaults. The "redis" backend is
+shared by every worker and bot process, the "local" one by the workers of
+one machine through files under cache/responses.
+"""
+import hashlib
+import json
+import logging
+import time
+
+import cache
+import db
+
+DEFAULTS = {
+    "backend": "redis",
+    # Seconds.
+    "ttl": 86400,
+    "max_entries": 10000,
+}
+
+
+def cache_key(model: str, messages) -> str:
+    """Hash of the model and the prompt, whitespace of the user's message
+    is normalized."""
+    normalized = [dict(msg) for msg in messages]
+    if normalized:
+        normalized[-1]["content"] = " ".join(normalized[-1]["content"].split())
+    data = json.dumps([model, normalized], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class LocalResponseCache:
+    def __init__(self, bot_name: str, ttl: float, max_entries: int) -> None:
+        self.bot_name = bot_name
+        self._memory = cache.LRUCache(max_entries=min(max_entries, 1024), ttl=ttl)
+        self._disk = cache.DiskCache(
+            f"cache/responses/{bot_name}", max_entries=max_entries, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        answer = self._memory.get(key)
+        if answer is None:
+            data = self._disk.get(key)
+            if data is not None:
+                answer = data.decode("utf-8")
+                self._memory.put(key, answer)
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return answer
+
+    def put(self, key: str, answer: str):
+        self._memory.put(key, answer)
+        self._disk.put(key, answer.encode("utf-8"))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class RedisResponseCache:
+    """Replies are kept with an expiry, a sorted set of keys by insertion
+    time bounds their number. Hits and misses are counted in redis too, so
+    the hit ratio covers every process."""
+
+    def __init__(self, bot_name: str, ttl: float, max_entries: int) -> None:
+        self.bot_name = bot_name
+        self.ttl = int(ttl)
+        self.max_entries = max_entries
+        self.prefix = f"response:{bot_name}:"
+        self.index_key = f"response_index:{bot_name}"
+        self.stats_key = f"response_stats:{bot_name}"
+
+    def get(self, key: str):
+        try:
+            redis_con = db.get_redis(db.RESPONSE_CACHE_DB)
+            answer = redis_con.get(self.prefix + key)
+            redis_con.hincrby(self.stats_key, "hits" if answer is not None else "misses", 1)
+        except Exception as e:
+            logging.error("Error in response cache get %s", e)
+            return None
+        return answer.decode("utf-8") if answer is not None else None
+
+    def put(self, key: str, answer: str):
+        try:
+            redis_con = db.get_redis(db.RESPONSE_CACHE_DB)
+            pipe = redis_con.pipeline(transaction=False)
+            pipe.set(self.prefix + key, answer, ex=self.ttl or None)
+            pipe.zadd(self.index_key, {key: time.time()})
+            pipe.zcard(self.index_key)
+            size = pipe.execute()[-1]
+            if size > self.max_entries:
+                # Evict the oldest replies.
+                evicted = redis_con.zpopmin(self.index_key, size - self.max_entries)
+                if evicted:
+                    redis_con.delete(*[self.prefix + k.decode("utf-8") for k, _ in evicted])
+        except Exception as e:
+            logging.error("Error in response cache put %s", e)
+
+    def stats(self) -> dict:
+        try:
+            counts = db.get_redis(db.RESPONSE_CACHE_DB).hgetall(self.stats_key)
+        except Exception as e:
+            logging.error("Error in response cache stats %s", e)
+            counts = {}
+        hits = int(counts.get(b"hits", 0))
+        misses = int(counts.get(b"misses", 0))
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / lookups if lookups else 0.0,
+        }
+
+
+_caches = {}
+
+
+def get_cache(bot_name: str, options):
+    """Returns the reply cache of the bot, or None if it did not opt in."""
+    if not options:
+        return None
+    if options is True:
+        options = {}
+    key = (bot_name, json.dumps(options, sort_keys=True))
+    response_cache = _caches.get(key)
+    if response_cache is None:
+        config = dict(DEFAULTS)
+        config.update(options)
+        if config["backend"] == "local":
+            cache_class = LocalResponseCache
+        else:
+            cache_class = RedisResponseCache
+        response_cache = cache_class(bot_name, config["ttl"], config["max_entries"])
+        _caches[key] = response_cache
+    return response_cache
+
+
+def cache_stats() -> dict:
+    return {bot_name: response_cache.stats() for (bot_name, _), response_cache in _caches.items()}
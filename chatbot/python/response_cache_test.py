@@ -0,0 +1,33 @@
+import os
+import tempfile
+import unittest
+import response_cache
+
+
+class TestResponseCache(unittest.TestCase):
+    def test_key_normalizes_user_message(self):
+        preset = [{"role": "system", "content": "Translate."}]
+        key = response_cache.cache_key("m", preset + [{"role": "user", "content": " hello   world\n"}])
+        self.assertEqual(key, response_cache.cache_key("m", preset + [{"role": "user", "content": "hello world"}]))
+        self.assertNotEqual(key, response_cache.cache_key("n", preset + [{"role": "user", "content": "hello world"}]))
+
+    def test_local(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            try:
+                local = response_cache.get_cache("bot", {"backend": "local"})
+                self.assertIs(local, response_cache.get_cache("bot", {"backend": "local"}))
+                self.assertIsNone(local.get("abcd"))
+                local.put("abcd", "你好")
+                self.assertEqual(local.get("abcd"), "你好")
+                self.assertEqual(local.stats()["hit_ratio"], 0.5)
+            finally:
+                os.chdir(cwd)
+
+    def test_opt_in(self):
+        self.assertIsNone(response_cache.get_cache("bot", None))
+
+
+if __name__ == "__main__":
+    unittest.main()
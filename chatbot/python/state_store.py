@@ -0,0 +1,213 @@
+"""Storage of the persona state of each user, bot and topic.
+
+The backend is selected with the CHATBOT_STATE_BACKEND environment variable:
+"json" keeps one file per key under CHATBOT_STATE_PATH (default "runtime"),
+"sqlite" keeps every key in one database (default "runtime/state.db").
+History turns are numbered with a sequence id that grows for the lifetime
+of the key, so the sqlite backend only writes the turns which changed.
+"""
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+from abc import ABC, abstractmethod
+
+# Persona fields stored besides the history.
+FIELDS = (
+    "feeling",
+    "photo_pool",
+    "tid",
+    "last_cmd",
+    "tokens_used",
+    "persona_preset",
+    "memory",
+)
+
+
+class StateStore(ABC):
+    @abstractmethod
+    def load(self, key: str, fields=FIELDS) -> dict:
+        """Returns the requested fields, or an empty dict for a new key."""
+
+    @abstractmethod
+    def load_history(self, key: str):
+        """Returns (seq of the first turn, list of turns)."""
+
+    @abstractmethod
+    def save(self, key: str, fields: dict, history_start: int, history, changed_from: int):
+        """Stores the fields and the history. Turns before changed_from
+        are the same as the stored ones, a history of None was not loaded
+        and is kept as stored."""
+
+    @abstractmethod
+    def delete(self, key: str):
+        pass
+
+    @abstractmethod
+    def keys(self, prefix: str = ""):
+        pass
+
+
+class JsonFileStateStore(StateStore):
+    """One json file per key. Files are replaced atomically, a crash never
+    leaves a truncated file behind."""
+
+    def __init__(self, folder) -> None:
+        self.folder = pathlib.Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        # The file read by load(), for the load_history() which follows.
+        self._loaded = (None, None)
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.folder / f"{key}.json"
+
+    def _read(self, key: str) -> dict:
+        path = self._path(key)
+        if not path.exists():
+            # No local data file, a new user.
+            return {}
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def load(self, key: str, fields=FIELDS) -> dict:
+        json_data = self._read(key)
+        self._loaded = (key, json_data)
+        return {field: json_data[field] for field in fields if field in json_data}
+
+    def load_history(self, key: str):
+        loaded_key, json_data = self._loaded
+        self._loaded = (None, None)
+        if loaded_key != key:
+            json_data = self._read(key)
+        return json_data.get("history_start", 0), list(json_data.get("history", []))
+
+    def save(self, key: str, fields: dict, history_start: int, history, changed_from: int):
+        json_data = dict(fields)
+        if history is None:
+            history_start, history = self.load_history(key)
+        json_data["history"] = list(history)
+        json_data["history_start"] = history_start
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(json_data, f)
+        os.replace(tmp_path, path)
+        self._loaded = (None, None)
+
+    def delete(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+        self._loaded = (None, None)
+
+    def keys(self, prefix: str = ""):
+        return [path.stem for path in self.folder.glob(f"{prefix}*.json")]
+
+
+class SqliteStateStore(StateStore):
+    """All keys in one sqlite database. Fields are columns holding json
+    values, history turns are rows keyed by (key, seq)."""
+
+    def __init__(self, path) -> None:
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Several worker processes share the database.
+        self.conn = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        columns = ", ".join(f"{field} TEXT" for field in FIELDS)
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, {columns})"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "key TEXT, seq INTEGER, role TEXT, content TEXT, "
+            "PRIMARY KEY (key, seq)) WITHOUT ROWID"
+        )
+
+    def load(self, key: str, fields=FIELDS) -> dict:
+        for field in fields:
+            if field not in FIELDS:
+                raise ValueError(f"Unknown state field: {field}")
+        row = self.conn.execute(
+            f"SELECT {', '.join(fields)} FROM state WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return {}
+        return {
+            field: json.loads(val)
+            for field, val in zip(fields, row)
+            if val is not None
+        }
+
+    def load_history(self, key: str):
+        rows = self.conn.execute(
+            "SELECT seq, role, content FROM history WHERE key = ? ORDER BY seq",
+            (key,),
+        ).fetchall()
+        if not rows:
+            return 0, []
+        return rows[0][0], [{"role": role, "content": content} for _, role, content in rows]
+
+    def save(self, key: str, fields: dict, history_start: int, history, changed_from: int):
+        names = [field for field in FIELDS if field in fields]
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO state (key, {', '.join(names)}) "
+                f"VALUES (?{', ?' * len(names)})",
+                [key] + [json.dumps(fields[name]) for name in names],
+            )
+            if history is None:
+                return
+            changed_from = max(changed_from, history_start)
+            history_end = history_start + len(history)
+            self.conn.execute(
+                "DELETE FROM history WHERE key = ? AND (seq < ? OR seq >= ?)",
+                (key, history_start, changed_from),
+            )
+            self.conn.executemany(
+                "INSERT INTO history (key, seq, role, content) VALUES (?, ?, ?, ?)",
+                [
+                    (key, seq, turn["role"], turn["content"])
+                    for seq, turn in zip(
+                        range(changed_from, history_end),
+                        history[changed_from - history_start:],
+                    )
+                ],
+            )
+
+    def delete(self, key: str):
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute("DELETE FROM state WHERE key = ?", (key,))
+            self.conn.execute("DELETE FROM history WHERE key = ?", (key,))
+
+    def keys(self, prefix: str = ""):
+        rows = self.conn.execute(
+            "SELECT key FROM state WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+
+_store = None
+_store_pid = None
+
+
+def create_store(backend: str, path: str = None) -> StateStore:
+    if backend == "sqlite":
+        return SqliteStateStore(path or "runtime/state.db")
+    if backend == "json":
+        return JsonFileStateStore(path or "runtime")
+    raise ValueError(f"Unknown state backend: {backend}")
+
+
+def get_store() -> StateStore:
+    """Returns the store of the current process."""
+    global _store, _store_pid
+    # sqlite connections must not be shared with forked processes.
+    if _store is None or _store_pid != os.getpid():
+        backend = os.environ.get("CHATBOT_STATE_BACKEND", "json")
+        _store = create_store(backend, os.environ.get("CHATBOT_STATE_PATH"))
+        _store_pid = os.getpid()
+        logging.info("Persona state backend: %s", backend)
+    return _store
@@ -0,0 +1,66 @@
+import tempfile
+import unittest
+import state_store
+
+
+FIELDS = {
+    "feeling": 3,
+    "photo_pool": {},
+    "tid": 101,
+    "last_cmd": "hi",
+    "tokens_used": {"times": 1, "tokens": 20},
+    "persona_preset": [],
+    "memory": True,
+}
+
+
+def turns(*contents):
+    return [{"role": "user", "content": content} for content in contents]
+
+
+class TestStateStore(unittest.TestCase):
+    def check_store(self, store):
+        self.assertEqual(store.load("k"), {})
+        store.save("k", FIELDS, 0, turns("a", "b"), 0)
+        self.assertEqual(store.load("k"), FIELDS)
+        self.assertEqual(store.load("k", ("feeling",)), {"feeling": 3})
+        self.assertEqual(store.load_history("k"), (0, turns("a", "b")))
+        # "a" dropped from the front, "b" unchanged, "c" appended.
+        store.save("k", FIELDS, 1, turns("b", "c"), 2)
+        self.assertEqual(store.load_history("k"), (1, turns("b", "c")))
+        # Last turn replaced.
+        store.save("k", FIELDS, 1, turns("b", "d"), 2)
+        self.assertEqual(store.load_history("k"), (1, turns("b", "d")))
+        # History not read, kept as stored.
+        store.save("k", dict(FIELDS, feeling=4), 0, None, 0)
+        self.assertEqual(store.load("k", ("feeling",)), {"feeling": 4})
+        self.assertEqual(store.load_history("k"), (1, turns("b", "d")))
+        self.assertEqual(store.keys(), ["k"])
+        store.delete("k")
+        self.assertEqual(store.load("k"), {})
+        self.assertEqual(store.load_history("k"), (0, []))
+
+    def test_json(self):
+        with tempfile.TemporaryDirectory() as folder:
+            self.check_store(state_store.JsonFileStateStore(folder))
+
+    def test_json_changed_by_other_store(self):
+        with tempfile.TemporaryDirectory() as folder:
+            store = state_store.JsonFileStateStore(folder)
+            other = state_store.JsonFileStateStore(folder)
+            store.save("k", FIELDS, 0, turns("a"), 0)
+            self.assertEqual(store.load("k", ("feeling",)), {"feeling": 3})
+            # Another worker's change is seen by the next message.
+            other.save("k", dict(FIELDS, feeling=4), 0, turns("a", "b"), 1)
+            self.assertEqual(store.load("k", ("feeling",)), {"feeling": 4})
+            self.assertEqual(store.load_history("k"), (0, turns("a", "b")))
+            other.delete("k")
+            self.assertEqual(store.load_history("k"), (0, []))
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as folder:
+            self.check_store(state_store.SqliteStateStore(folder + "/state.db"))
+
+
+if __name__ == '__main__':
+    unittest.main()
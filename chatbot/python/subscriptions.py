@@ -0,0 +1,86 @@
+"""The topics the bot is attached to, bounded to the active ones."""
+import collections
+import time
+
+import metrics
+
+# Topics attached at most.
+MAX_TOPICS = 10000
+# Seconds a topic stays attached after its last message at least, so a
+# conversation in progress is not evicted.
+MIN_IDLE = 300
+
+
+class Subscriptions:
+    """Attached topics in least recently active first order.
+
+    attach() returns the topics to leave to make room for a new one: the
+    least recently active, if idle for min_idle seconds. When every topic
+    is busier than that, the cap is exceeded rather than cutting a
+    conversation short.
+    """
+
+    def __init__(self, max_topics: int = MAX_TOPICS, min_idle: float = MIN_IDLE) -> None:
+        self.max_topics = max_topics
+        self.min_idle = min_idle
+        # {topic: last activity}, least recent first.
+        self._topics = collections.OrderedDict()
+        # Topics evicted lately, to count the ones coming back.
+        self._evicted = collections.OrderedDict()
+        self.attached = 0
+        self.reattached = 0
+        self.evicted = 0
+
+    def attach(self, topic, now: float = None) -> list:
+        """Adds the topic, returns the topics to leave."""
+        if now is None:
+            now = time.time()
+        if topic in self._topics:
+            self.touch(topic, now)
+            return []
+        evict = []
+        while len(self._topics) >= self.max_topics:
+            oldest, active_at = next(iter(self._topics.items()))
+            if now - active_at < self.min_idle:
+                break
+            evict.append(oldest)
+            self.remove(oldest)
+            self._evicted[oldest] = True
+            if len(self._evicted) > self.max_topics:
+                self._evicted.popitem(last=False)
+        self.evicted += len(evict)
+        self.attached += 1
+        if self._evicted.pop(topic, None) is not None:
+            self.reattached += 1
+            metrics.inc("subscriptions", event="reattach")
+        metrics.inc("subscriptions", event="attach")
+        if evict:
+            metrics.inc("subscriptions", len(evict), event="evict")
+        self._topics[topic] = now
+        return evict
+
+    def touch(self, topic, now: float = None):
+        if topic in self._topics:
+            self._topics[topic] = time.time() if now is None else now
+            self._topics.move_to_end(topic)
+
+    def remove(self, topic):
+        self._topics.pop(topic, None)
+
+    def stats(self) -> dict:
+        return {
+            "topics": len(self._topics),
+            "max_topics": self.max_topics,
+            "attached": self.attached,
+            "reattached": self.reattached,
+            "evicted": self.evicted,
+        }
+
+    def __contains__(self, topic) -> bool:
+        return topic in self._topics
+
+    def __iter__(self):
+        return iter(list(self._topics))
+
+    def __len__(self) -> int:
+        return len(self._topics)
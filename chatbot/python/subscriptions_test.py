@@ -0,0 +1,25 @@
+import unittest
+import subscriptions
+
+
+class TestSubscriptions(unittest.TestCase):
+    def test_evicts_least_recently_active(self):
+        topics = subscriptions.Subscriptions(max_topics=2, min_idle=10)
+        topics.attach("a", now=0)
+        topics.attach("b", now=1)
+        topics.touch("a", now=2)
+        self.assertEqual(topics.attach("c", now=20), ["b"])
+        self.assertEqual(list(topics), ["a", "c"])
+        # Coming back counts as a reattach.
+        topics.attach("b", now=30)
+        self.assertEqual(topics.stats()["reattached"], 1)
+
+    def test_keeps_busy_topics(self):
+        topics = subscriptions.Subscriptions(max_topics=1, min_idle=10)
+        topics.attach("a", now=0)
+        self.assertEqual(topics.attach("b", now=5), [])
+        self.assertEqual(len(topics), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
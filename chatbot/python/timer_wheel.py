@@ -0,0 +1,150 @@
+"""Requests waiting for their {ctrl}, expired by a hashed timer wheel."""
+import logging
+import math
+import threading
+import time
+
+import metrics
+
+# Seconds a request waits for its {ctrl} by default.
+REQUEST_TIMEOUT = 30
+# Code passed to onerror when a request expires, as the server's 504.
+TIMEOUT_CODE = 504
+# Seconds between two ticks of the wheel.
+TICK = 0.1
+
+
+class TimerWheel:
+    """Hashed timer wheel: a ring of slots advanced every tick seconds.
+
+    A timer is put in the slot it falls in, with the number of turns of
+    the ring left before it is due. Adding and cancelling are O(1), a tick
+    only looks at the timers of one slot.
+    """
+
+    def __init__(self, tick: float = TICK, slots: int = 512) -> None:
+        self.tick = tick
+        # [{key: turns left}]
+        self._slots = [{} for _ in range(slots)]
+        # {key: slot index}
+        self._slot_of = {}
+        self._current = 0
+        self._time = time.monotonic()
+
+    def add(self, key, timeout: float):
+        self.cancel(key)
+        ticks = max(1, math.ceil(timeout / self.tick))
+        index = (self._current + ticks) % len(self._slots)
+        self._slots[index][key] = (ticks - 1) // len(self._slots)
+        self._slot_of[key] = index
+
+    def cancel(self, key) -> bool:
+        index = self._slot_of.pop(key, None)
+        if index is None:
+            return False
+        del self._slots[index][key]
+        return True
+
+    def advance(self, now: float = None) -> list:
+        """Moves the wheel to now, returns the keys of the expired timers."""
+        if now is None:
+            now = time.monotonic()
+        expired = []
+        while self._time + self.tick <= now:
+            self._time += self.tick
+            self._current = (self._current + 1) % len(self._slots)
+            slot = self._slots[self._current]
+            for key, turns in list(slot.items()):
+                if turns > 0:
+                    slot[key] = turns - 1
+                    continue
+                del slot[key]
+                del self._slot_of[key]
+                expired.append(key)
+        return expired
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+
+class PendingRequests:
+    """The callback bundles of the requests sent to the server, by tid.
+
+    A bundle not completed within its timeout is removed by expire(), which
+    calls its onerror with TIMEOUT_CODE. Thread safe, the callbacks are
+    called without the lock held.
+    """
+
+    def __init__(
+        self, timeout: float = REQUEST_TIMEOUT, tick: float = TICK, slots: int = 512
+    ) -> None:
+        self.timeout = timeout
+        # Call expire() that often.
+        self.tick = tick
+        self._bundles = {}
+        self._wheel = TimerWheel(tick, slots)
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.expired = 0
+        self.dropped = 0
+
+    def add(self, tid, bundle, timeout: float = None):
+        with self._lock:
+            self._bundles[tid] = bundle
+            self._wheel.add(tid, self.timeout if timeout is None else timeout)
+
+    def pop(self, tid):
+        """Returns the bundle of a completed request, None if unknown."""
+        with self._lock:
+            bundle = self._bundles.pop(tid, None)
+            if bundle is not None:
+                self._wheel.cancel(tid)
+                self.completed += 1
+        if bundle is not None:
+            metrics.inc("requests_completed")
+        return bundle
+
+    def expire(self, now: float = None) -> int:
+        """Fails the requests past their deadline, returns how many."""
+        with self._lock:
+            bundles = [(tid, self._bundles.pop(tid)) for tid in self._wheel.advance(now)]
+            self.expired += len(bundles)
+        for tid, bundle in bundles:
+            logging.warning("Request %s timed out", tid)
+            metrics.inc("requests_expired")
+            onerror = bundle.get("onerror")
+            if onerror is None:
+                continue
+            try:
+                onerror(bundle.get("arg"), {"code": TIMEOUT_CODE, "text": "request timed out"})
+            except Exception as err:
+                logging.error("Error handling the timeout of %s: %s", tid, err)
+        return len(bundles)
+
+    def clear(self) -> int:
+        """Forgets all requests without calling them back, as after a
+        reconnect their replies will not come. Returns how many."""
+        with self._lock:
+            count = len(self._bundles)
+            for tid in self._bundles:
+                self._wheel.cancel(tid)
+            self._bundles.clear()
+            self.dropped += count
+        if count:
+            metrics.inc("requests_dropped", count)
+        return count
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": len(self._bundles),
+                "completed": self.completed,
+                "expired": self.expired,
+                "dropped": self.dropped,
+            }
+
+    def __len__(self) -> int:
+        return len(self._bundles)
+
+    def __contains__(self, tid) -> bool:
+        return tid in self._bundles
@@ -0,0 +1,42 @@
+import unittest
+import metrics
+import timer_wheel
+
+
+class TestTimerWheel(unittest.TestCase):
+    def test_expires_after_turns(self):
+        wheel = timer_wheel.TimerWheel(tick=1, slots=4)
+        start = wheel._time
+        wheel.add("a", 2)
+        wheel.add("b", 10)
+        wheel.add("c", 3)
+        wheel.cancel("c")
+        self.assertEqual(wheel.advance(start + 1), [])
+        self.assertEqual(wheel.advance(start + 2), ["a"])
+        # b is in the same slot as a, two turns later.
+        self.assertEqual(wheel.advance(start + 9), [])
+        self.assertEqual(wheel.advance(start + 10), ["b"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_pending_requests(self):
+        metrics.reset()
+        errors = []
+        requests = timer_wheel.PendingRequests(timeout=1, tick=0.5, slots=8)
+        start = requests._wheel._time
+        requests.add("1", {"arg": "me", "onerror": lambda arg, err: errors.append((arg, err["code"]))})
+        requests.add("2", {"arg": "usrA"})
+        self.assertIsNotNone(requests.pop("2"))
+        self.assertEqual(requests.expire(start + 1), 1)
+        self.assertEqual(errors, [("me", timer_wheel.TIMEOUT_CODE)])
+        self.assertIsNone(requests.pop("1"))
+        requests.add("3", {})
+        self.assertEqual(requests.clear(), 1)
+        self.assertEqual(
+            requests.stats(), {"in_flight": 0, "completed": 1, "expired": 1, "dropped": 1})
+        counters = {name: value for name, _, value in metrics.snapshot()["counters"]}
+        self.assertEqual(
+            counters, {"requests_completed": 1, "requests_expired": 1, "requests_dropped": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
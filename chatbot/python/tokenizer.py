@@ -0,0 +1,74 @@
+"""Token counting for the chat model.
+
+Counts come from tiktoken's BPE encoding of the model. tiktoken downloads
+the encoding file on first use, point TIKTOKEN_CACHE_DIR to a folder holding
+it to run offline. When the encoding cannot be loaded the counts fall back
+to an estimate which errs on the high side for mixed Chinese/English text.
+"""
+import functools
+import logging
+import math
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+MODEL = "gpt-3.5-turbo"
+# Every message is wrapped as <|start|>{role}\n{content}<|end|>\n.
+TOKENS_PER_MESSAGE = 4
+# Every reply is primed with <|start|>assistant<|message|>.
+TOKENS_PER_REPLY = 3
+
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        if tiktoken is None:
+            logging.warning("tiktoken is not installed, token counts are estimated")
+        else:
+            try:
+                _encoding = tiktoken.encoding_for_model(MODEL)
+            except Exception as e:
+                logging.warning("Failed to load the %s encoding, token counts are estimated: %s", MODEL, e)
+    return _encoding
+
+
+def _is_cjk(ch: str) -> bool:
+    code = ord(ch)
+    return (
+        0x3000 <= code <= 0x9FFF
+        or 0xAC00 <= code <= 0xD7AF
+        or 0xF900 <= code <= 0xFAFF
+        or 0xFF00 <= code <= 0xFFEF
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    # CJK characters take one to two tokens each, other text about four
+    # characters per token.
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    return math.ceil(cjk * 1.5 + (len(text) - cjk) / 4)
+
+
+@functools.lru_cache(maxsize=16384)
+def count_tokens(text: str) -> int:
+    """Returns the number of tokens of the text. Memoized, the turns of
+    a conversation are only tokenized once."""
+    encoding = _get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def message_tokens(msg) -> int:
+    """Returns the tokens a {"role", "content"} message takes in a prompt."""
+    return count_tokens(msg["content"]) + TOKENS_PER_MESSAGE
+
+
+def prompt_tokens(messages) -> int:
+    return sum(message_tokens(msg) for msg in messages) + TOKENS_PER_REPLY
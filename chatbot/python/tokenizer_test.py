@@ -0,0 +1,22 @@
+import unittest
+import tokenizer
+
+
+class TestTokenizer(unittest.TestCase):
+    def test_estimate(self):
+        self.assertEqual(tokenizer.estimate_tokens(""), 0)
+        self.assertEqual(tokenizer.estimate_tokens("你好"), 3)
+        self.assertEqual(tokenizer.estimate_tokens("hello world!"), 3)
+        self.assertEqual(tokenizer.estimate_tokens("你好 world"), 5)
+
+    def test_prompt_tokens(self):
+        messages = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+        self.assertEqual(
+            tokenizer.prompt_tokens(messages),
+            tokenizer.count_tokens("hi") + tokenizer.count_tokens("hello")
+            + 2 * tokenizer.TOKENS_PER_MESSAGE + tokenizer.TOKENS_PER_REPLY,
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+"""Imports the persona state files of runtime/*.json into the sqlite store."""
+import argparse
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import state_store  # noqa: E402
+
+
+def migrate(json_folder: str, sqlite_path: str) -> int:
+    source = state_store.JsonFileStateStore(json_folder)
+    target = state_store.SqliteStateStore(sqlite_path)
+    count = 0
+    for key in source.keys():
+        try:
+            fields = source.load(key)
+            history_start, history = source.load_history(key)
+        except (ValueError, OSError) as e:
+            # Files truncated by a crash of the old writer.
+            print("Skipped", key, e)
+            continue
+        target.save(key, fields, history_start, history, history_start)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runtime", default="runtime", help="folder of the json files")
+    parser.add_argument("--db", default="runtime/state.db", help="sqlite database")
+    args = parser.parse_args()
+    print("Migrated", migrate(args.runtime, args.db), "files")
+    print("Start the bots with CHATBOT_STATE_BACKEND=sqlite to use it.")
+
+
+if __name__ == "__main__":
+    main()
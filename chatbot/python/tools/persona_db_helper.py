@@ -1,7 +1,14 @@
+import argparse
 import json
+import pathlib
+import sys
 import yaml
 import redis
 
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import db  # noqa: E402
+
+
 def yaml_file_to_json_str(yaml_file_path: str)->str:
     with open(yaml_file_path, "r",encoding='utf-8') as f:
         yaml_content = yaml.safe_load(f)
@@ -22,11 +29,15 @@ def parse_json_str_to_dict(json_str: str)->dict:
         return json_str
 
 
+def connect_bot_db():
+    return redis.Redis(
+        host="47.103.17.145", port=8010, db=6, password="godword"
+    )
+
+
 def dump_redis_data():
     try:
-        with redis.Redis(
-            host="47.103.17.145", port=8010, db=6, password="godword"
-        ) as redis_ttl:
+        with connect_bot_db() as redis_ttl:
             all_data = {}
             for key in redis_ttl.keys():
                 all_data[key.decode('utf-8')] = parse_json_str_to_dict(redis_ttl.get(key).decode('utf-8'))
@@ -34,10 +45,36 @@ def dump_redis_data():
     except Exception as e:
         print(e)
         return None
- 
+
+
+def load_yaml_to_redis(yaml_file_path: str, names=None):
+    """Writes the bots of the yaml file to redis and tells the running bots."""
+    with open(yaml_file_path, "r",encoding='utf-8') as f:
+        yaml_content = yaml.safe_load(f)
+    with connect_bot_db() as redis_ttl:
+        for name, data in yaml_content.items():
+            if names and name not in names:
+                continue
+            if isinstance(data, dict):
+                value = json.dumps(data, ensure_ascii=False)
+            else:
+                value = str(data)
+            redis_ttl.set(name, value)
+            # The running bots and the manager reload the bot.
+            redis_ttl.publish(db.BOTS_CHANNEL, name)
+            print("Updated", name)
+
 
 def main():
-    dump_to_yaml_file("persona.yaml", dump_redis_data())
+    parser = argparse.ArgumentParser(description="Bot definitions in redis.")
+    parser.add_argument("action", nargs="?", default="dump", choices=["dump", "load"])
+    parser.add_argument("--file", default="persona.yaml")
+    parser.add_argument("--names", nargs="*", help="only load these bots")
+    args = parser.parse_args()
+    if args.action == "load":
+        load_yaml_to_redis(args.file, args.names)
+    else:
+        dump_to_yaml_file(args.file, dump_redis_data())
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
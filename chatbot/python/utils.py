@@ -1,8 +1,12 @@
+import atexit
+import functools
 import json
 import logging
 import logging.handlers
 import pathlib
 import os
+import queue
+import random
 import datetime
 import common
 from google.protobuf.json_format import MessageToDict
@@ -39,16 +43,167 @@ def clip_long_string(obj):
         return obj
 
 
+class SentenceChunker:
+    """Cuts a stream of text into sentences. Every complete sentence of at
+    least min_len characters is passed to emit(text, final) as soon as its
+    closing punctuation arrives."""
+
+    BOUNDARIES = "。！？!?；;\n"
+    CLOSERS = "\"”’)）」』"
+
+    def __init__(self, emit, min_len: int = 8):
+        self.emit = emit
+        self.min_len = min_len
+        self.buffer = ""
+
+    def _last_boundary(self) -> int:
+        # Returns the end of the last complete sentence in the buffer, or 0.
+        end = 0
+        i = 0
+        size = len(self.buffer)
+        while i < size:
+            ch = self.buffer[i]
+            if ch in self.BOUNDARIES or ch == ".":
+                j = i
+                while j + 1 < size and self.buffer[j + 1] in self.CLOSERS:
+                    j += 1
+                # A dot ends a sentence only when followed by a space,
+                # this keeps numbers like 3.14 in one piece.
+                if ch != "." or (j + 1 < size and self.buffer[j + 1].isspace()):
+                    end = j + 1
+                i = j
+            i += 1
+        return end
+
+    def feed(self, text: str):
+        self.buffer += text
+        end = self._last_boundary()
+        if end < self.min_len or not self.buffer[:end].strip():
+            return
+        chunk = self.buffer[:end]
+        self.buffer = self.buffer[end:]
+        self.emit(chunk, False)
+
+    def flush(self):
+        chunk = self.buffer
+        self.buffer = ""
+        self.emit(chunk, True)
+
+
 def to_json(msg):
     return json.dumps(clip_long_string(MessageToDict(msg)))
 
 
+class Lazy:
+    """Calls func(*args) only when the log message is rendered, e.g.
+    logging.debug("in: %s", utils.Lazy(utils.to_json, msg))."""
+
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self) -> str:
+        return str(self.func(*self.args))
+
+
+def lazy_json(msg) -> Lazy:
+    return Lazy(to_json, msg)
+
+
 def read_from_file(file_path) -> str:
     with open(file_path, "r") as f:
         return f.read()
 
 
+@functools.lru_cache(maxsize=None)
+def openai_api_key() -> str:
+    # Read once per process.
+    return read_from_file("openai.key").strip()
+
+
+# Fraction of the records of a category which are logged, a record has a
+# category if it's logged with extra={"category": ...}. Override with
+# CHATBOT_LOG_SAMPLING="msg.in=0.5,msg.out=1".
+LOG_SAMPLING = {
+    "msg.in": 0.1,
+    "msg.out": 0.1,
+}
+
+
+def _sampling_rates():
+    rates = dict(LOG_SAMPLING)
+    for item in os.environ.get("CHATBOT_LOG_SAMPLING", "").split(","):
+        if "=" in item:
+            category, rate = item.split("=", 1)
+            rates[category.strip()] = float(rate)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates) -> None:
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record) -> bool:
+        category = getattr(record, "category", None)
+        if category is None:
+            return True
+        rate = self.rates.get(category, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record) -> str:
+        data = {
+            "time": self.formatTime(record, "%Y-%m-%d %H:%M:%S"),
+            "level": record.levelname,
+            "pid": record.process,
+            "file": f"{record.filename}:{record.lineno}",
+            "msg": record.getMessage(),
+        }
+        category = getattr(record, "category", None)
+        if category is not None:
+            data["category"] = category
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class _BackgroundHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Arguments may change after the call, render the message now.
+        # Records below the level or not sampled never get here, their lazy
+        # arguments are not rendered at all. Formatting and writing are
+        # left to the writer thread.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+# The writer thread of this process.
+_listener = None
+_listener_pid = None
+
+
+def stop_logging():
+    """Writes the queued records and stops the writer thread."""
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    _listener = None
+
+
+atexit.register(stop_logging)
+
+
 def config_logging(logfile_name: str = ""):
+    """Logs to logs/logfile_name from a background thread. Records are JSON
+    lines unless CHATBOT_LOG_FORMAT=text, the level is CHATBOT_LOG_LEVEL."""
+    global _listener, _listener_pid
     time_str = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     process_id = os.getpid()
     # Set logfile name with date
@@ -63,14 +218,27 @@ def config_logging(logfile_name: str = ""):
         maxBytes=1024 * 1024 * 10,
         backupCount=5,
     )
+    if os.environ.get("CHATBOT_LOG_FORMAT") == "text":
+        file_rotate_handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(filename)s:%(lineno)d %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S",
+        ))
+    else:
+        file_rotate_handler.setFormatter(JsonFormatter())
+
+    # A forked worker inherits the parent's listener but not its thread.
+    stop_logging()
+    _listener = logging.handlers.QueueListener(queue.SimpleQueue(), file_rotate_handler)
+    _listener_pid = process_id
+    background_handler = _BackgroundHandler(_listener.queue)
+    background_handler.addFilter(SamplingFilter(_sampling_rates()))
+    _listener.start()
+
     logging.basicConfig(
-        level=logging.DEBUG,
-        format="%(asctime)s %(levelname)s %(filename)s:%(lineno)d %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-        handlers={file_rotate_handler},
-        # filename=logs_dir / logfile_name,
-        # filemode="a",
-        # encoding="utf-8",
+        level=os.environ.get("CHATBOT_LOG_LEVEL", "DEBUG").upper(),
+        handlers=[background_handler],
+        # Worker processes inherit the parent's handlers, replace them.
+        force=True,
     )
     logging.getLogger("grpc").setLevel(logging.INFO)
     logging.getLogger("grpc._channel").setLevel(logging.INFO)
@@ -0,0 +1,56 @@
+import json
+import logging
+import unittest
+import utils
+
+
+class TestSentenceChunker(unittest.TestCase):
+    def chunks(self, pieces, min_len=4):
+        out = []
+        chunker = utils.SentenceChunker(
+            lambda text, final: out.append((text, final)), min_len)
+        for piece in pieces:
+            chunker.feed(piece)
+        chunker.flush()
+        return out
+
+    def test_chinese_punctuation(self):
+        self.assertEqual(
+            self.chunks(["你好呀，今天", "天气很好。我们去", "公园吧！好", "不好"]),
+            [("你好呀，今天天气很好。", False), ("我们去公园吧！", False), ("好不好", True)],
+        )
+
+    def test_closing_quote_and_decimal(self):
+        self.assertEqual(
+            self.chunks(["He said \"pi is 3.", "14.\" Then", " left"]),
+            [("He said \"pi is 3.14.\"", False), (" Then left", True)],
+        )
+
+    def test_min_len(self):
+        self.assertEqual(
+            self.chunks(["嗯。", "好的，没问题。"], min_len=4),
+            [("嗯。好的，没问题。", False), ("", True)],
+        )
+
+
+class TestLogging(unittest.TestCase):
+    def test_sampled_out_is_not_rendered(self):
+        rendered = []
+        record = logging.LogRecord(
+            "root", logging.DEBUG, "x.py", 1, "in: %s",
+            (utils.Lazy(rendered.append, 1),), None)
+        record.category = "msg.in"
+        self.assertFalse(utils.SamplingFilter({"msg.in": 0.0}).filter(record))
+        self.assertEqual(rendered, [])
+        self.assertTrue(utils.SamplingFilter({}).filter(record))
+
+    def test_json_lines(self):
+        record = logging.LogRecord(
+            "root", logging.INFO, "x.py", 7, "hello %s", ("世界",), None)
+        data = json.loads(utils.JsonFormatter().format(record))
+        self.assertEqual(data["msg"], "hello 世界")
+        self.assertEqual(data["file"], "x.py:7")
+
+
+if __name__ == '__main__':
+    unittest.main()
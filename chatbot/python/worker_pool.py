@@ -0,0 +1,437 @@
+"""Long-lived worker processes that run process_chat for a chatbot, or
+for the bots of a BotHost."""
+import collections
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+import zlib
+
+import admission
+import metrics
+import photo_index
+import quota
+import utils
+from msg_proc import process_chat_burst, warm_up
+
+
+# Posted by a worker after the jobs of a bot of a BotHost, as
+# (JOB_DONE, worker index, number of jobs).
+JOB_DONE = "job_done"
+# First item of the jobs preparing the first message of a user, as
+# (WARM_UP, topic), or (WARM_UP, topic, (bot name, photos root)).
+WARM_UP = "warm_up"
+
+
+class OutQueue:
+    """The messages to send to the server, posted by the bot and its
+    workers. Each message is stamped with the time it was queued, and
+    tagged with the bot sending it when the workers serve several bots."""
+
+    def __init__(self) -> None:
+        self._queue = multiprocessing.Queue()
+
+    def put(self, msg, block: bool = True, timeout: float = None, tag=None):
+        self._queue.put((time.time(), tag, msg), block, timeout)
+
+    def get_tagged(self, block: bool = True, timeout: float = None):
+        """Returns (queued at, tag, message)."""
+        return self._queue.get(block, timeout)
+
+    def get_timed(self, block: bool = True, timeout: float = None):
+        """Returns (queued at, message)."""
+        queued_at, _, msg = self._queue.get(block, timeout)
+        return queued_at, msg
+
+    def get(self, block: bool = True, timeout: float = None):
+        return self._queue.get(block, timeout)[2]
+
+    def qsize(self) -> int:
+        try:
+            return self._queue.qsize()
+        except NotImplementedError:
+            # qsize() is not available on macOS.
+            return -1
+
+
+class _BotOutbox:
+    """The OutQueue as seen by process_chat for one bot of a BotHost."""
+
+    def __init__(self, queue_out, tag) -> None:
+        self.queue_out = queue_out
+        self.tag = tag
+
+    def put(self, msg):
+        self.queue_out.put(msg, tag=self.tag)
+
+
+def _topic_of(job):
+    topic = job[1] if job[0] == WARM_UP else job[0].data.topic
+    # Jobs of a BotHost are (msg, tid, (bot name, photos root, window)).
+    if len(job) > 2:
+        return job[2][0], topic
+    return topic
+
+
+def _window_of(job, window: float) -> float:
+    # Each bot of a BotHost has its own coalescing window.
+    if len(job) > 2:
+        return job[2][2]
+    return window
+
+
+# Seconds between two checks of an idle worker that its bot is alive.
+PARENT_CHECK_INTERVAL = 5
+
+
+class _ParentJobs:
+    """The job queue of a worker. Reads None, stopping the worker, once
+    the bot process is gone, so a killed bot leaves no workers behind."""
+
+    def __init__(self, jobs) -> None:
+        self.jobs = jobs
+        self.parent = os.getppid()
+
+    def get(self, timeout: float = None):
+        if timeout is not None:
+            return self.jobs.get(timeout=timeout)
+        while True:
+            try:
+                return self.jobs.get(timeout=PARENT_CHECK_INTERVAL)
+            except queue.Empty:
+                if os.getppid() != self.parent:
+                    logging.error("The bot process exited, stopping")
+                    return None
+
+    def get_nowait(self):
+        return self.jobs.get_nowait()
+
+
+def next_burst(jobs, pending, window: float, limit: int):
+    """Returns the next job together with the later jobs of the same topic,
+    or None when the worker must stop.
+
+    A topic is answered `window` seconds after its first waiting job was
+    received, or the window of the job's bot for the jobs of a BotHost,
+    with the jobs of the topic received until then. The topic
+    whose window ends first goes first, so jobs of other topics received
+    meanwhile wait for their own window only. `pending` keeps the
+    (received at, job) of the jobs not answered yet, at most `limit` of
+    them besides the next burst, so the bounded queue still pushes back on
+    the producer.
+    """
+    if not pending:
+        first = jobs.get()
+        pending.append((time.monotonic(), first))
+    stopping = any(job is None for _, job in pending)
+    while True:
+        while len(pending) <= limit and not stopping:
+            try:
+                job = jobs.get_nowait()
+            except queue.Empty:
+                break
+            pending.append((time.monotonic(), job))
+            stopping = job is None
+        if stopping:
+            # No more waiting, the worker exits after the jobs received.
+            received_at, first = pending[0]
+            if first is None:
+                return None
+            break
+        # {topic: end of its window}, in the order of the first jobs.
+        deadlines = {}
+        for received_at, job in pending:
+            deadlines.setdefault(_topic_of(job), received_at + _window_of(job, window))
+        topic = min(deadlines, key=deadlines.get)
+        timeout = deadlines[topic] - time.monotonic()
+        if timeout <= 0 or len(pending) > limit:
+            first = next(job for _, job in pending if _topic_of(job) == topic)
+            break
+        try:
+            job = jobs.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        pending.append((time.monotonic(), job))
+        stopping = job is None
+
+    topic = _topic_of(first)
+    burst = []
+    others = collections.deque()
+    while pending:
+        entry = pending.popleft()
+        job = entry[1]
+        if job is not None and _topic_of(job) == topic:
+            burst.append(job)
+        else:
+            others.append(entry)
+    pending.extend(others)
+    return burst
+
+
+def _worker_main(
+    index,
+    jobs,
+    queue_out,
+    bot_name,
+    photos_root,
+    queue_size,
+    coalesce_window,
+    admission_client,
+    metrics_folder,
+):
+    # Configure the worker once, it serves messages until it's told to stop.
+    utils.config_logging(logfile_name=f"{bot_name}_worker{index}.log")
+    logging.info("Worker %d started for %s", index, bot_name)
+    # The values inherited through fork are reported by the bot process.
+    metrics.reset()
+    report_metrics = None
+    if metrics_folder is not None:
+        # The bot process serves the metrics of all workers.
+        report_metrics = metrics.start_reporter(metrics_folder)
+    # LLM calls wait for a slot of the bot's admission controller.
+    admission.configure(admission_client)
+    # The quota used by the replies is debited in the background.
+    flush_quota = quota.start_flusher()
+    # Index the photos before the first message needs them.
+    if photos_root is not None:
+        photo_index.get_index(photos_root)
+    jobs = _ParentJobs(jobs)
+    pending = collections.deque()
+    while True:
+        burst = next_burst(jobs, pending, coalesce_window, queue_size)
+        if burst is None:
+            logging.info("Worker %d stopped", index)
+            flush_quota()
+            # The process exits without running atexit handlers.
+            if report_metrics is not None:
+                report_metrics()
+            utils.stop_logging()
+            return
+        tag = None
+        name, root, outbox = bot_name, photos_root, queue_out
+        if len(burst[0]) > 2:
+            tag = name = burst[0][2][0]
+            root = burst[0][2][1]
+            outbox = _BotOutbox(queue_out, tag)
+        jobs_done = len(burst)
+        try:
+            for job in burst:
+                if job[0] == WARM_UP:
+                    warm_up(job[1], name)
+            burst = [job for job in burst if job[0] != WARM_UP]
+            if burst:
+                msgs = [job[0] for job in burst]
+                process_chat_burst(msgs, burst[0][1], outbox, name, root)
+        except Exception as e:
+            logging.error(traceback.format_exc())
+            logging.error("Error in worker %d: %s", index, e)
+        if tag is not None:
+            # Lets the host admit more jobs of the bot.
+            queue_out.put((JOB_DONE, index, jobs_done), tag=tag)
+
+
+class WorkerPool:
+    """A fixed set of worker processes. Messages of the same topic always
+    go to the same worker, so they are processed in arrival order.
+    Each worker has a bounded queue, submit() fails when it's full.
+    Messages of a topic arriving within coalesce_window seconds, or while
+    the topic's previous reply is generated, are answered together.
+    The LLM calls of the workers are admitted by `admission`, if given.
+    Workers write their metrics to metrics_folder, if given.
+
+    The workers of a BotHost serve several bots, their jobs carry the bot
+    and are submitted with the bot name as tag. At most tag_limit jobs of
+    a tag are queued on the workers, later ones wait in a backlog of the
+    tag, so a busy bot does not fill the queues of the others.
+    """
+
+    def __init__(
+        self,
+        queue_out,
+        bot_name: str,
+        photos_root,
+        workers: int = 4,
+        queue_size: int = 64,
+        coalesce_window: float = 0.0,
+        admission=None,
+        metrics_folder=None,
+        tag_limit: int = 0,
+    ) -> None:
+        self.queue_out = queue_out
+        self.bot_name = bot_name
+        self.photos_root = photos_root
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.coalesce_window = coalesce_window
+        self.admission = admission
+        self.metrics_folder = metrics_folder
+        self.tag_limit = tag_limit
+        # {tag: jobs on the workers}, {worker index: {tag: jobs}}
+        self.in_flight = {}
+        self._worker_in_flight = {}
+        # {tag: deque of (topic, job)}
+        self.backlog = {}
+        self._lock = threading.Lock()
+        self.jobs = []
+        self.processors = []
+        self.submitted = 0
+        self.rejected = 0
+
+    def start(self):
+        for index in range(self.workers):
+            self.jobs.append(multiprocessing.Queue(self.queue_size))
+            self.processors.append(None)
+            self._start_worker(index)
+        if self.admission is not None:
+            self.admission.start()
+        logging.info(
+            "Worker pool started: %d workers, queue size %d",
+            self.workers,
+            self.queue_size,
+        )
+
+    def _start_worker(self, index):
+        admission_client = None
+        if self.admission is not None:
+            admission_client = self.admission.client(index)
+        processor = multiprocessing.Process(
+            target=_worker_main,
+            args=(
+                index,
+                self.jobs[index],
+                self.queue_out,
+                self.bot_name,
+                self.photos_root,
+                self.queue_size,
+                self.coalesce_window,
+                admission_client,
+                self.metrics_folder,
+            ),
+        )
+        processor.daemon = True
+        processor.start()
+        self.processors[index] = processor
+
+    def worker_index(self, topic: str) -> int:
+        # crc32 is stable across processes and restarts, unlike hash().
+        return zlib.crc32(topic.encode("utf-8")) % self.workers
+
+    def submit(self, topic: str, job, tag=None) -> bool:
+        """Queue the job on the worker owning the topic.
+        Returns False if the worker, or the backlog of the tag, is saturated."""
+        if tag is None or not self.tag_limit:
+            return self._put(topic, job)
+        with self._lock:
+            if self.in_flight.get(tag, 0) >= self.tag_limit:
+                backlog = self.backlog.setdefault(tag, collections.deque())
+                if len(backlog) >= self.queue_size:
+                    self.rejected += 1
+                    logging.warning("Backlog of %s is full, rejected the message", tag)
+                    return False
+                backlog.append((topic, job))
+                return True
+            self._count(tag, self.worker_index(topic), 1)
+        if not self._put(topic, job, tag):
+            with self._lock:
+                self._count(tag, self.worker_index(topic), -1)
+            return False
+        return True
+
+    def _count(self, tag, index: int, count: int):
+        self.in_flight[tag] = max(0, self.in_flight.get(tag, 0) + count)
+        worker = self._worker_in_flight.setdefault(index, {})
+        worker[tag] = max(0, worker.get(tag, 0) + count)
+
+    def done(self, tag, index: int, count: int):
+        """Called for each JOB_DONE of the workers. Queues the waiting jobs
+        of the tag, returns the ones which did not fit on their worker."""
+        if not self.tag_limit:
+            return []
+        ready = []
+        with self._lock:
+            self._count(tag, index, -count)
+            backlog = self.backlog.get(tag)
+            while backlog and self.in_flight.get(tag, 0) < self.tag_limit:
+                topic, job = backlog.popleft()
+                self._count(tag, self.worker_index(topic), 1)
+                ready.append((topic, job))
+            if backlog is not None and not backlog:
+                del self.backlog[tag]
+        rejected = []
+        for topic, job in ready:
+            if not self._put(topic, job, tag):
+                with self._lock:
+                    self._count(tag, self.worker_index(topic), -1)
+                rejected.append(job)
+        return rejected
+
+    def _put(self, topic: str, job, tag=None) -> bool:
+        # A job of tag is counted on its worker already.
+        index = self.worker_index(topic)
+        if not self.processors[index].is_alive():
+            logging.error("Worker %d died, restarting", index)
+            if self.admission is not None:
+                self.admission.reset(index)
+            with self._lock:
+                # The jobs the worker was answering are lost.
+                for lost_tag, count in self._worker_in_flight.pop(index, {}).items():
+                    self.in_flight[lost_tag] = max(0, self.in_flight.get(lost_tag, 0) - count)
+                if tag is not None:
+                    # But not the job being queued.
+                    self._count(tag, index, 1)
+            self._start_worker(index)
+        try:
+            self.jobs[index].put_nowait(job)
+        except queue.Full:
+            self.rejected += 1
+            logging.warning(
+                "Worker %d is saturated (%d queued), rejected %d messages so far",
+                index,
+                self.queue_size,
+                self.rejected,
+            )
+            return False
+        self.submitted += 1
+        return True
+
+    def stats(self):
+        depths = []
+        for jobs in self.jobs:
+            try:
+                depths.append(jobs.qsize())
+            except NotImplementedError:
+                # qsize() is not available on macOS.
+                depths.append(-1)
+        stats = {
+            "workers": self.workers,
+            "alive": sum(1 for p in self.processors if p.is_alive()),
+            "queue_size": self.queue_size,
+            "depths": depths,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+        }
+        if self.tag_limit:
+            with self._lock:
+                stats["in_flight"] = dict(self.in_flight)
+                stats["backlog"] = {tag: len(jobs) for tag, jobs in self.backlog.items()}
+        if self.admission is not None:
+            stats["admission"] = self.admission.stats()
+        return stats
+
+    def stop(self):
+        for jobs in self.jobs:
+            try:
+                jobs.put_nowait(None)
+            except queue.Full:
+                pass
+        for processor in self.processors:
+            processor.join(timeout=5)
+            if processor.is_alive():
+                processor.terminate()
+        if self.admission is not None:
+            self.admission.stop()
+        self.jobs.clear()
+        self.processors.clear()
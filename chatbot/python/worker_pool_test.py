@@ -0,0 +1,135 @@
+import collections
+import queue
+import time
+import unittest
+import model_pb2 as pb
+import msg_proc
+import worker_pool
+
+
+def data_msg(topic, seq):
+    return pb.ServerMsg(data=pb.ServerData(topic=topic, seq_id=seq)), str(seq)
+
+
+class Process:
+    def __init__(self, alive=True):
+        self.alive = alive
+
+    def is_alive(self):
+        return self.alive
+
+
+class TestWorkerPool(unittest.TestCase):
+    def pool(self, workers=2, queue_size=1, tag_limit=0):
+        # Queues of threads standing for the worker processes.
+        pool = worker_pool.WorkerPool(
+            None, "bot", None, workers=workers, queue_size=queue_size, tag_limit=tag_limit)
+        pool.jobs = [queue.Queue(queue_size) for _ in range(workers)]
+        pool.processors = [Process() for _ in range(workers)]
+        return pool
+
+    def test_submit_same_worker(self):
+        pool = self.pool(workers=4, queue_size=8)
+        for seq in range(3):
+            self.assertTrue(pool.submit("usrA", data_msg("usrA", seq)))
+        jobs = pool.jobs[pool.worker_index("usrA")]
+        self.assertEqual([jobs.get_nowait()[1] for _ in range(3)], ["0", "1", "2"])
+        self.assertEqual(pool.stats()["submitted"], 3)
+
+    def test_submit_saturated(self):
+        pool = self.pool()
+        self.assertTrue(pool.submit("usrA", data_msg("usrA", 1)))
+        self.assertFalse(pool.submit("usrA", data_msg("usrA", 2)))
+        self.assertEqual(pool.stats()["rejected"], 1)
+
+    def test_submit_tag_limit(self):
+        pool = self.pool(workers=1, queue_size=4, tag_limit=1)
+        self.assertTrue(pool.submit("usrA", data_msg("usrA", 1), tag="bot"))
+        # Over the limit of the bot, it waits in the backlog.
+        self.assertTrue(pool.submit("usrB", data_msg("usrB", 2), tag="bot"))
+        self.assertEqual(pool.stats()["backlog"], {"bot": 1})
+        self.assertEqual(pool.jobs[0].get_nowait()[1], "1")
+        # Queued once the first one is done.
+        self.assertEqual(pool.done("bot", 0, 1), [])
+        self.assertEqual(pool.stats()["in_flight"], {"bot": 1})
+        self.assertEqual(pool.jobs[0].get_nowait()[1], "2")
+
+    def test_dead_worker_restarted(self):
+        pool = self.pool(tag_limit=2)
+        started = []
+        pool._start_worker = started.append
+        self.assertTrue(pool.submit("usrA", data_msg("usrA", 1), tag="bot"))
+        pool.processors[pool.worker_index("usrA")].alive = False
+        pool.jobs[pool.worker_index("usrA")].get_nowait()
+        self.assertTrue(pool.submit("usrA", data_msg("usrA", 2), tag="bot"))
+        self.assertEqual(started, [pool.worker_index("usrA")])
+        # The job of the dead worker is not counted anymore.
+        self.assertEqual(pool.in_flight, {"bot": 1})
+
+    def test_next_burst_groups_topic(self):
+        jobs = queue.Queue()
+        for job in [data_msg("a", 1), data_msg("b", 2), data_msg("a", 3), data_msg("b", 4)]:
+            jobs.put(job)
+        pending = collections.deque()
+        burst = worker_pool.next_burst(jobs, pending, 0, 10)
+        self.assertEqual([tid for _, tid in burst], ["1", "3"])
+        burst = worker_pool.next_burst(jobs, pending, 0, 10)
+        self.assertEqual([tid for _, tid in burst], ["2", "4"])
+        self.assertEqual(len(pending), 0)
+
+    def test_next_burst_stops(self):
+        jobs = queue.Queue()
+        jobs.put(data_msg("a", 1))
+        jobs.put(None)
+        pending = collections.deque()
+        self.assertEqual(len(worker_pool.next_burst(jobs, pending, 0, 10)), 1)
+        self.assertIsNone(worker_pool.next_burst(jobs, pending, 0, 10))
+
+    def test_next_burst_limit(self):
+        jobs = queue.Queue()
+        for seq in range(5):
+            jobs.put(data_msg("b" if seq else "a", seq))
+        pending = collections.deque()
+        worker_pool.next_burst(jobs, pending, 0, 2)
+        self.assertEqual(len(pending), 2)
+        self.assertEqual(jobs.qsize(), 2)
+
+    def test_next_burst_window_per_topic(self):
+        jobs = queue.Queue()
+        for job in [data_msg("a", 1), data_msg("b", 2), data_msg("a", 3)]:
+            jobs.put(job)
+        pending = collections.deque()
+        start = time.monotonic()
+        burst = worker_pool.next_burst(jobs, pending, 0.3, 10)
+        self.assertEqual([tid for _, tid in burst], ["1", "3"])
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        # The window of b ended while a was waiting.
+        start = time.monotonic()
+        burst = worker_pool.next_burst(jobs, pending, 0.3, 10)
+        self.assertEqual([tid for _, tid in burst], ["2"])
+        self.assertLess(time.monotonic() - start, 0.1)
+
+    def test_next_burst_window_per_bot(self):
+        jobs = queue.Queue()
+        # Hosted bots: "slow" coalesces for 0.3s, "fast" doesn't.
+        jobs.put(data_msg("a", 1) + (("slow", "", 0.3),))
+        jobs.put(data_msg("a", 2) + (("fast", "", 0.0),))
+        pending = collections.deque()
+        start = time.monotonic()
+        burst = worker_pool.next_burst(jobs, pending, 1.0, 10)
+        self.assertEqual([job[1] for job in burst], ["2"])
+        self.assertLess(time.monotonic() - start, 0.1)
+        burst = worker_pool.next_burst(jobs, pending, 1.0, 10)
+        self.assertEqual([job[1] for job in burst], ["1"])
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        self.assertLess(time.monotonic() - start, 1.0)
+
+    def test_merge_burst(self):
+        self.assertEqual(
+            msg_proc.merge_burst(["你好", "在吗", "看照片", "hi", "DEL", "bye"]),
+            ["你好\n在吗", "看照片", "hi", "DEL", "bye"],
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()